@@ -13,6 +13,8 @@ import superdesk
 from analytics.report_configs import ReportConfigsResource, ReportConfigsService
 from analytics.base_report import BaseReportService
 from analytics.saved_reports import SavedReportsResource, SavedReportsService
+from analytics.report_batch import ReportBatchResource, ReportBatchService
+from analytics.report_jobs import ReportJobsResource, ReportJobsService
 from analytics.reports.scheduled_reports import (
     ScheduledReportsResource,
     ScheduledReportsService,
@@ -36,6 +38,7 @@ from analytics.update_time_report import init_app as init_update_time_report
 
 from analytics.commands import SendScheduledReports  # noqa
 from analytics.common import get_highcharts_cli_path, register_report
+from analytics.reference_cache import init_app as init_reference_cache
 from superdesk.celery_app import celery
 from superdesk.default_settings import celery_queue, crontab
 
@@ -100,10 +103,19 @@ def init_app(app):
         description="User can manage scheduling of reports",
     )
 
+    endpoint_name = ReportBatchResource.endpoint_name
+    service = ReportBatchService(endpoint_name, backend=superdesk.get_backend())
+    ReportBatchResource(endpoint_name, app=app, service=service)
+
+    endpoint_name = ReportJobsResource.endpoint_name
+    service = ReportJobsService(endpoint_name, backend=superdesk.get_backend())
+    ReportJobsResource(endpoint_name, app=app, service=service)
+
     endpoint_name = ReportConfigsResource.endpoint_name
     service = ReportConfigsService(endpoint_name, backend=superdesk.get_backend())
     ReportConfigsResource(endpoint_name, app=app, service=service)
 
+    init_reference_cache(app)
     init_content_publishing_report(app)
     init_publishing_performance_report(app)
     init_email_report(app)
@@ -11,7 +11,7 @@
 from flask import json, current_app as app
 from eve_elastic.elastic import set_filters, ElasticCursor
 
-from superdesk import get_resource_service, es_utils
+from superdesk import es_utils
 from superdesk.resource import Resource
 from superdesk.utils import ListCursor
 from superdesk.utc import utcnow, get_timezone_offset
@@ -22,11 +22,15 @@ from apps.search import SearchService
 
 from analytics.common import (
     MIME_TYPES,
+    MAX_TERMS_SIZE,
     get_elastic_version,
     get_weekstart_offset_hr,
     DATE_FILTERS,
     relative_to_absolute_datetime,
 )
+from analytics.base_report.report_cache import cache_enabled, cached_report
+from analytics.base_report.single_flight import coalesced_report
+from analytics.reference_cache import get_invisible_stage_ids
 
 
 class BaseReportResource(Resource):
@@ -51,6 +55,42 @@ class BaseReportResource(Resource):
     }
 
 
+class CompositeBuckets:
+    """The buckets of a composite aggregation, in the terms aggregation format
+
+    The buckets are streamed in the order of their keys. The first page is kept from the response,
+    and the following pages are requested as the buckets are iterated (again on each iteration),
+    so the report generators don't hold all the pages of the aggregation in memory.
+    """
+
+    def __init__(self, service, query, types, args, agg_id, response, sort_by_count=True):
+        self.service = service
+        self.query = query
+        self.types = types
+        self.args = args
+        self.agg_id = agg_id
+        self.response = response
+        self.sort_by_count = sort_by_count
+
+    def __bool__(self):
+        return bool(self.response.get("buckets"))
+
+    def __iter__(self):
+        for bucket in self.service.iter_composite_buckets(
+            self.query, self.types, self.args, self.agg_id, self.response
+        ):
+            yield dict(bucket, key=bucket["key"][self.agg_id])
+
+    def to_list(self):
+        """Returns all the buckets, in the same order as the terms aggregation (by doc_count unless ordered by key)"""
+        buckets = list(self)
+
+        if self.sort_by_count:
+            buckets.sort(key=lambda bucket: bucket.get("doc_count") or 0, reverse=True)
+
+        return buckets
+
+
 class BaseReportService(SearchService):
     exclude_stages_with_global_read_off = True
     date_filter_field = "versioncreated"
@@ -59,13 +99,15 @@ class BaseReportService(SearchService):
     defaultConfig = {}
     repos = REPOS
 
+    # Group of the result cache, used to invalidate the cached reports (config ANALYTICS_REPORT_CACHE)
+    cache_group = "reports"
+
     def get_stages_to_exclude(self):
         """
         Overriding from the base SearchService so we can control which stages to include.
         """
         if self.exclude_stages_with_global_read_off:
-            stages = get_resource_service("stages").get_stages_by_visibility(is_visible=False)
-            return [str(stage["_id"]) for stage in stages]
+            return get_invisible_stage_ids()
 
         return []
 
@@ -102,9 +144,12 @@ class BaseReportService(SearchService):
         """
         return {}
 
-    def get_aggregation_buckets(self, docs, aggregation_ids=None):
+    def get_aggregation_buckets(self, docs, aggregation_ids=None, stream=False):
         """
         Retrieves the aggregation buckets from the documents provided
+
+        The buckets of composite aggregations are returned as a list (in the order of the terms aggregation),
+        unless ``stream`` is True, where they're returned as an iterable of the pages (see CompositeBuckets)
         """
         if aggregation_ids is None:
             aggregation_ids = self.aggregations.keys()
@@ -115,12 +160,32 @@ class BaseReportService(SearchService):
             aggregations = docs.get("aggregations") or {}
             buckets[aggregation_id] = (aggregations.get(aggregation_id) or {}).get("buckets") or []
 
+            if isinstance(buckets[aggregation_id], CompositeBuckets) and not stream:
+                buckets[aggregation_id] = buckets[aggregation_id].to_list()
+
         return buckets
 
+    @staticmethod
+    def sort_groups_by_count(buckets, groups, counts):
+        """Re-orders the groups of a report by their doc_count, after streaming the buckets of a composite aggregation
+
+        The composite aggregation returns the buckets in the order of their keys, whereas the terms aggregation
+        it replaces returns them by doc_count (then by key).
+
+        :param buckets: The buckets the groups were generated from
+        :param dict groups: The groups of the report, in the order of the buckets
+        :param dict counts: The doc_count of each group
+        :return dict: The groups, in the order of the terms aggregation
+        """
+        if not isinstance(buckets, CompositeBuckets) or not buckets.sort_by_count:
+            return groups
+
+        return {key: groups[key] for key in sorted(groups, key=lambda key: counts.get(key) or 0, reverse=True)}
+
     def get_aggregations(self, params, args):
         return self.aggregations
 
-    def _get_histogram_aggregation(self, interval, args, aggregations):
+    def _get_histogram_aggregation(self, interval, args, aggregations, field=None):
         params = args.get("params") or {}
         lt, gte, time_zone = self._es_get_date_filters(params)
 
@@ -144,7 +209,7 @@ class BaseReportService(SearchService):
         aggs = {
             "dates": {
                 "date_histogram": {
-                    "field": self.histogram_source_field,
+                    "field": field or self.histogram_source_field,
                     "interval": interval,
                     "time_zone": time_zone,
                     "min_doc_count": 0,
@@ -176,18 +241,18 @@ class BaseReportService(SearchService):
 
         return 3600000 * hours  # (milliseconds in an hour) * number of hours
 
-    def get_histogram_aggregation(self, aggs, params, args):
+    def get_histogram_aggregation(self, aggs, params, args, field=None):
         interval = self.get_histogram_interval(args)
 
         if not interval:
             return aggs
 
         if interval == "hourly":
-            return self._get_histogram_aggregation("hour", args, aggs)
+            return self._get_histogram_aggregation("hour", args, aggs, field)
         elif interval == "weekly":
-            return self._get_histogram_aggregation("week", args, aggs)
+            return self._get_histogram_aggregation("week", args, aggs, field)
 
-        return self._get_histogram_aggregation("day", args, aggs)
+        return self._get_histogram_aggregation("day", args, aggs, field)
 
     def get_request_aggregations(self, params, args):
         aggs = self.get_aggregations(params, args)
@@ -246,6 +311,29 @@ class BaseReportService(SearchService):
         return es_utils.get_index(types)
 
     def run_query(self, params, args):
+        query, types = self.build_query(params, args)
+        return self.execute_query(query, types, args)
+
+    def execute_query(self, query, types, args):
+        if self.is_aggregation_query(query, args):
+            return self.search_aggregations(query, types, args)
+
+        docs = self.search_elastic(query, types, args)
+
+        for resource in types:
+            response = {app.config["ITEMS"]: [doc for doc in docs if doc["_type"] == resource]}
+            getattr(app, "on_fetched_resource")(resource, response)
+            getattr(app, "on_fetched_resource_%s" % resource)(response)
+
+        return docs
+
+    def build_query(self, params, args):
+        """Builds the Elasticsearch query of the report, along with the repos to search
+
+        :param dict params: The params of the report request
+        :param dict args: The arguments of the report request
+        :return tuple: (query, types)
+        """
         query = params.get("source") or {}
         if "query" not in query:
             query["query"] = {"filtered": {}}
@@ -272,20 +360,201 @@ class BaseReportService(SearchService):
         if filters:
             set_filters(query, filters)
 
-        index = self.get_elastic_index(types)
+        return query, types
 
-        docs = self.elastic.search(query, types, params={})
+    def search_elastic(self, query, types, args):
+        return self.elastic.search(query, types, params={})
 
-        for resource in types:
-            response = {app.config["ITEMS"]: [doc for doc in docs if doc["_type"] == resource]}
-            getattr(app, "on_fetched_resource")(resource, response)
-            getattr(app, "on_fetched_resource_%s" % resource)(response)
+    def get_search_indices(self, types, args):
+        """Returns the Elasticsearch indices to search, used when the query is sent in a batch"""
+        return [app.data.elastic._resource_index(resource) for resource in types]
 
-        return docs
+    def can_batch(self, args):
+        """Returns True if the query of the report can be sent in a batch with other reports"""
+        return True
+
+    def is_aggregation_query(self, query, args):
+        """Returns True if the report only uses the aggregations, not the hits of the query"""
+        return query.get("size") == 0 and bool(query.get("aggs")) and not int(args.get("include_items") or 0)
+
+    def search_aggregations(self, query, types, args):
+        """Runs a query for its aggregations only
+
+        No hits are returned, so the fetch hooks of the resources are not called.
+        The total number of hits is not tracked (Elasticsearch 7+), so the cursor only provides the aggregations.
+        """
+        composite_ids = self.apply_composite_aggregations(query)
+        docs = self.search_elastic(self.get_aggregation_query(query), types, args)
+        hits = self.page_composite_aggregations(query, types, args, composite_ids, docs.hits)
+
+        return self.get_aggregation_cursor(hits)
+
+    def get_aggregation_query(self, query):
+        if int(get_elastic_version().split(".")[0]) >= 7:
+            query["track_total_hits"] = False
+
+        return query
+
+    def get_aggregation_cursor(self, hits):
+        return ElasticCursor({"hits": {"hits": []}, "aggregations": hits.get("aggregations") or {}})
+
+    @staticmethod
+    def composite_enabled():
+        """Returns True if terms aggregations can be paged through using a composite aggregation"""
+        if not app.config.get("ANALYTICS_COMPOSITE_AGGREGATIONS", True):
+            return False
+
+        # The after_key of the composite aggregation is returned since Elasticsearch 6.3
+        version = [int(part) for part in get_elastic_version().split(".")[:2] if part.isdigit()]
+        return version >= [6, 3]
+
+    @staticmethod
+    def get_terms_key_order(terms):
+        """Returns the direction of a terms aggregation ordered by its keys, or None if it isn't"""
+        order = terms.get("order")
+
+        if isinstance(order, dict) and len(order) == 1 and list(order.keys())[0] in ["_key", "_term"]:
+            return list(order.values())[0]
+
+        return None
+
+    @staticmethod
+    def is_composite_terms(agg):
+        """Returns True if the aggregation returns all the buckets of a field, and can be paged through
+
+        Terms aggregations with a size below MAX_TERMS_SIZE are the top N buckets, and stay terms aggregations
+        so Elasticsearch orders and truncates them. So do terms aggregations using include, missing,
+        min_doc_count other than 1, or ordered by anything other than the key.
+        """
+        terms = agg.get("terms") or {}
+
+        return (
+            set(agg.keys()) <= {"terms", "aggs"}
+            and "field" in terms
+            and set(terms.keys()) <= {"field", "size", "shard_size", "order", "min_doc_count"}
+            and (terms.get("size") or 0) >= MAX_TERMS_SIZE
+            and terms.get("min_doc_count", 1) == 1
+            and ("order" not in terms or BaseReportService.get_terms_key_order(terms) in ["asc", "desc"])
+        )
+
+    def apply_composite_aggregations(self, query):
+        """Replaces the top level terms aggregations that return all buckets with composite aggregations
+
+        :param dict query: The Elasticsearch query
+        :return dict: The ids of the aggregations that were replaced, and whether their buckets are ordered by count
+        """
+        aggs = query.get("aggs") or {}
+        composite_ids = {
+            agg_id: "order" not in agg["terms"] for agg_id, agg in aggs.items() if self.is_composite_terms(agg)
+        }
+
+        if not composite_ids or not self.composite_enabled():
+            return {}
+
+        # The aggregations can be a class attribute of the report, so they're not modified in place
+        query["aggs"] = dict(aggs)
+        page_size = int(app.config.get("ANALYTICS_COMPOSITE_AGGREGATION_SIZE", MAX_TERMS_SIZE))
+
+        for agg_id in composite_ids:
+            terms = aggs[agg_id]["terms"]
+            source = {"field": terms["field"], "order": self.get_terms_key_order(terms) or "asc"}
+            composite = {"composite": {"size": page_size, "sources": [{agg_id: {"terms": source}}]}}
+
+            if aggs[agg_id].get("aggs"):
+                composite["aggs"] = aggs[agg_id]["aggs"]
+
+            query["aggs"][agg_id] = composite
+
+        return composite_ids
+
+    def iter_composite_buckets(self, query, types, args, agg_id, response):
+        """Yields the buckets of a composite aggregation, requesting the next page using the after_key
+
+        :param dict query: The Elasticsearch query, containing the composite aggregation
+        :param list types: The repos to search
+        :param dict args: The arguments of the report request
+        :param str agg_id: The id of the composite aggregation
+        :param dict response: The first page of the aggregation
+        """
+        agg = query["aggs"][agg_id]
+
+        while True:
+            buckets = response.get("buckets") or []
+
+            for bucket in buckets:
+                yield bucket
+
+            after_key = response.get("after_key")
+
+            if not after_key or len(buckets) < agg["composite"]["size"]:
+                return
+
+            # Only the composite aggregation is requested in the following pages
+            page_agg = dict(agg, composite=dict(agg["composite"], after=after_key))
+            docs = self.search_elastic(dict(query, aggs={agg_id: page_agg}), types, args)
+            response = (docs.hits.get("aggregations") or {}).get(agg_id) or {}
+
+    def page_composite_aggregations(self, query, types, args, composite_ids, hits):
+        """Returns the response with the buckets of the composite aggregations, paged through as they're iterated
+
+        The buckets are streamed in the order of their keys (see CompositeBuckets). Reports that need them in
+        the order of the terms aggregation get them as a list from ``get_aggregation_buckets``.
+
+        :param dict query: The Elasticsearch query
+        :param list types: The repos to search
+        :param dict args: The arguments of the report request
+        :param dict composite_ids: The ids returned from apply_composite_aggregations
+        :param dict hits: The response of the first page
+        :return dict: The response, with the buckets of the composite aggregations
+        """
+        if not composite_ids:
+            return hits
+
+        aggregations = dict(hits.get("aggregations") or {})
+
+        for agg_id, sort_by_count in composite_ids.items():
+            response = aggregations.get(agg_id) or {}
+            buckets = CompositeBuckets(self, query, types, args, agg_id, response, sort_by_count)
+            aggregations[agg_id] = {"buckets": buckets}
+
+        return dict(hits, aggregations=aggregations)
+
+    def get_cache_extra(self, args):
+        """Returns the values, other than the request arguments, that the cached report depends on"""
+        return {"repos": self.repos, "excluded_stages": self.get_stages_to_exclude()}
 
     def get(self, req, **lookup):
         args = self._get_request_or_lookup(req, **lookup)
 
+        if int(args.get("include_items") or 0):
+            report = self.get_report(args)
+        else:
+            extra = self.get_cache_extra(args)
+
+            # Identical concurrent requests share the one report, whether or not the result is then cached
+            def generate():
+                return coalesced_report(self.datasource, args, extra, lambda: self.get_report(args))
+
+            if cache_enabled():
+                report = cached_report(self.datasource, self.cache_group, args, extra, generate)
+            else:
+                report = generate()
+
+        if isinstance(report, list):
+            return ListCursor(report)
+        elif isinstance(report, ListCursor):
+            return report
+        elif isinstance(report, ElasticCursor):
+            return report
+        return ListCursor([report])
+
+    def get_report(self, args):
+        params = self.get_query_params(args)
+        docs = self.run_query(params, args)
+
+        return self.generate_output(docs, args)
+
+    def get_query_params(self, args):
         if args.get("source"):
             params = {"source": args["source"], "repo": args.get("repo")}
 
@@ -299,8 +568,9 @@ class BaseReportService(SearchService):
         else:
             raise SuperdeskApiError.badRequestError("source/query not provided")
 
-        docs = self.run_query(params, args)
+        return params
 
+    def generate_output(self, docs, args):
         if args["return_type"] == "highcharts_config":
             report = self.generate_highcharts_config(docs, args)
         elif args["return_type"] == MIME_TYPES.CSV:
@@ -313,13 +583,7 @@ class BaseReportService(SearchService):
         if "include_items" in args and int(args["include_items"]):
             report["_items"] = list(docs)
 
-        if isinstance(report, list):
-            return ListCursor(report)
-        elif isinstance(report, ListCursor):
-            return report
-        elif isinstance(report, ElasticCursor):
-            return report
-        return ListCursor([report])
+        return report
 
     def get_utc_offset(self):
         return get_timezone_offset(app.config["DEFAULT_TIMEZONE"], utcnow())
@@ -13,6 +13,8 @@ from superdesk.metadata.item import ITEM_STATE, CONTENT_STATE
 from superdesk.tests import TestCase
 
 from analytics import init_app
+from analytics.base_report import CompositeBuckets
+from analytics.common import MAX_TERMS_SIZE
 
 from eve.utils import ParsedRequest
 from werkzeug.datastructures import ImmutableMultiDict
@@ -845,3 +847,101 @@ class BaseReportServiceTestCase(TestCase):
             aggs=lookup["aggs"],
         )
         self.assertEqual(args, expected_args)
+
+    def test_aggregation_query_skips_fetch_hooks(self):
+        source = {"query": {"filtered": {"filter": {"bool": {"must": [], "must_not": []}}}}, "size": 0}
+
+        with self.app.app_context():
+            with mock.patch.object(self.app, "on_fetched_resource") as on_fetched:
+                report = list(self.service.get(req=None, source=source, repo="published"))[0]
+                self.assertEqual(report["source"], [{"key": "AAP", "doc_count": 1}])
+                self.assertEqual(on_fetched.call_count, 0)
+
+                # Queries that return hits still call the fetch hooks
+                self.service.get(req=None, source=dict(source, size=10), repo="published")
+                self.assertEqual(on_fetched.call_count, 1)
+
+    def test_composite_aggregation_pages_through_all_buckets(self):
+        source = {"query": {"filtered": {"filter": {"bool": {"must": [], "must_not": []}}}}, "size": 0}
+        aggregations = {"source": {"terms": {"field": "source", "size": MAX_TERMS_SIZE}}}
+
+        with self.app.app_context():
+            self.app.config["ANALYTICS_COMPOSITE_AGGREGATION_SIZE"] = 1
+            self.app.data.insert(
+                "published",
+                [
+                    {"_id": "item2", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AFP"},
+                    {"_id": "item3", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AFP"},
+                    {"_id": "item4", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "Reuters"},
+                ],
+            )
+
+            with mock.patch.object(self.service, "aggregations", aggregations), mock.patch.object(
+                self.service, "search_elastic", wraps=self.service.search_elastic
+            ) as search_elastic:
+                report = list(self.service.get(req=None, source=source, repo="published"))[0]
+
+            # A page for each source, and the last empty page
+            self.assertEqual(search_elastic.call_count, 4)
+            self.assertEqual(
+                report["source"],
+                [{"key": "AFP", "doc_count": 2}, {"key": "AAP", "doc_count": 1}, {"key": "Reuters", "doc_count": 1}],
+            )
+            self.assertEqual(aggregations["source"]["terms"], {"field": "source", "size": MAX_TERMS_SIZE})
+
+    def test_composite_buckets_are_streamed(self):
+        source = {"query": {"filtered": {"filter": {"bool": {"must": [], "must_not": []}}}}, "size": 0}
+        aggregations = {"source": {"terms": {"field": "source", "size": MAX_TERMS_SIZE, "order": {"_key": "desc"}}}}
+
+        with self.app.app_context(), mock.patch.dict(self.app.config, {"ANALYTICS_COMPOSITE_AGGREGATION_SIZE": 1}):
+            self.app.data.insert(
+                "published",
+                [
+                    {"_id": "item2", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AFP"},
+                    {"_id": "item3", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "Reuters"},
+                ],
+            )
+
+            with mock.patch.object(self.service, "aggregations", aggregations), mock.patch.object(
+                self.service, "generate_report", side_effect=lambda docs, args: docs
+            ):
+                docs = self.service.get(req=None, source=source, repo="published")
+
+            with mock.patch.object(self.service, "search_elastic", wraps=self.service.search_elastic) as search_elastic:
+                buckets = self.service.get_aggregation_buckets(docs.hits, ["source"], stream=True)["source"]
+                self.assertEqual(search_elastic.call_count, 0)
+
+                # The following pages are requested as the buckets are iterated, in the order of the keys
+                iterator = iter(buckets)
+                self.assertEqual(next(iterator)["key"], "Reuters")
+                self.assertEqual(search_elastic.call_count, 0)
+                self.assertEqual(next(iterator)["key"], "AFP")
+                self.assertEqual(search_elastic.call_count, 1)
+
+    def test_streamed_groups_are_sorted_by_count(self):
+        groups = {"AAP": {"published": 1}, "AFP": {"published": 3}, "Reuters": {"published": 2}}
+        counts = {"AAP": 1, "AFP": 3, "Reuters": 2}
+        buckets = CompositeBuckets(self.service, {}, [], {}, "parent", {"buckets": []})
+
+        # Same order as the terms aggregation, by doc_count
+        self.assertEqual(list(self.service.sort_groups_by_count(buckets, groups, counts)), ["AFP", "Reuters", "AAP"])
+
+        # Ordered by key, or not streamed
+        buckets.sort_by_count = False
+        self.assertEqual(list(self.service.sort_groups_by_count(buckets, groups, counts)), ["AAP", "AFP", "Reuters"])
+        self.assertEqual(list(self.service.sort_groups_by_count([], groups, counts)), ["AAP", "AFP", "Reuters"])
+
+    def test_top_n_terms_are_not_paged(self):
+        is_composite = self.service.is_composite_terms
+
+        self.assertTrue(is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE}}))
+        self.assertTrue(is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE, "order": {"_key": "asc"}}}))
+        self.assertTrue(is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE, "min_doc_count": 1}}))
+
+        # The top N buckets are ordered and truncated by Elasticsearch
+        self.assertFalse(is_composite({"terms": {"field": "source", "size": 10}}))
+        self.assertFalse(
+            is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE, "order": {"_count": "asc"}}})
+        )
+        self.assertFalse(is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE, "include": ["AAP"]}}))
+        self.assertFalse(is_composite({"terms": {"field": "source", "size": MAX_TERMS_SIZE, "min_doc_count": 0}}))
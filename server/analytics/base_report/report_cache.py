@@ -0,0 +1,251 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, Option
+from superdesk.logging import logger
+
+from analytics.common import DATE_FILTERS
+from analytics.reference_cache import get_redis
+
+from flask import json, current_app as app
+from bson import json_util
+from hashlib import sha1
+from time import monotonic
+import redis
+
+
+KEY_PREFIX = "analytics:report_cache"
+
+# Cache groups, each with their own version, so they can be invalidated separately
+CACHE_GROUPS = ["reports", "stats"]
+
+
+def cache_enabled():
+    return app.config.get("ANALYTICS_REPORT_CACHE", False)
+
+
+def _get_version_key(group):
+    return "{}:version:{}".format(KEY_PREFIX, group)
+
+
+def _get_counters_key():
+    return "{}:counters".format(KEY_PREFIX)
+
+
+def is_relative(value):
+    """Returns True if the value contains a date relative to now (i.e. ``now/d`` or ``now-1d/d``)"""
+
+    return '"now' in json.dumps(value or {})
+
+
+def get_fingerprint(args, extra=None):
+    """Returns a hash of the normalised arguments of a report request, along with the values it depends on"""
+
+    fingerprint = json.dumps({"args": args, "extra": extra or {}}, sort_keys=True, default=str)
+    return sha1(fingerprint.encode("utf-8")).hexdigest()
+
+
+def get_cache_key(report, group, args, extra=None):
+    """Returns the key of a report result, using the current version of the cache group
+
+    :param str report: The name of the report
+    :param str group: The cache group of the report
+    :param dict args: The arguments of the report request
+    :param dict extra: Additional values the result depends on (i.e. repos and excluded stages)
+    :return str: The key of the cached result
+    """
+
+    version = int(get_redis().get(_get_version_key(group)) or 0)
+    return "{}:{}:{}:{}:{}".format(KEY_PREFIX, group, version, report, get_fingerprint(args, extra))
+
+
+def get_ttl(group, args):
+    """Returns the number of seconds to keep a report result for
+
+    Results filtered by a relative date (i.e. ``now/d``) use a short TTL, as the date range moves with time.
+    Results of the statistics reports use a longer TTL, as they are invalidated after each statistics run.
+    """
+
+    date_filter = ((args.get("params") or {}).get("dates") or {}).get("filter")
+
+    if (date_filter and date_filter not in [DATE_FILTERS.RANGE, DATE_FILTERS.DAY]) or is_relative(args.get("source")):
+        return int(app.config.get("ANALYTICS_REPORT_CACHE_RELATIVE_TTL", 60))
+    elif group == "stats":
+        return int(app.config.get("ANALYTICS_REPORT_CACHE_STATS_TTL", 3600))
+
+    return int(app.config.get("ANALYTICS_REPORT_CACHE_TTL", 300))
+
+
+def count_request(hit, started):
+    elapsed_ms = int((monotonic() - started) * 1000)
+    name = "hits" if hit else "misses"
+
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hincrby(_get_counters_key(), name, 1)
+        pipe.hincrby(_get_counters_key(), "{}_ms".format(name), elapsed_ms)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def get_cached(report, group, args, extra=None):
+    """Returns the key and the cached result of a report
+
+    :return tuple: (key, result), the result is None if it is not cached, the key is None if Redis is not available
+    """
+
+    try:
+        key = get_cache_key(report, group, args, extra)
+        cached = get_redis().get(key)
+    except redis.RedisError:
+        logger.warning("Report cache is not available")
+        return None, None
+
+    return key, loads(cached) if cached is not None else None
+
+
+def dumps(result):
+    """Serialises a report result, keeping the type of dates and ObjectIds (using the Mongo extended JSON)"""
+
+    return json_util.dumps(result)
+
+
+def loads(cached):
+    """Returns the report result serialised using ``dumps``, with its dates and ObjectIds"""
+
+    return json_util.loads(cached)
+
+
+def store_cached(key, group, args, result):
+    """Stores the result of a report, using the key returned from ``get_cached``"""
+
+    # Only plain reports are stored, not cursors of the search results
+    if key is None or not isinstance(result, (dict, list)):
+        return
+
+    try:
+        cached = dumps(result)
+    except TypeError:
+        logger.warning("Report {} can not be serialised, not storing it in the cache".format(key))
+        return
+
+    try:
+        get_redis().set(key, cached, ex=get_ttl(group, args))
+    except redis.RedisError:
+        logger.warning("Failed to store report {} in the cache".format(key))
+
+
+def cached_report(report, group, args, extra, generate):
+    """Returns the cached result of a report, generating and storing it on a miss
+
+    If the cache is disabled (config ANALYTICS_REPORT_CACHE) or Redis is not available,
+    the report is generated without being cached.
+
+    :param str report: The name of the report
+    :param str group: The cache group of the report
+    :param dict args: The arguments of the report request
+    :param dict extra: Additional values the result depends on
+    :param function generate: Function that generates the report
+    :return: The report
+    """
+
+    if not cache_enabled():
+        return generate()
+
+    started = monotonic()
+    key, cached = get_cached(report, group, args, extra)
+
+    if cached is not None:
+        count_request(True, started)
+        return cached
+
+    result = generate()
+
+    if key is not None:
+        count_request(False, started)
+        store_cached(key, group, args, result)
+
+    return result
+
+
+def invalidate(group=None):
+    """Invalidates the cached results of a group (or all groups), by incrementing its version
+
+    The results of previous versions are no longer used, and expire with their TTL.
+    """
+
+    try:
+        for name in [group] if group else CACHE_GROUPS:
+            get_redis().incr(_get_version_key(name))
+    except redis.RedisError:
+        logger.warning("Failed to invalidate the report cache")
+
+
+def get_counters():
+    """Returns the hit and miss counters of the cache, along with the average latency of each"""
+
+    counters = {key.decode("utf-8"): int(value) for key, value in get_redis().hgetall(_get_counters_key()).items()}
+
+    for name in ["hits", "misses"]:
+        count = counters.setdefault(name, 0)
+        elapsed_ms = counters.setdefault("{}_ms".format(name), 0)
+        counters["{}_avg_ms".format(name)] = int(elapsed_ms / count) if count else 0
+
+    total = counters["hits"] + counters["misses"]
+    counters["hit_ratio"] = round(counters["hits"] / total, 3) if total else 0
+
+    return counters
+
+
+def reset_counters():
+    get_redis().delete(_get_counters_key())
+
+
+class ReportCache(Command):
+    """Show the counters of the report cache, or invalidate the cached reports (config ANALYTICS_REPORT_CACHE)
+
+    Options
+    ::
+
+        -i, --invalidate:
+        Invalidate the cached reports
+        -g, --group (defaults to all groups):
+        The cache group to invalidate ('reports' or 'stats')
+        -r, --reset:
+        Reset the hit and miss counters
+
+    Example:
+    ::
+
+        $ python manage.py analytics:report_cache
+        $ python manage.py analytics:report_cache --invalidate --group stats
+
+    """
+
+    option_list = [
+        Option("--invalidate", "-i", dest="invalidate_cache", action="store_true", default=False),
+        Option("--group", "-g", dest="group", default=None, choices=CACHE_GROUPS),
+        Option("--reset", "-r", dest="reset", action="store_true", default=False),
+    ]
+
+    def run(self, invalidate_cache=False, group=None, reset=False):
+        if invalidate_cache:
+            invalidate(group)
+            logger.info("Invalidated cached reports")
+
+        if reset:
+            reset_counters()
+
+        for name, value in sorted(get_counters().items()):
+            logger.info("{}: {}".format(name, value))
+
+
+command("analytics:report_cache", ReportCache())
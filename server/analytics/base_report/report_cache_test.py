@@ -0,0 +1,88 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.base_report import BaseReportService
+from analytics.base_report.report_cache import (
+    cache_enabled,
+    get_ttl,
+    invalidate,
+    get_counters,
+    reset_counters,
+    dumps,
+    loads,
+)
+
+from bson import ObjectId
+from datetime import datetime
+from unittest import mock
+import pytz
+
+
+class ReportCacheTestCase(TestCase):
+    def test_cache_enabled(self):
+        # The report services import cache_enabled, so this also checks the package can be imported
+        self.assertEqual(BaseReportService.get.__module__, "analytics.base_report")
+
+        with self.app.app_context():
+            with mock.patch.dict(self.app.config, {"ANALYTICS_REPORT_CACHE": True}):
+                self.assertTrue(cache_enabled())
+
+            with mock.patch.dict(self.app.config, {"ANALYTICS_REPORT_CACHE": False}):
+                self.assertFalse(cache_enabled())
+
+    def test_get_ttl(self):
+        with self.app.app_context():
+            self.assertEqual(get_ttl("reports", {"params": {"dates": {"filter": "range"}}}), 300)
+            self.assertEqual(get_ttl("stats", {"params": {"dates": {"filter": "range"}}}), 3600)
+            self.assertEqual(get_ttl("stats", {"params": {"dates": {"filter": "yesterday"}}}), 60)
+
+            source = {"query": {"range": {"versioncreated": {"gte": "now/d", "lt": "now"}}}}
+            self.assertEqual(get_ttl("stats", {"source": source}), 60)
+
+    def test_cached_result_keeps_its_types(self):
+        result = {
+            "_id": ObjectId(),
+            "versioncreated": datetime(2019, 3, 1, 10, 30, tzinfo=pytz.utc),
+            "items": [{"user": ObjectId(), "count": 1, "avg": 1.5, "name": None}],
+        }
+
+        self.assertEqual(loads(dumps(result)), result)
+
+    def test_cached_report(self):
+        with self.app.app_context():
+            init_app(self.app)
+            self.app.config["ANALYTICS_REPORT_CACHE"] = True
+            service = get_resource_service("analytics_test_report")
+            invalidate()
+            reset_counters()
+
+            source = {"query": {"match_all": {}}}
+
+            with mock.patch.object(service, "get_report", return_value={"source": {"AAP": 1}}) as get_report:
+                self.assertEqual(list(service.get(req=None, source=source)), [{"source": {"AAP": 1}}])
+                self.assertEqual(list(service.get(req=None, source=source)), [{"source": {"AAP": 1}}])
+                self.assertEqual(get_report.call_count, 1)
+
+                # Other arguments are cached separately
+                service.get(req=None, source=source, return_type="highcharts_config")
+                self.assertEqual(get_report.call_count, 2)
+
+                # Invalidating the group generates the report again
+                invalidate("reports")
+                service.get(req=None, source=source)
+                self.assertEqual(get_report.call_count, 3)
+
+            counters = get_counters()
+            self.assertEqual(counters["hits"], 1)
+            self.assertEqual(counters["misses"], 3)
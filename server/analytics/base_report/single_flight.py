@@ -0,0 +1,229 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk.logging import logger
+
+from analytics.base_report.report_cache import get_fingerprint, dumps, loads
+from analytics.reference_cache import get_redis
+
+from flask import current_app as app
+from copy import copy, deepcopy
+from time import monotonic, sleep
+import threading
+import redis
+
+
+KEY_PREFIX = "analytics:single_flight"
+
+
+class SingleFlightError(Exception):
+    """Raised in a waiting call when the call in flight failed, if its error can't be copied"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.shared = False
+        self.error = None
+        self.waiters = 0
+
+
+def _materialise(result):
+    """Returns a copy of the result that can be shared, or raises TypeError if it can't be shared
+
+    Only plain reports (dicts and lists) are shared, not cursors or iterators of the search results
+    """
+
+    if not isinstance(result, (dict, list)):
+        raise TypeError("Result of type {} can not be shared".format(type(result).__name__))
+
+    return deepcopy(result)
+
+
+def _copy_error(key, error):
+    """Returns a new exception for a waiting call, so the exception of the call in flight is not raised in every thread
+
+    The exception is of the same type where possible, so the error handlers of the API (i.e. SuperdeskApiError)
+    still apply.
+    """
+
+    try:
+        copied = copy(error)
+    except Exception:
+        copied = None
+
+    if not isinstance(copied, BaseException) or copied is error:
+        copied = SingleFlightError("Report {} failed: {}".format(key, error))
+
+    return copied
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls in this process, so only the first call does the work
+
+    Calls with the same key that start while the first call is in flight wait for it to finish,
+    and then receive their own copy of its result (or a copy of its exception, chained to it).
+    The result is only copied if there are calls waiting for it, the first call receives the original.
+    If the result can't be shared (i.e. a cursor of the search results), the waiting calls run the function themselves.
+
+    Example:
+    ::
+
+        flight = SingleFlight()
+        report = flight.do("key", lambda: generate_report(args), timeout=60)
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, timeout=None):
+        """Runs the function, unless an identical call is already in flight
+
+        :param str key: The key of the call
+        :param function func: The function to run
+        :param int timeout: Seconds to wait for the call in flight, before running the function again
+        :return: The result of the function
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                logger.warning("Timed out waiting for report {}, generating it again".format(key))
+                return func()
+            elif call.error is not None:
+                raise _copy_error(key, call.error) from call.error
+            elif not call.shared:
+                return func()
+
+            # A single waiting call can have the copy made for it, otherwise each waiting call copies it again
+            return call.result if call.waiters == 1 else deepcopy(call.result)
+
+        try:
+            result = func()
+
+            # No more calls can join once the call is removed, so the number of waiting calls is final
+            with self.lock:
+                self.calls.pop(key, None)
+
+            if call.waiters:
+                # The result is copied once, so changes the leader makes to its result are not shared.
+                # If it can't be copied, the waiting calls generate their own result
+                try:
+                    call.result = _materialise(result)
+                    call.shared = True
+                except Exception:
+                    logger.debug("Report {} can not be shared with the waiting requests".format(key))
+
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    self.calls.pop(key)
+
+            call.done.set()
+
+
+single_flight = SingleFlight()
+
+
+def _redis_flight(key, func, timeout):
+    """Coalesces identical calls across processes, using a Redis lock
+
+    The process holding the lock generates the report and hands it to the waiting processes
+    using a short lived key. If the lock is released without a result, the waiting process generates the report itself.
+    """
+
+    client = get_redis()
+    result_key = "{}:result:{}".format(KEY_PREFIX, key)
+
+    try:
+        lock = client.lock("{}:lock:{}".format(KEY_PREFIX, key), timeout=timeout)
+        acquired = lock.acquire(blocking=False)
+    except redis.RedisError:
+        logger.warning("Report single flight lock is not available")
+        return func()
+
+    if acquired:
+        try:
+            result = func()
+
+            # Only plain reports can be handed to the other processes
+            if isinstance(result, (dict, list)):
+                try:
+                    handoff_ttl = int(app.config.get("ANALYTICS_REPORT_SINGLE_FLIGHT_HANDOFF", 5))
+                    client.set(result_key, dumps(result), ex=handoff_ttl)
+                except (redis.RedisError, TypeError):
+                    logger.warning("Failed to hand report {} to the waiting requests".format(key))
+
+            return result
+        finally:
+            try:
+                lock.release()
+            except redis.RedisError:
+                pass
+
+    started = monotonic()
+
+    try:
+        while monotonic() - started < timeout:
+            result = client.get(result_key)
+
+            if result is not None:
+                return loads(result)
+            elif not lock.locked():
+                # Check for the result once more, as it is stored before the lock is released
+                result = client.get(result_key)
+                return loads(result) if result is not None else func()
+
+            sleep(0.05)
+    except redis.RedisError:
+        logger.warning("Report single flight lock is not available")
+
+    return func()
+
+
+def coalesced_report(report, args, extra, generate):
+    """Generates the report, sharing the work with identical concurrent requests
+
+    Identical requests in this process are coalesced (config ANALYTICS_REPORT_SINGLE_FLIGHT),
+    and optionally across processes using a Redis lock (config ANALYTICS_REPORT_SINGLE_FLIGHT_REDIS).
+    This doesn't store the results, it only shares the result of a request that is already in flight.
+
+    :param str report: The name of the report
+    :param dict args: The arguments of the report request
+    :param dict extra: Additional values the result depends on
+    :param function generate: Function that generates the report
+    :return: The report
+    """
+
+    if not app.config.get("ANALYTICS_REPORT_SINGLE_FLIGHT", True):
+        return generate()
+
+    key = "{}:{}".format(report, get_fingerprint(args, extra))
+    timeout = int(app.config.get("ANALYTICS_REPORT_SINGLE_FLIGHT_TIMEOUT", 60))
+
+    if not app.config.get("ANALYTICS_REPORT_SINGLE_FLIGHT_REDIS", False):
+        return single_flight.do(key, generate, timeout)
+
+    return single_flight.do(key, lambda: _redis_flight(key, generate, timeout), timeout)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk.tests import TestCase
+
+from analytics.base_report.single_flight import SingleFlight
+
+from time import sleep
+from unittest import mock
+import threading
+
+
+class SingleFlightTestCase(TestCase):
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def generate():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"source": [{"key": "AAP", "doc_count": 1}]}
+
+        def request():
+            results.append(flight.do("report", generate, timeout=5))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=request) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+
+        # Give the followers time to join the call in flight
+        sleep(0.2)
+        release.set()
+
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"source": [{"key": "AAP", "doc_count": 1}]}] * 4)
+
+        # Each call receives its own copy of the result
+        self.assertEqual(len({id(result) for result in results}), 4)
+        self.assertEqual(len({id(result["source"]) for result in results}), 4)
+
+        # Once the call has finished, the next call does the work again
+        flight.do("report", generate)
+        self.assertEqual(len(calls), 2)
+
+    def test_result_is_not_copied_without_waiting_calls(self):
+        flight = SingleFlight()
+        report = {"source": [{"key": "AAP", "doc_count": 1}]}
+
+        with mock.patch("analytics.base_report.single_flight.deepcopy") as deepcopy:
+            self.assertIs(flight.do("report", lambda: report), report)
+
+        deepcopy.assert_not_called()
+
+    def test_waiting_calls_raise_their_own_error(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def generate():
+            started.set()
+            release.wait(5)
+            raise ValueError("Failed")
+
+        def request():
+            try:
+                flight.do("report", generate, timeout=5)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=request) for _ in range(2)]
+        for follower in followers:
+            follower.start()
+
+        sleep(0.2)
+        release.set()
+
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len({id(error) for error in errors}), 3)
+
+        # The errors of the waiting calls are chained to the error of the call in flight
+        leader_error = next(error for error in errors if error.__cause__ is None)
+        self.assertEqual(
+            [error.__cause__ for error in errors if error is not leader_error], [leader_error, leader_error]
+        )
+
+    def test_failed_calls_are_not_kept(self):
+        flight = SingleFlight()
+
+        def generate():
+            raise ValueError("Failed")
+
+        with self.assertRaises(ValueError):
+            flight.do("report", generate)
+
+        # The failed call is not kept
+        self.assertEqual(flight.calls, {})
+
+    def test_results_that_cant_be_shared_are_not_coalesced(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def generate():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return iter([{"key": "AAP", "doc_count": 1}])
+
+        def request():
+            results.append(list(flight.do("report", generate, timeout=5)))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(5)
+
+        follower = threading.Thread(target=request)
+        follower.start()
+        sleep(0.2)
+        release.set()
+
+        for thread in [leader, follower]:
+            thread.join(5)
+
+        # The iterator can only be consumed once, so the follower generates its own result
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results, [[{"key": "AAP", "doc_count": 1}]] * 2)
@@ -9,9 +9,8 @@
 # at https://www.sourcefabric.org/superdesk/license
 
 
-from superdesk import get_resource_service
-
 from analytics.common import get_cv_by_qcode, DATE_FILTERS
+from analytics.reference_cache import get_desk_names, get_user_names
 from analytics.chart_config import SDChart
 from analytics.stats.common import OPERATION_NAMES
 
@@ -272,23 +271,9 @@ class ChartConfig:
             return
 
         elif field == "task.desk":
-            self._set_translation(
-                "task.desk",
-                "Desk",
-                {
-                    str(desk.get("_id")): desk.get("name")
-                    for desk in list(get_resource_service("desks").get(req=None, lookup={}))
-                },
-            )
+            self._set_translation("task.desk", "Desk", get_desk_names())
         elif field == "task.user":
-            self._set_translation(
-                "task.user",
-                "User",
-                {
-                    str(user.get("_id")): user.get("display_name")
-                    for user in list(get_resource_service("users").get(req=None, lookup={}))
-                },
-            )
+            self._set_translation("task.user", "User", get_user_names())
         elif field == "anpa_category.qcode":
             self._set_translation("anpa_category.qcode", "Category", get_cv_by_qcode("categories", "name"))
         elif field == "genre.qcode":
@@ -313,14 +298,7 @@ class ChartConfig:
         elif field == "operation":
             self._set_translation("operation", "Operation", OPERATION_NAMES)
         elif field == "authors.parent":
-            self._set_translation(
-                "authors.parent",
-                "Author",
-                {
-                    str(user.get("_id")): user.get("display_name")
-                    for user in list(get_resource_service("users").get(req=None, lookup={}))
-                },
-            )
+            self._set_translation("authors.parent", "Author", get_user_names())
 
     def _set_translation(self, field, title, names=None):
         """Saves the provided field translations
@@ -11,8 +11,11 @@
 from typing import NamedTuple
 from os import path
 
-from superdesk import get_resource_service
+from superdesk import get_resource_service, get_resource_privileges
+from superdesk.errors import SuperdeskApiError
+from superdesk.users.services import current_user_has_privilege
 from superdesk.utc import utcnow, utc_to_local
+from analytics.reference_cache import get_cached_cv, get_elastic_version  # noqa
 from subprocess import check_call, PIPE
 from flask import current_app as app
 import pytz
@@ -145,6 +148,26 @@ def get_report_service(report_type):
         return None
 
 
+def get_authorised_report_service(report_type):
+    """Returns the service of the report, if the current user has the privilege to view the report
+
+    :param str report_type: The type of report
+    :return: The report service
+    """
+    service = get_report_service(report_type)
+
+    if service is None:
+        raise SuperdeskApiError.badRequestError('Unknown report type "{}"'.format(report_type))
+
+    # The user must have the privilege required by the endpoint of the report
+    privilege = (get_resource_privileges(registered_reports[report_type]) or {}).get("GET")
+
+    if privilege and not current_user_has_privilege(privilege):
+        raise SuperdeskApiError.forbiddenError('Unauthorized to view report "{}"'.format(report_type))
+
+    return service
+
+
 def get_highcharts_cli_path():
     highcharts_cli_path = path.join(
         ANALYTICS_PATH,
@@ -155,20 +178,15 @@ def get_highcharts_cli_path():
 
 
 def get_cv_by_qcode(name, field=None):
-    cvs = get_resource_service("vocabularies").find_one(req=None, _id=name)
-    return (
-        {}
-        if not cvs
-        else {
-            item.get("qcode"): item if field is None else item.get(field)
-            for item in cvs.get("items") or []
-            if item.get("is_active", True)
-        }
-    )
-
-
-def get_elastic_version():
-    return app.data.elastic.es.info()["version"]["number"]
+    def load():
+        cvs = get_resource_service("vocabularies").find_one(req=None, _id=name)
+        return (cvs or {}).get("items") or []
+
+    return {
+        item.get("qcode"): item if field is None else item.get(field)
+        for item in get_cached_cv(name, load)
+        if item.get("is_active", True)
+    }
 
 
 def get_weekstart_offset_hr():
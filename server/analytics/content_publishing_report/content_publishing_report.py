@@ -69,7 +69,7 @@ class ContentPublishingReportService(BaseReportService):
         :param docs: document used for generating the statistics
         :return dict: report
         """
-        agg_buckets = self.get_aggregation_buckets(getattr(docs, "hits"), ["parent"])
+        agg_buckets = self.get_aggregation_buckets(getattr(docs, "hits"), ["parent"], stream=True)
 
         report = {"groups": {}}
 
@@ -78,12 +78,16 @@ class ContentPublishingReportService(BaseReportService):
         if has_children:
             report["subgroups"] = {}
 
+        counts = {}
+
         for parent in agg_buckets.get("parent") or []:
             parent_key = parent.get("key")
 
             if not parent_key:
                 continue
 
+            counts[parent_key] = parent.get("doc_count") or 0
+
             if not has_children:
                 report["groups"][parent_key] = parent.get("doc_count") or 0
                 continue
@@ -103,6 +107,8 @@ class ContentPublishingReportService(BaseReportService):
                 report["groups"][parent_key][child_key] = doc_count
                 report["subgroups"][child_key] += doc_count
 
+        report["groups"] = self.sort_groups_by_count(agg_buckets.get("parent"), report["groups"], counts)
+
         return report
 
     def generate_highcharts_config(self, docs, args):
@@ -13,6 +13,8 @@ from superdesk.errors import SuperdeskApiError
 
 from analytics.base_report import BaseReportService
 from analytics.stats.common import ENTER_DESK_OPERATIONS, EXIT_DESK_OPERATIONS
+from analytics.stats.archive_statistics_rollups import use_stats_rollups, search_rollups
+from analytics.stats.archive_statistics_events import use_stats_events, search_events, EVENT_TYPE
 from analytics.chart_config import SDChart, ChartConfig
 from analytics.common import (
     get_utc_offset_in_minutes,
@@ -75,15 +77,20 @@ class DeskActivityReportService(BaseReportService):
         }
     }
 
+    def get_desk_id(self, args):
+        desk_id = (args.get("params") or {}).get("desk")
+
+        if not desk_id:
+            raise SuperdeskApiError.badRequestError("Desk must be provided")
+
+        return desk_id
+
     def get_request_aggregations(self, params, args):
         aggs = super().get_request_aggregations(params, args)
         params = args.get("params") or {}
         lt, gte, time_zone = self._es_get_date_filters(params)
 
-        desk_id = (args.get("params") or {}).get("desk")
-
-        if not desk_id:
-            raise SuperdeskApiError.badRequestError("Desk must be provided")
+        desk_id = self.get_desk_id(args)
 
         new_aggs = {
             "timeline": {
@@ -114,6 +121,41 @@ class DeskActivityReportService(BaseReportService):
 
         return new_aggs
 
+    def can_batch(self, args):
+        # The rollups and events are searched using their own queries
+        return not use_stats_rollups(args) and not use_stats_events(args)
+
+    def run_query(self, params, args):
+        if use_stats_rollups(args):
+            # Count the operations from the hourly rollups of the desk, instead of the timeline of each item
+            aggs = {
+                "operations": {
+                    "terms": {"field": "operation", "size": MAX_TERMS_SIZE},
+                    "aggs": {"count": {"sum": {"field": "count"}}},
+                }
+            }
+
+            return search_rollups(
+                self,
+                args.get("params") or {},
+                {"desk": self.get_desk_id(args)},
+                self.get_histogram_aggregation(aggs, params, args, field="hour"),
+            )
+        elif use_stats_events(args):
+            # Count the operations from the flattened timeline events, without a nested aggregation
+            aggs = {"operations": {"terms": {"field": "operation", "size": MAX_TERMS_SIZE}}}
+
+            return search_events(
+                self,
+                args.get("params") or {},
+                EVENT_TYPE.TIMELINE,
+                "operation_created",
+                {"task.desk": self.get_desk_id(args)},
+                self.get_histogram_aggregation(aggs, params, args, field="operation_created"),
+            )
+
+        return super().run_query(params, args)
+
     def _get_filters(self, repos, invisible_stages):
         return None
 
@@ -122,8 +164,14 @@ class DeskActivityReportService(BaseReportService):
 
     def generate_report(self, docs, args):
         aggregations = getattr(docs, "hits", {}).get("aggregations") or {}
-        desk_filter = (aggregations.get("timeline") or {}).get("desk_filter") or {}
-        agg_dates = (desk_filter.get("timeline_filter") or {}).get("dates") or {}
+
+        if "dates" in aggregations:
+            # Results from the rollups or events
+            agg_dates = aggregations["dates"]
+        else:
+            desk_filter = (aggregations.get("timeline") or {}).get("desk_filter") or {}
+            agg_dates = (desk_filter.get("timeline_filter") or {}).get("dates") or {}
+
         date_buckets = agg_dates.get("buckets") or []
 
         if len(date_buckets) < 1:
@@ -153,7 +201,11 @@ class DeskActivityReportService(BaseReportService):
 
             for operation in op_buckets:
                 key = operation.get("key")
-                doc_count = operation.get("doc_count")
+
+                if "count" in operation:
+                    doc_count = int((operation["count"] or {}).get("value") or 0)
+                else:
+                    doc_count = operation.get("doc_count")
 
                 if key in ENTER_DESK_OPERATIONS:
                     incoming += doc_count
@@ -43,6 +43,7 @@ class FeaturemdiaUpdatesReportResource(Resource):
 class FeaturemediaUpdatesTimeReportService(StatsReportService):
     aggregations = None
     date_filter_field = "versioncreated"
+    stream_hits = True
 
     defaultConfig = {
         REPORT_CONFIG.CHART_TYPES: {
@@ -86,9 +87,13 @@ class FeaturemediaUpdatesTimeReportService(StatsReportService):
             query["must"].append({"term": {"stats_type": "archive"}})
 
     def _es_set_size(self, query, params):
-        """Disable setting the size"""
+        """Limits the size of the query when the hits are paged (i.e. include_items, or the default return_type)"""
         query["size"] = 200
 
+    def _es_set_sort(self, query, params):
+        chart_params = params.get("chart") or {}
+        query["sort"] = [{"versioncreated": chart_params.get("sort_order") or "desc"}]
+
     def generate_elastic_query(self, args):
         query = super().generate_elastic_query(args)
 
@@ -102,17 +107,16 @@ class FeaturemediaUpdatesTimeReportService(StatsReportService):
         return query
 
     def generate_report(self, docs, args):
-        chart_params = (args.get("params") or {}).get("chart") or {}
-        report = {"items": []}
+        return {"items": list(self.iter_items(docs))}
+
+    def iter_items(self, docs):
+        """Yields the report of each item as the hits are streamed, so the items are not all kept in memory"""
 
         def get_featuremedia(update):
             return (update.get("associations") or {}).get("featuremedia") or {}
 
-        for doc in sorted(
-            docs,
-            key=lambda d: d.get("versioncreated"),
-            reverse=(chart_params.get("sort_order") or "desc") == "desc",
-        ):
+        # The hits are sorted by Elasticsearch, using the sort order of the chart
+        for doc in docs:
             stats = doc.get("stats") or {}
             featuremedia_updates = stats.get("featuremedia_updates") or []
 
@@ -155,16 +159,11 @@ class FeaturemediaUpdatesTimeReportService(StatsReportService):
                     }
                 )
 
-            report["items"].append(item_report)
-
-        return report
+            yield item_report
 
     def generate_highcharts_config(self, docs, args):
-        report = self.generate_report(docs, args)
-
         params = args.get("params") or {}
         chart_params = params.get("chart") or {}
-        items = report.get("items") or []
 
         title = chart_params.get("title") or "Changes to Featuremedia"
         subtitle = chart_params.get("subtitle") or ChartConfig.gen_subtitle_for_dates(params)
@@ -177,7 +176,8 @@ class FeaturemediaUpdatesTimeReportService(StatsReportService):
         def gen_date_str(date):
             return utc_to_local(app.config["DEFAULT_TIMEZONE"], date).strftime("%d/%m/%Y %H:%M")
 
-        for item in items:
+        # The rows are generated as the hits are streamed, in the sort order of the query
+        for item in self.iter_items(docs):
             original_image = item.get("original_image") or {}
             updates = []
 
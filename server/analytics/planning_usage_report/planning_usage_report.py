@@ -8,12 +8,12 @@
 # AUTHORS and LICENSE files distributed with this source code, or
 # at https://www.sourcefabric.org/superdesk/license
 
-from superdesk import get_resource_service
 from superdesk.resource import Resource
 
 from analytics.chart_config import ChartConfig
 from analytics.base_report import BaseReportService
 from analytics.common import MAX_TERMS_SIZE
+from analytics.reference_cache import get_users_with_planning
 
 
 class PlanningUsageReportResource(Resource):
@@ -47,45 +47,55 @@ class PlanningUsageReportService(BaseReportService):
     repos = ["events", "planning", "assignments"]
     date_filter_field = "_created"
     aggregations = {
-        "events": {
-            "filter": {"term": {"type": "event"}},
+        # Events, planning and assignments created by each user
+        # (all the users are returned, using a composite aggregation)
+        "users": {
+            "terms": {
+                "field": "original_creator",
+                "size": MAX_TERMS_SIZE,
+            },
+            "aggs": {"types": {"terms": {"field": "type"}}},
+        },
+        "coverages": {
+            "nested": {"path": "coverages"},
             "aggs": {
                 "users": {
                     "terms": {
-                        "field": "original_creator",
+                        "field": "coverages.original_creator",
                         "size": MAX_TERMS_SIZE,
                     }
                 }
             },
         },
+    }
+
+    # Without composite aggregations, the users are requested for each item type,
+    # so each type returns up to MAX_TERMS_SIZE users
+    type_aggregations = {
+        "events": {
+            "filter": {"term": {"type": "event"}},
+            "aggs": {"users": {"terms": {"field": "original_creator", "size": MAX_TERMS_SIZE}}},
+        },
         "planning": {
             "filter": {"term": {"type": "planning"}},
-            "aggs": {
-                "users": {
-                    "terms": {
-                        "field": "original_creator",
-                        "size": MAX_TERMS_SIZE,
-                    }
-                }
-            },
+            "aggs": {"users": {"terms": {"field": "original_creator", "size": MAX_TERMS_SIZE}}},
         },
         "assignments": {
             "filter": {"term": {"type": "assignment"}},
             "aggs": {"users": {"terms": {"field": "original_creator", "size": MAX_TERMS_SIZE}}},
         },
-        "coverages": {
-            "nested": {"path": "coverages"},
-            "aggs": {
-                "users": {
-                    "terms": {
-                        "field": "coverages.original_creator",
-                        "size": MAX_TERMS_SIZE,
-                    }
-                }
-            },
-        },
+        "coverages": aggregations["coverages"],
     }
 
+    # Maps the type of the item to the report's subgroup
+    item_types = {"event": "events", "planning": "planning", "assignment": "assignments"}
+
+    def get_aggregations(self, params, args):
+        if not self.composite_enabled():
+            return self.type_aggregations
+
+        return self.aggregations
+
     def _get_filters(self, repos, invisible_stages):
         return None
 
@@ -120,57 +130,47 @@ class PlanningUsageReportService(BaseReportService):
             "subgroup": {"events": 0, "planning": 0, "coverages": 0, "assignments": 0},
         }
 
-        def add_creators(item_type):
-            stats = (aggs.get(item_type) or {}).get("users") or {}
+        def add_creator(user_id, item_type, create_count):
+            user_id = str(user_id or "")
+            if not user_id or not create_count or create_count < 1:
+                return
+
+            if user_id not in report["group"]:
+                report["group"][user_id] = {
+                    "events": 0,
+                    "planning": 0,
+                    "coverages": 0,
+                    "assignments": 0,
+                }
 
-            for item in stats.get("buckets") or []:
-                user_id = str(item.get("key") or "")
-                if not user_id:
-                    continue
+            report["group"][user_id][item_type] += create_count
+            report["subgroup"][item_type] += create_count
 
-                create_count = item.get("doc_count")
-                if create_count < 1:
-                    continue
+        for item in ((aggs.get("coverages") or {}).get("users") or {}).get("buckets") or []:
+            add_creator(item.get("key"), "coverages", item.get("doc_count"))
 
-                if user_id not in report["group"]:
-                    report["group"][user_id] = {
-                        "events": 0,
-                        "planning": 0,
-                        "coverages": 0,
-                        "assignments": 0,
-                    }
+        # The users are streamed in the order of their ids, so the counts are added in the same order
+        # as before they were a single aggregation (by item type, then by the number of items created)
+        creators = {item_type: [] for item_type in self.item_types.values()}
+
+        for item in (aggs.get("users") or {}).get("buckets") or []:
+            for item_type in (item.get("types") or {}).get("buckets") or []:
+                if item_type.get("key") in self.item_types:
+                    creators[self.item_types[item_type["key"]]].append((item.get("key"), item_type.get("doc_count")))
 
-                report["group"][user_id][item_type] += create_count
-                report["subgroup"][item_type] += create_count
+        for item_type in creators:
+            for item in ((aggs.get(item_type) or {}).get("users") or {}).get("buckets") or []:
+                creators[item_type].append((item.get("key"), item.get("doc_count")))
 
-        add_creators("coverages")
-        add_creators("events")
-        add_creators("planning")
-        add_creators("assignments")
+        for item_type, counts in creators.items():
+            for user_id, create_count in sorted(counts, key=lambda count: (-(count[1] or 0), str(count[0] or ""))):
+                add_creator(user_id, item_type, create_count)
 
         return report
 
     def _get_users_with_planning(self):
         """Returns a list of users with the Planning privilege"""
-
-        planning_role_ids = [
-            str(role.get("_id"))
-            for role in get_resource_service("roles").get(req=None, lookup={"privileges.planning": 1})
-        ]
-
-        active_users = get_resource_service("users").get(req=None, lookup={"is_enabled": True})
-
-        users_with_planning = []
-        for user in active_users:
-            user_id = str(user.get("_id"))
-            privileges = user.get("privileges") or {}
-
-            if (privileges.get("planning") or 0) != 0:
-                users_with_planning.append(user_id)
-            elif str(user.get("role")) in planning_role_ids:
-                users_with_planning.append(user_id)
-
-        return users_with_planning
+        return get_users_with_planning()
 
     def generate_highcharts_config(self, docs, args):
         params = args.get("params") or {}
@@ -10,8 +10,11 @@
 
 from superdesk import get_resource_service, resources
 from superdesk.tests import TestCase
+from unittest import mock
 
+from analytics.common import MAX_TERMS_SIZE
 from analytics.planning_usage_report import init_app
+from analytics.planning_usage_report.planning_usage_report import PlanningUsageReportService
 
 
 class PlanningUsageReportTestCase(TestCase):
@@ -76,3 +79,35 @@ class PlanningUsageReportTestCase(TestCase):
         users = service._get_users_with_planning()
 
         self.assertEqual(users, ["user2", "user4"])
+
+    def test_users_are_requested_per_type_without_composite_aggregations(self):
+        service = PlanningUsageReportService()
+
+        with mock.patch.object(service, "composite_enabled", return_value=False):
+            aggregations = service.get_aggregations({}, {})
+
+        for item_type in ["events", "planning", "assignments"]:
+            self.assertEqual(aggregations[item_type]["aggs"]["users"]["terms"]["size"], MAX_TERMS_SIZE)
+
+        docs = mock.Mock(
+            hits={
+                "aggregations": {
+                    "events": {"users": {"buckets": [{"key": "user1", "doc_count": 2}]}},
+                    "planning": {"users": {"buckets": [{"key": "user2", "doc_count": 3}]}},
+                    "assignments": {"users": {"buckets": []}},
+                    "coverages": {"users": {"buckets": [{"key": "user1", "doc_count": 1}]}},
+                }
+            }
+        )
+
+        with mock.patch.object(service, "_get_users_with_planning", return_value=[]):
+            report = service.generate_report(docs, {})
+
+        self.assertEqual(
+            report["group"],
+            {
+                "user1": {"events": 2, "planning": 0, "coverages": 1, "assignments": 0},
+                "user2": {"events": 0, "planning": 3, "coverages": 0, "assignments": 0},
+            },
+        )
+        self.assertEqual(report["subgroup"], {"events": 2, "planning": 3, "coverages": 1, "assignments": 0})
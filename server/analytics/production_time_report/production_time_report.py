@@ -11,6 +11,8 @@
 from superdesk.resource import Resource
 
 from analytics.stats.stats_report_service import StatsReportService
+from analytics.stats.archive_statistics_rollups import use_stats_rollups, search_rollups
+from analytics.stats.archive_statistics_events import use_stats_events, search_events, EVENT_TYPE
 from analytics.chart_config import SDChart, ChartConfig
 from analytics.common import seconds_to_human_readable, MAX_TERMS_SIZE
 
@@ -74,11 +76,75 @@ class ProductionTimeReportService(StatsReportService):
             }
         }
 
+    def use_rollups(self, args):
+        """Returns True if the report can be answered from the hourly rollups
+
+        The nested path only includes the items whose versioncreated is in the date range. The rollups
+        don't know the versioncreated of the items, so they're only used when the range ends now
+        (or there is no date filter), as the versioncreated of every item with a desk transition
+        in the range is then also in the range.
+        """
+
+        if not use_stats_rollups(args):
+            return False
+
+        lt, gte, time_zone = self._es_get_date_filters(args.get("params") or {})
+        return lt in [None, "now"]
+
+    def can_batch(self, args):
+        # The rollups and events are searched using their own queries
+        return not self.use_rollups(args) and not use_stats_events(args)
+
+    def run_query(self, params, args):
+        if self.use_rollups(args):
+            # Combine the duration statistics of the hourly rollups, instead of the desk transitions of each item
+            aggs = {
+                "desks": {
+                    "terms": {"field": "desk", "size": MAX_TERMS_SIZE},
+                    "aggs": {
+                        "count": {"sum": {"field": "duration.count"}},
+                        "sum": {"sum": {"field": "duration.sum"}},
+                        "min": {"min": {"field": "duration.min"}},
+                        "max": {"max": {"field": "duration.max"}},
+                    },
+                }
+            }
+
+            return search_rollups(self, args.get("params") or {}, aggs=aggs)
+        elif use_stats_events(args):
+            # Calculate the duration statistics from the flattened desk transition events
+            aggs = {
+                "desks": {
+                    "terms": {"field": "task.desk", "size": MAX_TERMS_SIZE},
+                    "aggs": {"stats": {"stats": {"field": "duration"}}},
+                }
+            }
+
+            return search_events(self, args.get("params") or {}, EVENT_TYPE.DESK_TRANSITION, "entered", aggs=aggs)
+
+        return super().run_query(params, args)
+
+    def get_rollup_stats(self, bucket):
+        count = (bucket.get("count") or {}).get("value") or 0
+        total = (bucket.get("sum") or {}).get("value") or 0
+
+        return {
+            "count": int(count),
+            "min": (bucket.get("min") or {}).get("value"),
+            "max": (bucket.get("max") or {}).get("value"),
+            "avg": total / count if count else 0,
+            "sum": total,
+        }
+
     def generate_report(self, docs, args):
         aggregations = getattr(docs, "hits", {}).get("aggregations") or {}
 
-        date_filter = (aggregations.get("inner") or {}).get("date_filter") or {}
-        desk_buckets = (date_filter.get("desks") or {}).get("buckets") or []
+        if "desks" in aggregations:
+            # Results from the rollups or events
+            desk_buckets = aggregations["desks"].get("buckets") or []
+        else:
+            date_filter = (aggregations.get("inner") or {}).get("date_filter") or {}
+            desk_buckets = (date_filter.get("desks") or {}).get("buckets") or []
 
         if len(desk_buckets) < 1:
             return {}
@@ -91,7 +157,14 @@ class ProductionTimeReportService(StatsReportService):
             if not desk_id:
                 continue
 
-            stats = bucket.get("stats") or {}
+            if "stats" in bucket:
+                stats = bucket.get("stats") or {}
+            else:
+                stats = self.get_rollup_stats(bucket)
+
+                if not stats["count"]:
+                    # This desk only has rollups of timeline entries, not desk transitions
+                    continue
 
             report["desk_stats"][desk_id] = {
                 "count": stats.get("count") or 0,
@@ -8,10 +8,10 @@
 # AUTHORS and LICENSE files distributed with this source code, or
 # at https://www.sourcefabric.org/superdesk/license
 
-from superdesk import get_resource_service
 from analytics.base_report import BaseReportService, BaseReportResource
 from analytics.chart_config import ChartConfig
 from analytics.common import MAX_TERMS_SIZE
+from analytics.reference_cache import get_desk_names
 
 
 class PublishingPerformanceReportResource(BaseReportResource):
@@ -83,18 +83,22 @@ class PublishingPerformanceReportService(BaseReportService):
         :param docs: document used for generating the statistics
         :return dict: report
         """
-        agg_buckets = self.get_aggregation_buckets(getattr(docs, "hits"), ["parent"])
+        agg_buckets = self.get_aggregation_buckets(getattr(docs, "hits"), ["parent"], stream=True)
 
         states = ["killed", "corrected", "updated", "published", "recalled"]
 
         report = {"groups": {}, "subgroups": {state: 0 for state in states}}
 
+        counts = {}
+
         for parent in agg_buckets.get("parent") or []:
             parent_key = parent.get("key")
 
             if not parent_key:
                 continue
 
+            counts[parent_key] = parent.get("doc_count") or 0
+
             report["groups"][parent_key] = {state: 0 for state in states}
 
             no_rewrite_of = (parent.get("no_rewrite_of") or {}).get("state") or {}
@@ -125,6 +129,8 @@ class PublishingPerformanceReportService(BaseReportService):
                 report["groups"][parent_key][state_key] += doc_count
                 report["subgroups"][state_key] += doc_count
 
+        report["groups"] = self.sort_groups_by_count(agg_buckets.get("parent"), report["groups"], counts)
+
         if args and args.get("show_all_desks"):
             desk_with_no_articles = {
                 "killed": 0,
@@ -134,11 +140,10 @@ class PublishingPerformanceReportService(BaseReportService):
                 "recalled": 0,
             }
             report_groups = list(report["groups"])
-            desks = get_resource_service("desks").get(req=None, lookup={})
 
-            for desk in list(desks):
-                if str(desk["_id"]) not in report_groups:
-                    report["groups"][str(desk["_id"])] = desk_with_no_articles
+            for desk_id in get_desk_names().keys():
+                if desk_id not in report_groups:
+                    report["groups"][desk_id] = desk_with_no_articles
 
         return report
 
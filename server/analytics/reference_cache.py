@@ -0,0 +1,304 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+import superdesk
+from superdesk import get_resource_service
+from superdesk.logging import logger
+
+from flask import current_app as app, g
+from celery.signals import worker_process_init
+from contextlib import contextmanager
+from functools import partial, wraps
+from time import monotonic
+import redis
+
+
+KEY_PREFIX = "analytics:reference_cache"
+
+# Resources used by the reports, and the cache group that is invalidated when they change
+RESOURCE_GROUPS = {
+    "desks": "desks",
+    "stages": "stages",
+    "users": "users",
+    "roles": "roles",
+    "vocabularies": "vocabularies",
+}
+
+# Eve hooks that are called after a resource has been changed through the API
+CHANGE_HOOKS = ["on_inserted", "on_updated", "on_replaced", "on_deleted_item"]
+
+# Service hooks that are called after a resource has been changed using the service (i.e. post, patch or delete)
+SERVICE_HOOKS = ["on_created", "on_updated", "on_replaced", "on_deleted"]
+
+_clients = {}
+
+
+def get_redis():
+    """Returns the Redis client shared by the analytics caches
+
+    Uses the client of the app if there is one, otherwise a client is created from the REDIS_URL config
+    """
+
+    client = getattr(app, "redis", None)
+
+    if client is not None:
+        return client
+
+    url = app.config.get("ANALYTICS_REPORT_CACHE_URL") or app.config["REDIS_URL"]
+
+    if url not in _clients:
+        _clients[url] = redis.from_url(url)
+
+    return _clients[url]
+
+
+def _get_version_key(group):
+    return "{}:version:{}".format(KEY_PREFIX, group)
+
+
+class ReferenceCache:
+    """Process local cache of the reference data used when generating reports (config ANALYTICS_REFERENCE_CACHE)
+
+    Each value belongs to one or more groups (i.e. desks or users). When a resource is changed through the API
+    or its service, the version of its group is incremented in Redis. Each process compares the versions at most once
+    every ANALYTICS_REFERENCE_CACHE_CHECK_INTERVAL seconds, and drops the values of the groups that changed.
+    Values are also dropped after ANALYTICS_REFERENCE_CACHE_TTL seconds, for changes made directly in the database.
+
+    Example:
+    ::
+
+        cache = get_reference_cache()
+        names = cache.get("desk_names", ["desks"], load_desk_names)
+        cache.invalidate("desks")
+
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.versions = {}
+        self.checked = None
+
+    def get(self, key, groups, load):
+        """Returns the cached value, loading it if it is not cached
+
+        :param key: The key of the value
+        :param list groups: The groups that invalidate the value
+        :param function load: Function that loads the value
+        :return: The value
+        """
+
+        if not app.config.get("ANALYTICS_REFERENCE_CACHE", False):
+            shared = g.get("analytics_shared_lookups")
+
+            if shared is None:
+                return load()
+            elif key not in shared:
+                shared[key] = load()
+
+            return shared[key]
+
+        self.check_versions()
+        ttl = int(app.config.get("ANALYTICS_REFERENCE_CACHE_TTL", 300))
+        entry = self.values.get(key)
+
+        if entry is None or (ttl and monotonic() - entry["loaded"] > ttl):
+            entry = self.values[key] = {"groups": groups, "value": load(), "loaded": monotonic()}
+
+        return entry["value"]
+
+    def check_versions(self):
+        interval = int(app.config.get("ANALYTICS_REFERENCE_CACHE_CHECK_INTERVAL", 5))
+
+        if self.checked is not None and monotonic() - self.checked < interval:
+            return
+
+        self.checked = monotonic()
+        groups = sorted(set(RESOURCE_GROUPS.values()))
+
+        try:
+            versions = dict(zip(groups, get_redis().mget([_get_version_key(group) for group in groups])))
+        except redis.RedisError:
+            # Without the shared versions, fall back to only using the TTL
+            return
+
+        changed = [group for group in groups if versions[group] != self.versions.get(group)]
+        self.versions = versions
+
+        if changed:
+            self.drop(changed)
+
+    def drop(self, groups):
+        for key, entry in list(self.values.items()):
+            if any(group in groups for group in entry["groups"]):
+                self.values.pop(key, None)
+
+    def invalidate(self, group):
+        """Drops the values of the group in this process, and increments its version for the other processes"""
+
+        self.drop([group])
+
+        try:
+            self.versions[group] = get_redis().incr(_get_version_key(group))
+        except redis.RedisError:
+            logger.warning("Failed to invalidate the reference cache for {}".format(group))
+
+    def clear(self):
+        self.values = {}
+        self.versions = {}
+        self.checked = None
+
+
+@contextmanager
+def shared_lookups():
+    """Shares the reference data loaded within the block, even if the reference cache is disabled
+
+    Used when generating multiple reports in the one request, so each report doesn't load the same data again.
+    """
+
+    g.analytics_shared_lookups = {}
+
+    try:
+        yield
+    finally:
+        g.pop("analytics_shared_lookups", None)
+
+
+def get_reference_cache():
+    return app.extensions.setdefault("analytics_reference_cache", ReferenceCache())
+
+
+def get_desk_names():
+    """Returns the names of all desks, keyed by the desk id"""
+
+    def load():
+        return {
+            str(desk.get("_id")): desk.get("name") for desk in get_resource_service("desks").get(req=None, lookup={})
+        }
+
+    return dict(get_reference_cache().get("desk_names", ["desks"], load))
+
+
+def get_user_names():
+    """Returns the display names of all users, keyed by the user id"""
+
+    def load():
+        return {
+            str(user.get("_id")): user.get("display_name")
+            for user in get_resource_service("users").get(req=None, lookup={})
+        }
+
+    return dict(get_reference_cache().get("user_names", ["users"], load))
+
+
+def get_invisible_stage_ids():
+    """Returns the ids of the stages with global read turned off"""
+
+    def load():
+        stages = get_resource_service("stages").get_stages_by_visibility(is_visible=False)
+        return [str(stage["_id"]) for stage in stages]
+
+    return list(get_reference_cache().get("invisible_stages", ["stages", "desks"], load))
+
+
+def get_users_with_planning():
+    """Returns the ids of the active users with the Planning privilege, either directly or through their role"""
+
+    def load():
+        planning_role_ids = [
+            str(role.get("_id"))
+            for role in get_resource_service("roles").get(req=None, lookup={"privileges.planning": 1})
+        ]
+
+        users_with_planning = []
+        for user in get_resource_service("users").get(req=None, lookup={"is_enabled": True}):
+            privileges = user.get("privileges") or {}
+
+            if (privileges.get("planning") or 0) != 0 or str(user.get("role")) in planning_role_ids:
+                users_with_planning.append(str(user.get("_id")))
+
+        return users_with_planning
+
+    return list(get_reference_cache().get("users_with_planning", ["users", "roles"], load))
+
+
+def get_cached_cv(name, load):
+    """Returns the items of the vocabulary, loaded using the provided function"""
+
+    return get_reference_cache().get(("vocabulary", name), ["vocabularies"], load)
+
+
+def get_elastic_version():
+    """Returns the version of Elasticsearch, which doesn't change while the process is running"""
+
+    def load():
+        return app.data.elastic.es.info()["version"]["number"]
+
+    return get_reference_cache().get("elastic_version", [], load)
+
+
+def warm_reference_cache():
+    """Loads the reference data used by most reports"""
+
+    if not app.config.get("ANALYTICS_REFERENCE_CACHE", False):
+        return
+
+    try:
+        get_desk_names()
+        get_user_names()
+        get_invisible_stage_ids()
+        get_elastic_version()
+    except Exception:
+        logger.exception("Failed to warm the reference cache")
+
+
+def _on_changed(group, *args, **kwargs):
+    if app.config.get("ANALYTICS_REFERENCE_CACHE", False):
+        get_reference_cache().invalidate(group)
+
+
+def _wrap_service_hook(service, hook, group):
+    """Invalidates the group after the hook of the service, so changes made using the service are seen as well"""
+
+    original = getattr(service, hook, None)
+
+    if original is None or getattr(original, "analytics_reference_cache", False):
+        return
+
+    @wraps(original)
+    def hook_wrapper(*args, **kwargs):
+        result = original(*args, **kwargs)
+        _on_changed(group)
+        return result
+
+    hook_wrapper.analytics_reference_cache = True
+    setattr(service, hook, hook_wrapper)
+
+
+def init_app(app):
+    if app.extensions.get("analytics_reference_cache_hooks"):
+        return
+
+    app.extensions["analytics_reference_cache_hooks"] = True
+
+    for resource, group in RESOURCE_GROUPS.items():
+        for hook in CHANGE_HOOKS:
+            event = getattr(app, "{}_{}".format(hook, resource))
+            event += partial(_on_changed, group)
+
+        if resource in superdesk.resources:
+            for hook in SERVICE_HOOKS:
+                _wrap_service_hook(superdesk.resources[resource].service, hook, group)
+
+    def warm_worker(**kwargs):
+        with app.app_context():
+            warm_reference_cache()
+
+    # Only the first app warms the cache, as the signal is process wide
+    worker_process_init.connect(warm_worker, weak=False, dispatch_uid="analytics_reference_cache")
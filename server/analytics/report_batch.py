@@ -0,0 +1,204 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service, json
+from superdesk.services import BaseService
+from superdesk.resource import Resource
+from superdesk.errors import SuperdeskApiError
+from superdesk.utils import ListCursor
+from superdesk.logging import logger
+
+from analytics.common import get_authorised_report_service
+from analytics.base_report.report_cache import cache_enabled, get_cached, store_cached, count_request
+from analytics.reference_cache import shared_lookups
+
+from flask import current_app as app
+from eve_elastic.elastic import fix_query, ElasticCursor
+from time import monotonic
+
+
+class ReportBatchResource(Resource):
+    """Generates multiple reports in the one request
+
+    The ``reports`` argument is a JSON list, where each entry is either a report request
+    (``report``, ``params`` or ``source``, ``aggs``, ``repo``, ``translations``, ``return_type``)
+    or the id of a saved report (``saved_report``, ``return_type``).
+    The ``return_type`` defaults to ``highcharts_config``.
+    """
+
+    endpoint_name = resource_title = url = "analytics_report_batch"
+    item_methods = []
+    resource_methods = ["GET"]
+    schema = {
+        "report": {"type": "string"},
+        "saved_report": {"type": "string"},
+        "result": {"type": "dict", "allow_unknown": True},
+    }
+
+
+class ReportBatchService(BaseService):
+    def get(self, req, lookup):
+        entries = self._get_entries(req)
+
+        # Reference data (i.e. desk and user names) is only loaded once for the whole batch
+        with shared_lookups():
+            return ListCursor(self.gen_reports(entries))
+
+    def gen_reports(self, entries):
+        """Generates the reports, sending the aggregation queries to Elasticsearch in a single msearch
+
+        :param list entries: The report requests or saved report ids
+        :return list: The generated reports, in the same order as the entries
+        """
+
+        reports = []
+        batch = []
+
+        for entry in entries:
+            report_type, lookup = self._resolve_entry(entry)
+            service = get_authorised_report_service(report_type)
+            args = service._get_request_or_lookup(None, **lookup)
+
+            report = {
+                "report": report_type,
+                "saved_report": entry.get("saved_report"),
+                "result": None,
+                "cache_key": None,
+                "started": monotonic(),
+            }
+            reports.append(report)
+
+            if cache_enabled() and not int(args.get("include_items") or 0):
+                report["cache_key"], report["result"] = get_cached(
+                    service.datasource, service.cache_group, args, service.get_cache_extra(args)
+                )
+
+                if report["result"] is not None:
+                    count_request(True, report["started"])
+                    continue
+
+            params = service.get_query_params(args)
+
+            if not service.can_batch(args):
+                self._set_result(report, service, args, service.run_query(params, args))
+                continue
+
+            query, types = service.build_query(params, args)
+
+            if not service.is_aggregation_query(query, args):
+                self._set_result(report, service, args, service.execute_query(query, types, args))
+                continue
+
+            batch.append(
+                {
+                    "report": report,
+                    "service": service,
+                    "args": args,
+                    "types": types,
+                    "indices": service.get_search_indices(types, args),
+                    "composite_ids": service.apply_composite_aggregations(query),
+                    "query": service.get_aggregation_query(query),
+                }
+            )
+
+        for request, response in zip(batch, self.msearch(batch)):
+            service = request["service"]
+
+            # The first page of composite aggregations is sent in the batch, the following pages are requested here
+            hits = service.page_composite_aggregations(
+                request["query"], request["types"], request["args"], request["composite_ids"], response
+            )
+            self._set_result(request["report"], service, request["args"], service.get_aggregation_cursor(hits))
+
+        for report in reports:
+            report.pop("cache_key", None)
+            report.pop("started", None)
+
+        return reports
+
+    def msearch(self, batch):
+        """Sends the queries using a single msearch request per Elasticsearch client
+
+        :param list batch: The queries, along with the indices to search
+        :return list: The responses, in the same order as the queries
+        """
+
+        responses = [None] * len(batch)
+        clients = {}
+
+        for index, request in enumerate(batch):
+            es = app.data.elastic.elastic(request["types"][0])
+            clients.setdefault(id(es), (es, []))[1].append(index)
+
+        for es, indexes in clients.values():
+            body = []
+
+            for index in indexes:
+                body.append({"index": ",".join(batch[index]["indices"]), "ignore_unavailable": True})
+                body.append(fix_query(batch[index]["query"]))
+
+            for index, response in zip(indexes, es.msearch(body=body)["responses"]):
+                if response.get("error"):
+                    logger.error("Failed to generate report {}: {}".format(batch[index]["report"]["report"], response))
+                    raise SuperdeskApiError.internalError("Failed to generate the reports")
+
+                responses[index] = response
+
+        return responses
+
+    @staticmethod
+    def _set_result(report, service, args, docs):
+        result = service.generate_output(docs, args)
+
+        if isinstance(result, ElasticCursor):
+            result = list(result)
+
+        report["result"] = result
+
+        if report["cache_key"] is not None:
+            count_request(False, report["started"])
+            store_cached(report["cache_key"], service.cache_group, args, result)
+
+    @staticmethod
+    def _get_entries(req):
+        entries = (getattr(req, "args", None) or {}).get("reports")
+
+        if isinstance(entries, str):
+            entries = json.loads(entries)
+
+        if not entries or not isinstance(entries, list):
+            raise SuperdeskApiError.badRequestError("reports not provided")
+
+        return entries
+
+    @staticmethod
+    def _resolve_entry(entry):
+        """Returns the report type, and the lookup used to generate the report"""
+
+        return_type = entry.get("return_type") or "highcharts_config"
+
+        if not entry.get("saved_report"):
+            lookup = {key: entry.get(key) for key in ["source", "params", "aggs", "repo", "translations"]}
+            lookup["return_type"] = return_type
+            return entry.get("report"), lookup
+
+        # Uses the saved reports service, so only global reports or reports owned by the user are found
+        saved_reports = list(get_resource_service("saved_reports").get(req=None, lookup={"_id": entry["saved_report"]}))
+
+        if not saved_reports:
+            raise SuperdeskApiError.notFoundError('Saved report "{}" not found'.format(entry["saved_report"]))
+
+        saved_report = saved_reports[0]
+
+        return saved_report.get("report"), {
+            "params": saved_report.get("params") or {},
+            "translations": saved_report.get("translations") or {},
+            "return_type": return_type,
+        }
@@ -0,0 +1,160 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service, json
+from superdesk.services import BaseService
+from superdesk.resource import Resource
+from superdesk.notification import push_notification
+from superdesk.errors import SuperdeskApiError
+from superdesk.celery_app import celery
+from superdesk.logging import logger
+from superdesk.utc import utcnow
+
+from apps.auth import get_user_id
+
+from analytics.common import get_report_service, get_authorised_report_service
+
+from flask import current_app as app
+from eve.utils import config, ParsedRequest
+from datetime import timedelta
+from collections import namedtuple
+
+job_statuses = ["pending", "running", "completed", "failed"]
+JOB_STATUS = namedtuple("JOB_STATUS", ["PENDING", "RUNNING", "COMPLETED", "FAILED"])(*job_statuses)
+
+
+class ReportJobsResource(Resource):
+    """Reports generated asynchronously in a Celery task
+
+    Creating a job queues the report, and the client is notified using a ``report_jobs:update``
+    notification once it has completed (or failed). The status and result of the job are then fetched
+    from the job item. Jobs (along with their results) are removed once they expire.
+    """
+
+    endpoint_name = resource_title = url = "report_jobs"
+    item_methods = ["GET", "DELETE"]
+    resource_methods = ["GET", "POST"]
+
+    schema = {
+        "report_type": {"type": "string", "required": True},
+        "params": {"type": "dict", "required": True},
+        "translations": {"type": "dict"},
+        "return_type": {"type": "string", "default": "highcharts_config"},
+        "user": Resource.rel("users", nullable=True),
+        "status": {"type": "string", "allowed": job_statuses, "readonly": True},
+        # The generated report, stored as JSON as it can contain keys that are not valid in Mongo
+        "result": {"type": "string", "readonly": True},
+        "error": {"type": "string", "readonly": True},
+        "started": {"type": "datetime", "readonly": True},
+        "finished": {"type": "datetime", "readonly": True},
+        "expiry": {"type": "datetime", "readonly": True},
+    }
+
+    mongo_indexes = {
+        "user_1": ([("user", 1)], {"background": True}),
+        # Removes the job once it has expired
+        "expiry_1": ([("expiry", 1)], {"expireAfterSeconds": 0}),
+    }
+
+
+class ReportJobsService(BaseService):
+    def on_create(self, docs):
+        expiry = utcnow() + timedelta(seconds=int(app.config.get("ANALYTICS_REPORT_JOBS_EXPIRY", 3600)))
+
+        for doc in docs:
+            # Validates the report type, and that the user is allowed to view the report
+            get_authorised_report_service(doc["report_type"])
+
+            doc["user"] = get_user_id(required=True)
+            doc["status"] = JOB_STATUS.PENDING
+            doc["expiry"] = expiry
+
+        super().on_create(docs)
+
+    def on_created(self, docs):
+        for doc in docs:
+            run_report_job.apply_async(args=[str(doc[config.ID_FIELD])])
+
+    def get(self, req, lookup):
+        """
+        Overriding to only return the jobs of the current user
+        """
+        if not req:
+            req = ParsedRequest()
+
+        where = json.loads(req.where) if req.where else {}
+
+        if lookup:
+            where.update(lookup)
+
+        where["user"] = str(get_user_id(required=True))
+        req.where = json.dumps(where)
+
+        return super().get(req, lookup=None)
+
+    def on_fetched_item(self, doc):
+        if str(doc.get("user")) != str(get_user_id(required=True)):
+            raise SuperdeskApiError.notFoundError()
+
+        self._parse_result(doc)
+
+    def on_fetched(self, docs):
+        for doc in docs.get(config.ITEMS) or []:
+            self._parse_result(doc)
+
+    def on_delete(self, doc):
+        if str(doc.get("user")) != str(get_user_id(required=True)):
+            raise SuperdeskApiError.forbiddenError("Unauthorized to delete other user's report job.")
+
+    @staticmethod
+    def _parse_result(doc):
+        if isinstance(doc.get("result"), str):
+            doc["result"] = json.loads(doc["result"])
+
+    def run_job(self, job_id):
+        """Generates the report of the job, and stores the result
+
+        :param str job_id: The id of the job
+        """
+
+        job = self.find_one(req=None, _id=job_id)
+
+        if not job or job.get("status") != JOB_STATUS.PENDING:
+            return
+
+        self.system_update(job[config.ID_FIELD], {"status": JOB_STATUS.RUNNING, "started": utcnow()}, job)
+
+        try:
+            report = get_report_service(job["report_type"]).get(
+                req=None,
+                params=job.get("params") or {},
+                translations=job.get("translations") or {},
+                return_type=job.get("return_type") or "highcharts_config",
+            )
+            updates = {"status": JOB_STATUS.COMPLETED, "result": json.dumps(list(report))}
+        except Exception as e:
+            logger.exception("Failed to generate report for job {}".format(job_id))
+            updates = {"status": JOB_STATUS.FAILED, "error": str(e)}
+
+        updates["finished"] = utcnow()
+        self.system_update(job[config.ID_FIELD], updates, job)
+
+        push_notification(
+            "report_jobs:update",
+            job_id=str(job[config.ID_FIELD]),
+            report_type=job["report_type"],
+            status=updates["status"],
+            user_id=str(job["user"]) if job.get("user") else None,
+        )
+
+
+@celery.task(soft_time_limit=600)
+def run_report_job(job_id):
+    get_resource_service(ReportJobsResource.endpoint_name).run_job(job_id)
@@ -14,8 +14,16 @@ from superdesk.default_settings import env
 from superdesk.default_settings import crontab
 
 from .archive_statistics import ArchiveStatisticsResource, ArchiveStatisticsService
-from .gen_archive_statistics import GenArchiveStatistics
+from .gen_archive_statistics import GenArchiveStatistics, LOCK_RETRY_COUNTDOWN
 from .featuremedia_updates import *  # noqa
+from .backfill_archive_statistics import BackfillArchiveStatistics  # noqa
+from .stream_archive_statistics import StreamArchiveStatistics  # noqa
+from .compact_archive_statistics import CompactArchiveStatistics  # noqa
+from .archive_statistics_rollups import ArchiveStatisticsRollupsResource, ArchiveStatisticsRollupsService
+from .archive_statistics_rollups import RollupArchiveStatistics  # noqa
+from .archive_statistics_events import ArchiveStatisticsEventsResource, ArchiveStatisticsEventsService
+from .archive_statistics_events import IndexArchiveStatisticsEvents  # noqa
+from .archive_statistics_partitions import PartitionArchiveStatistics  # noqa
 
 
 def init_app(app):
@@ -44,6 +52,14 @@ def init_app(app):
     service = ArchiveStatisticsService(endpoint_name, backend=superdesk.get_backend())
     ArchiveStatisticsResource(endpoint_name, app=app, service=service)
 
+    endpoint_name = ArchiveStatisticsRollupsResource.endpoint_name
+    service = ArchiveStatisticsRollupsService(endpoint_name, backend=superdesk.get_backend())
+    ArchiveStatisticsRollupsResource(endpoint_name, app=app, service=service)
+
+    endpoint_name = ArchiveStatisticsEventsResource.endpoint_name
+    service = ArchiveStatisticsEventsService(endpoint_name, backend=superdesk.get_backend())
+    ArchiveStatisticsEventsResource(endpoint_name, app=app, service=service)
+
 
 def init_gen_stats_task(app):
     # Check the application config to see if archive stats is enabled
@@ -64,4 +80,9 @@ def init_gen_stats_task(app):
 
 @celery.task(soft_time_limit=600)
 def gen_archive_stats():
-    GenArchiveStatistics().run()
+    command = GenArchiveStatistics()
+    command.run()
+
+    if command.busy:
+        # The statistics were locked by another task, continue from the last processed history item later
+        gen_archive_stats.apply_async(countdown=LOCK_RETRY_COUNTDOWN)
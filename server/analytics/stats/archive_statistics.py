@@ -25,7 +25,22 @@ from apps.archive.common import ARCHIVE_SCHEMA_FIELDS
 
 from analytics.stats.common import STAT_TYPE
 
+from flask import current_app as app
 from eve.utils import config, ParsedRequest, date_to_str
+from bson import ObjectId
+
+
+# Attributes of archive_history items that are used to generate the statistics
+HISTORY_FIELDS = [
+    config.ID_FIELD,
+    "item_id",
+    "operation",
+    "update",
+    "user_id",
+    "version",
+    "original_item_id",
+    "_created",
+]
 
 
 class ArchiveStatisticsResource(Resource):
@@ -246,6 +261,14 @@ class ArchiveStatisticsResource(Resource):
         "num_featuremedia_updates": {"type": "integer", "default": 0},
         # Dictionary for statistics generated via plugins (i.e. from gen_stats_signals)
         "extra": {"type": "dict", "mapping": not_enabled},
+        # State of the timeline processing, used to continue from on the next run
+        "timeline_state": {"type": "dict", "mapping": not_enabled},
+        # Checkpoint of a backfill shard (for stats_type='backfill' documents)
+        "backfill": {"type": "dict", "mapping": not_enabled},
+        # Resume token of the archive_history change stream (for stats_type='stream' documents)
+        "resume_token": {"type": "dict", "mapping": not_enabled},
+        # Monthly partition of the statistics index the document is stored in (see ANALYTICS_STATS_PARTITIONS)
+        "partition": {"type": "string", "mapping": not_analyzed},
     }
 
 
@@ -254,15 +277,109 @@ class ArchiveStatisticsService(BaseService):
         return self.find_one(req=None, stats_type="last_run") or {}
 
     def set_last_run_id(self, entry_id, last_run=None):
+        """Stores the id of the last processed archive_history item
+
+        :param entry_id: The id of the last processed archive_history item
+        :param dict last_run: The existing last_run document (loaded if not provided)
+        :return dict: The updated last_run document
+        """
+
         if last_run is None:
             last_run = self.get_last_run()
 
         if last_run and last_run.get(config.ID_FIELD):
             self.patch(last_run[config.ID_FIELD], {"guid": entry_id})
-        else:
-            self.post([{"guid": entry_id, "stats_type": "last_run"}])
+            return dict(last_run, guid=entry_id)
+
+        doc = {"guid": entry_id, "stats_type": "last_run"}
+        self.post([doc])
+        return doc
+
+    def get_items_by_ids(self, item_ids):
+        """Returns the statistics documents for the provided item ids, keyed by their id
+
+        All documents are loaded using a single ``$in`` query, instead of a ``find_one`` per item
+
+        :param list item_ids: The ids of the items to load statistics for
+        :return dict: Statistics documents keyed by the item id
+        """
+
+        ids = list({str(item_id) for item_id in item_ids or [] if item_id})
+
+        if not ids:
+            return {}
+
+        return {doc[config.ID_FIELD]: doc for doc in self.find({config.ID_FIELD: {"$in": ids}})}
+
+    def get_backfill_shards(self):
+        """Returns the checkpoints of all shards from the current backfill, sorted by their id"""
+
+        return sorted(self.find({"stats_type": "backfill"}), key=lambda doc: doc[config.ID_FIELD])
+
+    def get_history_items(self, last_id, gte, item_id, chunk_size=0, lookup=None):
+        """Yields chunks of archive_history items to generate the statistics from
+
+        If the config option ANALYTICS_STATS_HISTORY_CURSOR is true (the default), the items are read
+        using a single streaming Mongo cursor, otherwise a new request is sent for each chunk.
+
+        :param str last_id: The id of the last processed archive_history item
+        :param datetime gte: Only include history items created on or after this date
+        :param str item_id: Only include history items for this content item
+        :param int chunk_size: The number of history items per chunk
+        :param dict lookup: Additional Mongo query to filter the history items by
+        """
+
+        if app.config.get("ANALYTICS_STATS_HISTORY_CURSOR", True):
+            return self.stream_history_items(last_id, gte, item_id, chunk_size, lookup)
+
+        return self.get_history_items_by_page(last_id, gte, item_id, chunk_size, lookup)
+
+    def stream_history_items(self, last_id, gte, item_id, chunk_size=0, lookup=None):
+        """Yields chunks of archive_history items from a single Mongo cursor
+
+        The query is only planned once, and the server returns the items in batches
+        of ``chunk_size``. Only the attributes from HISTORY_FIELDS are returned.
+        """
+
+        chunk_size = int(chunk_size or 0)
+        if chunk_size <= 0:
+            chunk_size = app.config.get("PAGINATION_DEFAULT", 25)
+
+        query = dict(lookup or {})
+
+        if gte:
+            query["_created"] = {"$gte": gte}
+
+        if item_id:
+            query["item_id"] = str(item_id)
+
+        if last_id:
+            last_id = str(last_id)
+            query[config.ID_FIELD] = {"$gt": ObjectId(last_id) if ObjectId.is_valid(last_id) else last_id}
+
+        collection = app.data.mongo.pymongo("archive_history").db["archive_history"]
+        cursor = collection.find(
+            query,
+            projection=HISTORY_FIELDS,
+            sort=[(config.ID_FIELD, 1), ("version", 1)],
+            batch_size=chunk_size,
+        )
+
+        try:
+            items = []
+            for history in cursor:
+                items.append(history)
+
+                if len(items) >= chunk_size:
+                    yield items
+                    items = []
+
+            if items:
+                yield items
+        finally:
+            cursor.close()
 
-    def get_history_items(self, last_id, gte, item_id, chunk_size=0):
+    def get_history_items_by_page(self, last_id, gte, item_id, chunk_size=0, lookup=None):
         history_service = get_resource_service("archive_history")
 
         last_processed_id = last_id
@@ -271,7 +388,7 @@ class ArchiveStatisticsService(BaseService):
             req = ParsedRequest()
             req.sort = '[("_id", 1), ("version", 1)]'
 
-            query = {"$and": []}
+            query = {"$and": [lookup] if lookup else []}
 
             if gte:
                 query["$and"].append({"_created": {"$gte": date_to_str(gte)}})
@@ -284,7 +401,7 @@ class ArchiveStatisticsService(BaseService):
 
             req.where = json.dumps(query)
 
-            if chunk_size > 0:
+            if chunk_size and chunk_size > 0:
                 req.max_results = int(chunk_size)
 
             items = list(history_service.get(req=req, lookup=None))
@@ -0,0 +1,380 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, get_resource_service, Option
+from superdesk.logging import logger
+from superdesk.services import BaseService
+from superdesk.resource import Resource, not_analyzed
+from superdesk.metadata.item import metadata_schema, ITEM_TYPE, ITEM_STATE
+
+from analytics.stats.common import STAT_TYPE
+from analytics.stats.gen_archive_statistics import connect_stats_signals
+from analytics.stats.bulk_writer import StatsBulkWriter
+
+from flask import current_app as app
+from eve.utils import config
+from bson import ObjectId
+
+
+class EVENT_TYPE:
+    TIMELINE = "timeline"
+    DESK_TRANSITION = "desk_transition"
+
+
+# Attributes of the item copied to each event, so the events can be filtered without a join
+ITEM_FIELDS = [
+    "source",
+    "ingest_provider",
+    "anpa_category",
+    "genre",
+    "urgency",
+    ITEM_TYPE,
+    ITEM_STATE,
+    "rewrite_of",
+    "versioncreated",
+]
+
+# Report filters supported by the events, and the event attribute they filter on
+EVENT_FILTERS = {
+    "desks": "task.desk",
+    "users": "task.user",
+    "stages": "task.stage",
+    "sources": "source",
+    "genre": "genre.qcode",
+    "urgency": "urgency",
+    "ingest_providers": "ingest_provider",
+    "content_types": ITEM_TYPE,
+    "states": ITEM_STATE,
+}
+
+
+class ArchiveStatisticsEventsResource(Resource):
+    """Flattened timeline entries and desk transitions, one document per event
+
+    The events are only stored in Elasticsearch, and are re-indexed from the statistics
+    whenever the statistics of an item are generated.
+    """
+
+    endpoint_name = resource_title = url = "archive_statistics_events"
+    item_methods = ["GET"]
+    resource_methods = ["GET"]
+    internal_resource = True
+    datasource = {
+        "source": "archive_statistics_events",
+        "search_backend": "elastic",
+    }
+
+    mongo_prefix = "STATISTICS_MONGO"
+    elastic_prefix = "STATISTICS_ELASTIC"
+
+    schema = {
+        config.ID_FIELD: {"type": "string"},
+        "item_id": {"type": "string", "mapping": not_analyzed},
+        # Marker of the indexing run that created this event, used to remove stale events
+        "generation": {"type": "string", "mapping": not_analyzed},
+        "event_type": {"type": "string", "mapping": not_analyzed},
+        # Timeline events
+        "operation": {"type": "string", "mapping": not_analyzed},
+        "operation_created": {"type": "datetime"},
+        "word_count": metadata_schema["word_count"],
+        "par_count": metadata_schema["word_count"],
+        # Desk transition events
+        "entered": {"type": "datetime"},
+        "entered_operation": {"type": "string", "mapping": not_analyzed},
+        "exited": {"type": "datetime"},
+        "exited_operation": {"type": "string", "mapping": not_analyzed},
+        "duration": {"type": "integer"},
+        "task": {
+            "type": "dict",
+            "schema": {
+                "user": {"type": "string", "mapping": not_analyzed},
+                "desk": {"type": "string", "mapping": not_analyzed},
+                "stage": {"type": "string", "mapping": not_analyzed},
+            },
+        },
+        # Metadata of the item
+        "source": metadata_schema["source"],
+        "ingest_provider": metadata_schema["ingest_provider"],
+        "anpa_category": metadata_schema["anpa_category"],
+        "genre": metadata_schema["genre"],
+        "urgency": metadata_schema["urgency"],
+        ITEM_TYPE: metadata_schema[ITEM_TYPE],
+        ITEM_STATE: metadata_schema[ITEM_STATE],
+        "rewrite_of": {"type": "string", "mapping": not_analyzed},
+        "versioncreated": metadata_schema["versioncreated"],
+    }
+
+
+def _get_task(task):
+    return {key: str(value) for key, value in (task or {}).items() if key in ["user", "desk", "stage"] and value}
+
+
+def gen_events(item_id, doc, generation):
+    """Generates the flattened events from the statistics of an item
+
+    :param str item_id: The id of the item
+    :param dict doc: The statistics document of the item
+    :param str generation: The marker of the current indexing run
+    :return list: The events of the item
+    """
+
+    metadata = {field: doc[field] for field in ITEM_FIELDS if doc.get(field) is not None}
+    stats = doc.get("stats") or {}
+    events = []
+
+    def add_event(event_type, attributes):
+        event = dict(metadata)
+        event.update(attributes)
+        event.update(
+            {
+                config.ID_FIELD: "{}_{}_{}".format(item_id, event_type, len(events)),
+                "item_id": str(item_id),
+                "generation": generation,
+                "event_type": event_type,
+            }
+        )
+        events.append(event)
+
+    for entry in stats.get(STAT_TYPE.TIMELINE) or []:
+        add_event(
+            EVENT_TYPE.TIMELINE,
+            {
+                "operation": entry.get("operation"),
+                "operation_created": entry.get("operation_created"),
+                "word_count": entry.get("word_count"),
+                "par_count": entry.get("par_count"),
+                "task": _get_task(entry.get("task")),
+            },
+        )
+
+    for transition in stats.get(STAT_TYPE.DESK_TRANSITIONS) or []:
+        add_event(
+            EVENT_TYPE.DESK_TRANSITION,
+            {
+                "entered": transition.get("entered"),
+                "entered_operation": transition.get("entered_operation"),
+                "exited": transition.get("exited"),
+                "exited_operation": transition.get("exited_operation"),
+                "duration": transition.get("duration"),
+                "task": _get_task(transition),
+            },
+        )
+
+    return events
+
+
+class ArchiveStatisticsEventsService(BaseService):
+    def index_items(self, docs, refresh=True):
+        """Re-indexes the events of the items, removing any events from previous runs
+
+        All events are indexed using a single bulk request, tagged with a new generation.
+        Events of these items from a previous generation are then removed using a single delete by query.
+
+        :param dict docs: The statistics documents, keyed by the item id
+        :param bool refresh: If True, refresh the index after writing
+        :return list: The ids of the items that failed to be indexed
+        """
+
+        if not docs:
+            return []
+
+        generation = str(ObjectId())
+        writer = StatsBulkWriter(resource=self.datasource, refresh=refresh)
+
+        events = []
+        for item_id, doc in docs.items():
+            events.extend(gen_events(item_id, doc, generation))
+
+        failed_events = set(writer.index(events))
+        failed_ids = {event["item_id"] for event in events if event[config.ID_FIELD] in failed_events}
+        item_ids = [str(item_id) for item_id in docs.keys() if str(item_id) not in failed_ids]
+
+        if item_ids:
+            writer.get_elastic().delete_by_query(
+                index=writer.get_elastic_index(),
+                body={
+                    "query": {
+                        "bool": {
+                            "filter": [{"terms": {"item_id": item_ids}}],
+                            "must_not": [{"term": {"generation": generation}}],
+                        }
+                    }
+                },
+                conflicts="proceed",
+                refresh=refresh and app.config.get("ELASTICSEARCH_FORCE_REFRESH", True),
+            )
+
+        return list(failed_ids)
+
+
+def use_stats_events(args):
+    """Returns True if the report can be answered from the events
+
+    The events are only used if enabled (config ANALYTICS_STATS_EVENTS), and if the report
+    is only filtered by attributes that are stored with the events.
+
+    :param dict args: The arguments of the report request
+    :return bool: True if the events should be used
+    """
+
+    params = args.get("params")
+
+    if not app.config.get("ANALYTICS_STATS_EVENTS", False) or not params or args.get("aggs"):
+        return False
+
+    for must in ["must", "must_not"]:
+        for field, filters in (params.get(must) or {}).items():
+            if field in EVENT_FILTERS or field in ["categories", "rewrites"]:
+                continue
+            elif isinstance(filters, dict) and any(filters.values()):
+                return False
+            elif not isinstance(filters, dict) and filters:
+                return False
+
+    return True
+
+
+def search_events(service, params, event_type, date_field, terms=None, aggs=None):
+    """Runs an aggregation query against the events, using plain term filters
+
+    :param BaseReportService service: The report service (used to calculate the filters)
+    :param dict params: The params of the report request
+    :param str event_type: The type of events to search
+    :param str date_field: The attribute of the events to filter the dates on
+    :param dict terms: Additional values to filter the events by
+    :param dict aggs: The aggregations to run
+    :return ElasticCursor: The search results
+    """
+
+    lt, gte, time_zone = service._es_get_date_filters(params)
+    query = {"must": [{"term": {"event_type": event_type}}], "must_not": []}
+
+    for field, value in (terms or {}).items():
+        query["must"].append({"term": {field: value}})
+
+    if lt is not None and gte is not None:
+        query["must"].append({"range": {date_field: {"gte": gte, "lt": lt, "time_zone": time_zone}}})
+
+    for must in ["must", "must_not"]:
+        for name, filters in (params.get(must) or {}).items():
+            values = service._es_get_filter_values(filters)
+
+            if not values:
+                continue
+            elif name == "categories":
+                field = params.get("category_field") or "qcode"
+                query[must].append({"terms": {"anpa_category.{}".format(field): sorted(values)}})
+            elif name == "rewrites":
+                query[must].append({"exists": {"field": "rewrite_of"}})
+            elif name in EVENT_FILTERS:
+                query[must].append({"terms": {EVENT_FILTERS[name]: values}})
+
+    rewrites = params.get("rewrites") or "include"
+    if rewrites != "include":
+        query["must" if rewrites == "only" else "must_not"].append(
+            {"bool": {"must": [{"term": {ITEM_STATE: "published"}}, {"exists": {"field": "rewrite_of"}}]}}
+        )
+
+    source = {
+        "query": {"filtered": {"filter": {"bool": {"must": query["must"], "must_not": query["must_not"]}}}},
+        "size": 0,
+    }
+
+    if aggs:
+        source["aggs"] = aggs
+
+    return get_resource_service(ArchiveStatisticsEventsResource.endpoint_name).search(source)
+
+
+class ArchiveStatisticsEvents:
+    """Re-indexes the events of the items processed in a chunk, once the statistics have been written"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def on_start(self, sender=None):
+        self.docs = {}
+
+    def processed(self, sender, orig, updates):
+        if app.config.get("ANALYTICS_STATS_EVENTS", False):
+            self.docs[orig[config.ID_FIELD]] = updates
+
+    def finish(self, sender):
+        if not self.docs:
+            return
+
+        try:
+            service = get_resource_service(ArchiveStatisticsEventsResource.endpoint_name)
+            failed_ids = service.index_items(self.docs, getattr(sender, "refresh", True))
+
+            if failed_ids:
+                logger.warning("Failed to index events for items {}".format(", ".join(failed_ids)))
+        except Exception:
+            logger.exception("Failed to index events")
+
+        self.docs = {}
+
+
+archive_statistics_events = ArchiveStatisticsEvents()
+
+connect_stats_signals(
+    on_start=archive_statistics_events.on_start,
+    on_processed=archive_statistics_events.processed,
+    on_finish=archive_statistics_events.finish,
+)
+
+
+class IndexArchiveStatisticsEvents(Command):
+    """Re-index the flattened events of all archive statistics
+
+    Use this when enabling the events (config ANALYTICS_STATS_EVENTS) for the first time.
+
+    Options
+    ::
+
+        -c, --chunk-size (defaults to 500):
+        Number of statistics documents to index per iteration
+
+    Example:
+    ::
+
+        $ python manage.py analytics:index_archive_statistics_events
+        $ python manage.py analytics:index_archive_statistics_events -c 100
+
+    """
+
+    option_list = [Option("--chunk-size", "-c", dest="chunk_size", default=500)]
+
+    def run(self, chunk_size=500):
+        service = get_resource_service(ArchiveStatisticsEventsResource.endpoint_name)
+        collection = StatsBulkWriter().get_mongo_collection()
+        lookup = {"stats_type": "archive"}
+        last_id = None
+        num_items = 0
+
+        while True:
+            query = dict(lookup, **{config.ID_FIELD: {"$gt": last_id}}) if last_id else lookup
+            docs = list(collection.find(query).sort(config.ID_FIELD, 1).limit(int(chunk_size)))
+
+            if not docs:
+                break
+
+            failed_ids = service.index_items({doc[config.ID_FIELD]: doc for doc in docs})
+
+            if failed_ids:
+                logger.warning("Failed to index events for items {}".format(", ".join(failed_ids)))
+
+            num_items += len(docs)
+            last_id = docs[-1][config.ID_FIELD]
+
+        logger.info("Indexed events of {} archive statistics documents".format(num_items))
+
+
+command("analytics:index_archive_statistics_events", IndexArchiveStatisticsEvents())
@@ -0,0 +1,94 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+from superdesk.utc import utcnow
+
+from analytics import init_app
+from analytics.stats.archive_statistics_events import gen_events, use_stats_events, EVENT_TYPE
+
+from datetime import timedelta
+
+
+def gen_doc(num_entries):
+    now = utcnow()
+
+    return {
+        "type": "text",
+        "source": "AAP",
+        "urgency": 3,
+        "stats": {
+            "timeline": [
+                {
+                    "operation": "create" if index == 0 else "update",
+                    "operation_created": now + timedelta(minutes=index),
+                    "task": {"desk": "desk1", "stage": "stage1", "user": "user1"},
+                }
+                for index in range(num_entries)
+            ],
+            "desk_transitions": [
+                {
+                    "desk": "desk1",
+                    "stage": "stage1",
+                    "user": "user1",
+                    "entered": now,
+                    "entered_operation": "create",
+                    "exited": now + timedelta(minutes=10),
+                    "exited_operation": "publish",
+                    "duration": 600,
+                }
+            ],
+        },
+    }
+
+
+class ArchiveStatisticsEventsTestCase(TestCase):
+    def test_gen_events(self):
+        events = gen_events("item1", gen_doc(3), "gen1")
+
+        self.assertEqual(len(events), 4)
+        self.assertEqual(
+            [event["event_type"] for event in events],
+            [EVENT_TYPE.TIMELINE] * 3 + [EVENT_TYPE.DESK_TRANSITION],
+        )
+
+        for event in events:
+            # Each event carries the filterable metadata of the item
+            self.assertEqual(event["item_id"], "item1")
+            self.assertEqual(event["generation"], "gen1")
+            self.assertEqual(event["source"], "AAP")
+            self.assertEqual(event["task"]["desk"], "desk1")
+
+        self.assertEqual(events[3]["duration"], 600)
+
+    def test_use_stats_events(self):
+        with self.app.app_context():
+            self.app.config["ANALYTICS_STATS_EVENTS"] = True
+
+            self.assertTrue(use_stats_events({"params": {"must": {"desks": ["desk1"], "sources": {"AAP": True}}}}))
+            self.assertFalse(use_stats_events({"params": {"must": {"desk_transitions": {"min": 1}}}}))
+            self.assertFalse(use_stats_events({"source": {"query": {}}}))
+
+            self.app.config["ANALYTICS_STATS_EVENTS"] = False
+            self.assertFalse(use_stats_events({"params": {}}))
+
+    def test_index_items_removes_stale_events(self):
+        with self.app.app_context():
+            init_app(self.app)
+            service = get_resource_service("archive_statistics_events")
+
+            service.index_items({"item1": gen_doc(3), "item2": gen_doc(2)})
+            self.assertEqual(service.search({"query": {"term": {"item_id": "item1"}}}).count(), 4)
+
+            # Re-indexing with a shorter timeline removes the events from the previous generation
+            service.index_items({"item1": gen_doc(1)})
+            self.assertEqual(service.search({"query": {"term": {"item_id": "item1"}}}).count(), 2)
+            self.assertEqual(service.search({"query": {"term": {"item_id": "item2"}}}).count(), 3)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, Option
+from superdesk.logging import logger
+from superdesk.utc import utcnow
+
+from analytics.common import relative_to_absolute_datetime
+
+from flask import current_app as app
+from eve.utils import config
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import re
+
+
+# Format of the month appended to the name of the partitions
+PARTITION_FORMAT = "%Y.%m"
+PARTITION_REGEX = re.compile(r"-(?P<partition>\d{4}\.\d{2})(-shrunk)?$")
+
+# Statistics types that are stored in the monthly partitions
+PARTITIONED_STATS_TYPES = ["archive"]
+
+# Dates that don't change once set, so documents don't move between partitions as the items are updated
+PARTITION_FIELDS = ["firstcreated", config.DATE_CREATED]
+
+# Dates the reports filter on, which are kept within the skew of the partition date (see get_partition)
+SKEWED_FIELDS = ["versioncreated", "firstpublished"]
+
+
+def partitions_enabled(resource="archive_statistics"):
+    return resource == "archive_statistics" and app.config.get("ANALYTICS_STATS_PARTITIONS", False)
+
+
+def get_partition_field():
+    field = app.config.get("ANALYTICS_STATS_PARTITION_FIELD")
+    return field if field in PARTITION_FIELDS else "firstcreated"
+
+
+def get_partition_skew():
+    return timedelta(days=int(app.config.get("ANALYTICS_STATS_PARTITION_SKEW", 30)))
+
+
+def get_partition(doc):
+    """Returns the month partition of a statistics document
+
+    The date is taken from the ANALYTICS_STATS_PARTITION_FIELD config (firstcreated or _created).
+    Documents without this date are not partitioned (they stay in the original index, which is always searched).
+
+    The reports filter on versioncreated or firstpublished, so a document is only kept in its partition while these
+    dates are within ANALYTICS_STATS_PARTITION_SKEW days of the partition date. Otherwise it moves to the original
+    index, and doesn't move again as these dates only get further away. This way a report only searches the
+    partitions within the skew of its date range.
+
+    :param dict doc: The statistics document
+    :return str: The partition (i.e. '2019.03'), or None if the document is not partitioned
+    """
+
+    if doc.get("stats_type") not in PARTITIONED_STATS_TYPES:
+        return None
+
+    date = doc.get(get_partition_field())
+
+    if not date:
+        return None
+
+    skew = get_partition_skew()
+
+    for field in SKEWED_FIELDS:
+        value = doc.get(field)
+
+        if value and abs(value - date) > skew:
+            return None
+
+    return date.strftime(PARTITION_FORMAT)
+
+
+def get_months(gte, lt):
+    """Returns the partitions of the months between the two dates (inclusive)
+
+    :param datetime gte: The start date
+    :param datetime lt: The end date
+    :return list: The partitions of the months
+    """
+
+    month = gte.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = []
+
+    while month <= lt:
+        months.append(month.strftime(PARTITION_FORMAT))
+        month += relativedelta(months=1)
+
+    return months
+
+
+def parse_report_date(value):
+    """Converts a date from the report date filters to a datetime (ignoring the timezone)"""
+
+    if value.startswith("now"):
+        value = relative_to_absolute_datetime(value, "%Y-%m-%dT%H:%M:%S")
+
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def get_search_partitions(field, gte, lt):
+    """Returns the partitions that can contain documents in the date range, or None for all partitions
+
+    If the report filters on the partition field, only the months of the range are searched.
+    For a filter on versioncreated or firstpublished, the range is widened by ANALYTICS_STATS_PARTITION_SKEW,
+    as the documents outside of this skew are stored in the original index (see get_partition).
+
+    :param str field: The field the report filters the dates on
+    :param str gte: The start of the date filter
+    :param str lt: The end of the date filter
+    :return list: The partitions to search
+    """
+
+    if not gte or not lt:
+        return None
+
+    # Widen the range by a day, as the partitions use UTC and the filters use the local timezone
+    start = parse_report_date(gte) - timedelta(days=1)
+    end = parse_report_date(lt) + timedelta(days=1)
+    partition_field = get_partition_field()
+
+    if field == partition_field:
+        return get_months(start, end)
+    elif field in SKEWED_FIELDS:
+        skew = get_partition_skew()
+        return get_months(start - skew, end + skew)
+
+    return None
+
+
+class StatsPartitions:
+    """Manages the monthly partitions of the statistics index
+
+    Each partition is a separate index named after the alias of the statistics resource, with the month appended
+    (i.e. ``statistics_archive_statistics-2019.03``). All partitions are added to the alias, so documents
+    are read from every partition by default. The original index stays the write index of the alias,
+    and holds the documents that are not partitioned (i.e. last_run, backfill and archive_family).
+
+    Example:
+    ::
+
+        partitions = StatsPartitions()
+        index = partitions.ensure_partition("2019.03")
+        indices = partitions.get_search_indices(["2019.02", "2019.03"])
+
+    """
+
+    def __init__(self, resource="archive_statistics"):
+        self.resource = resource
+        self.created = set()
+
+    def get_elastic(self):
+        return app.data.elastic.elastic(self.resource)
+
+    def get_alias(self):
+        return app.data.elastic._resource_index(self.resource)
+
+    def get_partition_index(self, partition):
+        return "{}-{}".format(self.get_alias(), partition)
+
+    def get_indices(self):
+        """Returns the indices of the alias, keyed by their partition (None for the original index)"""
+
+        indices = {}
+
+        for index in self.get_elastic().indices.get_alias(name=self.get_alias()).keys():
+            match = PARTITION_REGEX.search(index)
+            indices.setdefault(match.group("partition") if match else None, []).append(index)
+
+        return indices
+
+    def ensure_partition(self, partition):
+        """Creates the index of the partition if it doesn't exist, and adds it to the alias
+
+        :param str partition: The partition (month) of the index
+        :return str: The name of the index (or alias) of the partition
+        """
+
+        index = self.get_partition_index(partition)
+
+        if index in self.created:
+            return index
+
+        es = self.get_elastic()
+
+        if not es.indices.exists(index=index):
+            alias = self.get_alias()
+            base_indices = self.get_indices().get(None) or []
+
+            # Keep the original index as the write index of the alias, once there are multiple indices
+            es.indices.update_aliases(
+                body={
+                    "actions": [
+                        {"add": {"index": base_index, "alias": alias, "is_write_index": True}}
+                        for base_index in base_indices
+                    ]
+                }
+            )
+
+            mapping = app.data.elastic.get_mapping(self.resource)
+            body = dict(app.config.get("STATISTICS_ELASTIC_SETTINGS") or {})
+            body["mappings"] = mapping.get("mappings") or {}
+            body["aliases"] = {alias: {"is_write_index": False}}
+
+            es.indices.create(index=index, body=body, ignore=400)
+            logger.info("Created statistics partition {}".format(index))
+
+        self.created.add(index)
+        return index
+
+    def get_search_indices(self, partitions):
+        """Returns the indices to search, for the provided partitions
+
+        The original index is always included, as it holds documents written before partitioning was enabled.
+
+        :param list partitions: The partitions to search
+        :return list: The names of the indices
+        """
+
+        indices = self.get_indices()
+        search_indices = list(indices.get(None) or [])
+
+        for partition in partitions:
+            search_indices.extend(indices.get(partition) or [])
+
+        return search_indices
+
+
+class PartitionArchiveStatistics(Command):
+    """Manage the monthly partitions of the statistics index (config ANALYTICS_STATS_PARTITIONS)
+
+    Rolling creates the partitions of the current and next month ahead of time.
+    Partitions older than ``--older-than`` months are force merged to a single segment,
+    and optionally shrunk to fewer shards. Shrinking requires a copy of every shard of the partition
+    to be allocated on the same node. The shrunk index replaces the partition, using an alias with its name.
+
+    Options
+    ::
+
+        -r, --roll:
+        Create the partitions for the current and next month
+        -f, --force-merge:
+        Force merge old partitions to a single segment
+        -s, --shrink (defaults to 0 - don't shrink):
+        Shrink old partitions to this number of shards
+        -o, --older-than (defaults to 2):
+        Number of months after which a partition is considered old
+
+    Example:
+    ::
+
+        $ python manage.py analytics:partition_archive_statistics --roll
+        $ python manage.py analytics:partition_archive_statistics --force-merge --shrink 1 --older-than 3
+
+    """
+
+    option_list = [
+        Option("--roll", "-r", dest="roll", action="store_true", default=False),
+        Option("--force-merge", "-f", dest="force_merge", action="store_true", default=False),
+        Option("--shrink", "-s", dest="shrink", default=0),
+        Option("--older-than", "-o", dest="older_than", default=2),
+    ]
+
+    def run(self, roll=False, force_merge=False, shrink=0, older_than=2):
+        partitions = StatsPartitions()
+        now = utcnow()
+
+        if roll:
+            for month in [now, now + relativedelta(months=1)]:
+                partitions.ensure_partition(month.strftime(PARTITION_FORMAT))
+
+        if not force_merge and not int(shrink):
+            return
+
+        last_old_partition = (now - relativedelta(months=int(older_than))).strftime(PARTITION_FORMAT)
+
+        for partition, indices in sorted(partitions.get_indices().items(), key=lambda item: item[0] or ""):
+            if partition is None or partition > last_old_partition:
+                continue
+
+            for index in indices:
+                if int(shrink):
+                    index = self.shrink(partitions, partition, index, int(shrink))
+
+                if force_merge:
+                    logger.info("Force merging statistics partition {}".format(index))
+                    partitions.get_elastic().indices.forcemerge(index=index, max_num_segments=1)
+
+    def shrink(self, partitions, partition, index, num_shards):
+        es = partitions.get_elastic()
+        settings = next(iter(es.indices.get_settings(index=index).values()))["settings"]["index"]
+
+        if int(settings.get("number_of_shards") or 1) <= num_shards:
+            return index
+
+        target = "{}-shrunk".format(partitions.get_partition_index(partition))
+        logger.info("Shrinking statistics partition {} to {} shards".format(index, num_shards))
+
+        try:
+            es.indices.put_settings(index=index, body={"index.blocks.write": True})
+            es.indices.shrink(
+                index=index,
+                target=target,
+                body={
+                    "settings": {"index.number_of_shards": num_shards, "index.blocks.write": None},
+                    "aliases": {partitions.get_alias(): {"is_write_index": False}},
+                },
+                wait_for_active_shards="all",
+            )
+        except Exception:
+            logger.exception("Failed to shrink statistics partition {}".format(index))
+            es.indices.put_settings(index=index, body={"index.blocks.write": None})
+            return index
+
+        # Replace the partition with the shrunk index, using an alias with the name of the partition
+        es.indices.delete(index=index)
+        es.indices.put_alias(index=target, name=partitions.get_partition_index(partition))
+
+        return target
+
+
+command("analytics:partition_archive_statistics", PartitionArchiveStatistics())
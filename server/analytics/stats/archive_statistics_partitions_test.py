@@ -0,0 +1,84 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk.tests import TestCase
+
+from analytics.stats.archive_statistics_partitions import get_partition, get_months, get_search_partitions
+
+from datetime import datetime
+from unittest import mock
+
+
+class ArchiveStatisticsPartitionsTestCase(TestCase):
+    def test_get_partition(self):
+        with self.app.app_context():
+            doc = {
+                "stats_type": "archive",
+                "firstcreated": datetime(2019, 1, 31, 23),
+                "versioncreated": datetime(2019, 3, 2),
+                "_created": datetime(2019, 4, 1),
+            }
+
+            # Partitioned by firstcreated by default, so updating the item doesn't move the document
+            self.assertEqual(get_partition(doc), "2019.01")
+            self.assertEqual(get_partition(dict(doc, versioncreated=datetime(2019, 2, 28))), "2019.01")
+
+            # Unless the dates the reports filter on are outside of the skew, then it moves to the original index
+            self.assertIsNone(get_partition(dict(doc, versioncreated=datetime(2019, 5, 1))))
+            self.assertIsNone(get_partition(dict(doc, firstpublished=datetime(2019, 3, 5))))
+
+            with mock.patch.dict(self.app.config, {"ANALYTICS_STATS_PARTITION_SKEW": 90}):
+                self.assertEqual(get_partition(dict(doc, versioncreated=datetime(2019, 4, 1))), "2019.01")
+
+            # Documents without the date stay in the original index
+            self.assertIsNone(get_partition(dict(doc, firstcreated=None)))
+
+            with mock.patch.dict(self.app.config, {"ANALYTICS_STATS_PARTITION_FIELD": "_created"}):
+                self.assertEqual(get_partition(dict(doc, versioncreated=datetime(2019, 3, 20))), "2019.04")
+
+            # Dates that change as the item is updated are not supported
+            with mock.patch.dict(self.app.config, {"ANALYTICS_STATS_PARTITION_FIELD": "versioncreated"}):
+                self.assertEqual(get_partition(doc), "2019.01")
+
+            # Only archive statistics are partitioned
+            self.assertIsNone(get_partition(dict(doc, stats_type="archive_family")))
+            self.assertIsNone(get_partition({"stats_type": "last_run"}))
+
+    def test_get_search_partitions(self):
+        self.assertEqual(
+            get_months(datetime(2018, 11, 30), datetime(2019, 2, 1)),
+            ["2018.11", "2018.12", "2019.01", "2019.02"],
+        )
+
+        with self.app.app_context():
+            self.assertEqual(
+                get_search_partitions("firstcreated", "2019-03-10T00:00:00+0000", "2019-03-10T23:59:59+0000"),
+                ["2019.03"],
+            )
+            self.assertEqual(
+                get_search_partitions("firstcreated", "2019-03-01T00:00:00+0000", "2019-03-31T23:59:59+0000"),
+                ["2019.02", "2019.03", "2019.04"],
+            )
+
+            # The range of the dates the reports filter on is widened by the skew
+            self.assertEqual(
+                get_search_partitions("versioncreated", "2019-03-10T00:00:00+0000", "2019-03-10T23:59:59+0000"),
+                ["2019.02", "2019.03", "2019.04"],
+            )
+            self.assertEqual(
+                get_search_partitions("firstpublished", "2019-01-10T00:00:00+0000", "2019-01-11T00:00:00+0000"),
+                ["2018.12", "2019.01", "2019.02"],
+            )
+            self.assertIsNone(get_search_partitions("versioncreated", None, None))
+
+            # Dates that are not mapped onto the partitions search all partitions
+            self.assertIsNone(
+                get_search_partitions("operation_created", "2019-03-10T00:00:00+0000", "2019-03-10T23:59:59+0000")
+            )
@@ -0,0 +1,519 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, get_resource_service, Option
+from superdesk.logging import logger
+from superdesk.services import BaseService
+from superdesk.resource import Resource, not_analyzed
+from superdesk.utc import utcnow
+
+from analytics.stats.common import STAT_TYPE
+from analytics.stats.gen_archive_statistics import connect_stats_signals
+from analytics.stats.bulk_writer import StatsBulkWriter
+from analytics.common import MAX_TERMS_SIZE
+from analytics.base_report import BaseReportService
+
+from flask import current_app as app
+from eve.utils import config
+from collections import Counter
+from datetime import datetime, timedelta
+import pytz
+
+
+# Maximum number of hours re-calculated using a single search request
+HOURS_PER_REQUEST = 24
+
+# Attributes the rollups are keyed by (along with the hour)
+ROLLUP_KEYS = ["desk", "stage", "user", "operation"]
+
+
+class ArchiveStatisticsRollupsResource(Resource):
+    """Hourly rollups of the archive statistics, keyed by desk, stage, user and operation
+
+    ``count`` is the number of timeline entries with this key, and ``duration`` the statistics of the
+    desk transitions that were entered with this key (where ``operation`` is the entered operation).
+    """
+
+    endpoint_name = resource_title = url = "archive_statistics_rollups"
+    item_methods = ["GET"]
+    resource_methods = ["GET"]
+    internal_resource = True
+    datasource = {
+        "source": "archive_statistics_rollups",
+        "search_backend": "elastic",
+    }
+
+    mongo_prefix = "STATISTICS_MONGO"
+    elastic_prefix = "STATISTICS_ELASTIC"
+
+    schema = {
+        config.ID_FIELD: {"type": "string"},
+        "hour": {"type": "datetime"},
+        "desk": {"type": "string", "nullable": True, "mapping": not_analyzed},
+        "stage": {"type": "string", "nullable": True, "mapping": not_analyzed},
+        "user": {"type": "string", "nullable": True, "mapping": not_analyzed},
+        "operation": {"type": "string", "mapping": not_analyzed},
+        "count": {"type": "integer", "default": 0},
+        "duration": {
+            "type": "dict",
+            "schema": {
+                "count": {"type": "integer"},
+                "sum": {"type": "number"},
+                "min": {"type": "number"},
+                "max": {"type": "number"},
+            },
+        },
+    }
+
+
+class ArchiveStatisticsRollupsService(BaseService):
+    def replace_hours(self, hours, docs):
+        """Replaces the stored rollups of the hours with the provided rollups
+
+        The new rollups are written first (replacing the rollups with the same id), and then the rollups
+        of these hours that no longer exist are removed. This way the reports don't see an hour without rollups.
+
+        :param list hours: The hours to replace the rollups for
+        :param list docs: The new rollups for these hours
+        """
+
+        writer = StatsBulkWriter(resource=ArchiveStatisticsRollupsResource.endpoint_name, delta=False)
+        for doc in docs:
+            writer.replace(doc, {})
+
+        failed_ids = writer.flush()
+        if failed_ids:
+            logger.warning("Failed to store rollups {}".format(", ".join(failed_ids)))
+
+        rollup_ids = [doc[config.ID_FIELD] for doc in docs]
+        self.delete_action({"hour": {"$in": list(hours)}, config.ID_FIELD: {"$nin": rollup_ids}})
+
+
+def get_hour(date):
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+def _get_id(value):
+    return str(value) if value else None
+
+
+def get_rollup_keys(stats):
+    """Returns the rollup keys of the timeline entries and desk transitions of the stats
+
+    :param dict stats: The stats of an archive_statistics document
+    :return Counter: The number of occurrences of each key
+    """
+
+    keys = Counter()
+
+    for entry in stats.get(STAT_TYPE.TIMELINE) or []:
+        if not entry.get("operation_created"):
+            continue
+
+        task = entry.get("task") or {}
+        keys[
+            (
+                STAT_TYPE.TIMELINE,
+                get_hour(entry["operation_created"]),
+                _get_id(task.get("desk")),
+                _get_id(task.get("stage")),
+                _get_id(task.get("user")),
+                entry.get("operation"),
+            )
+        ] += 1
+
+    for transition in stats.get(STAT_TYPE.DESK_TRANSITIONS) or []:
+        if not transition.get("entered"):
+            continue
+
+        keys[
+            (
+                STAT_TYPE.DESK_TRANSITIONS,
+                get_hour(transition["entered"]),
+                _get_id(transition.get("desk")),
+                _get_id(transition.get("stage")),
+                _get_id(transition.get("user")),
+                transition.get("entered_operation"),
+                transition.get("duration"),
+            )
+        ] += 1
+
+    return keys
+
+
+def get_touched_hours(original, updates):
+    """Returns the hours where the timeline or desk transitions of an item have changed
+
+    :param dict original: The stored statistics document
+    :param dict updates: The newly generated statistics document
+    :return set: The hours that need their rollups re-calculated
+    """
+
+    original_keys = get_rollup_keys(original.get("stats") or {})
+    updated_keys = get_rollup_keys(updates.get("stats") or {})
+
+    return {key[1] for key in (original_keys - updated_keys) + (updated_keys - original_keys)}
+
+
+def group_hours(hours):
+    """Groups consecutive hours into (gte, lt) ranges"""
+
+    ranges = []
+
+    for hour in sorted(hours):
+        if ranges and ranges[-1][1] == hour:
+            ranges[-1][1] = hour + timedelta(hours=1)
+        else:
+            ranges.append([hour, hour + timedelta(hours=1)])
+
+    return ranges
+
+
+def _gen_terms_aggs(path, fields, leaf_aggs=None):
+    aggs = leaf_aggs
+
+    for name, field in reversed(list(zip(ROLLUP_KEYS, fields))):
+        terms = {"terms": {"field": "{}.{}".format(path, field), "size": MAX_TERMS_SIZE, "missing": ""}}
+        if aggs:
+            terms["aggs"] = aggs
+
+        aggs = {name: terms}
+
+    return aggs
+
+
+def _gen_hours_query(path, date_field, ranges):
+    date_field = "{}.{}".format(path, date_field)
+
+    return {"bool": {"should": [{"range": {date_field: {"gte": gte, "lt": lt}}} for gte, lt in ranges]}}
+
+
+def _gen_nested_aggs(path, date_field, ranges, fields, leaf_aggs=None):
+    return {
+        "nested": {"path": path},
+        "aggs": {
+            "hours_filter": {
+                "filter": _gen_hours_query(path, date_field, ranges),
+                "aggs": {
+                    "hours": {
+                        "date_histogram": {
+                            "field": "{}.{}".format(path, date_field),
+                            "interval": "hour",
+                            "min_doc_count": 1,
+                        },
+                        "aggs": _gen_terms_aggs(path, fields, leaf_aggs),
+                    }
+                },
+            }
+        },
+    }
+
+
+def _gen_composite_aggs(path, date_field, fields, leaf_aggs=None, after=None):
+    sources = [{"hour": {"date_histogram": {"field": "{}.{}".format(path, date_field), "interval": "1h"}}}]
+
+    for name, field in zip(ROLLUP_KEYS, fields):
+        sources.append({name: {"terms": {"field": "{}.{}".format(path, field), "missing_bucket": True}}})
+
+    composite = {
+        "composite": {
+            "size": int(app.config.get("ANALYTICS_COMPOSITE_AGGREGATION_SIZE", MAX_TERMS_SIZE)),
+            "sources": sources,
+        }
+    }
+
+    if after:
+        composite["composite"]["after"] = after
+
+    if leaf_aggs:
+        composite["aggs"] = leaf_aggs
+
+    # A composite aggregation can only be nested in a nested aggregation, so the hours
+    # are filtered by the query instead, and the buckets of other hours are skipped
+    return {"nested": {"path": path}, "aggs": {"keys": composite}}
+
+
+def _iter_composite_buckets(search, path, date_field, fields, leaf_aggs=None):
+    """Yields the buckets of the keys and hours, requesting the next page using the after_key"""
+
+    after = None
+
+    while True:
+        aggregations = search(path, date_field, _gen_composite_aggs(path, date_field, fields, leaf_aggs, after))
+        response = (aggregations.get("nested") or {}).get("keys") or {}
+        buckets = response.get("buckets") or []
+
+        for bucket in buckets:
+            key = bucket.get("key") or {}
+            yield key.get("hour"), tuple(key.get(name) or None for name in ROLLUP_KEYS), bucket
+
+        after = response.get("after_key")
+
+        if not after or not buckets:
+            return
+
+
+def _iter_terms_buckets(search, path, date_field, ranges, fields, leaf_aggs=None):
+    """Yields the buckets of the keys and hours, from nested terms aggregations"""
+
+    aggregations = search(path, date_field, _gen_nested_aggs(path, date_field, ranges, fields, leaf_aggs))
+    hours_filter = (aggregations.get("nested") or {}).get("hours_filter") or {}
+
+    for hour_bucket in (hours_filter.get("hours") or {}).get("buckets") or []:
+        for keys, bucket in _iter_buckets(hour_bucket, ROLLUP_KEYS):
+            yield hour_bucket["key"], keys, bucket
+
+
+def _iter_buckets(aggregations, names, keys=()):
+    if not names:
+        yield keys, aggregations
+        return
+
+    for bucket in (aggregations.get(names[0]) or {}).get("buckets") or []:
+        yield from _iter_buckets(bucket, names[1:], keys + (bucket.get("key") or None,))
+
+
+def gen_rollups(hours):
+    """Calculates the rollups of the hours from the archive statistics
+
+    Only the items with timeline entries or desk transitions in the hours are aggregated. The keys of each
+    hour are paged through using composite aggregations where available (see BaseReportService.composite_enabled),
+    otherwise nested terms aggregations are used.
+
+    :param list hours: The hours to calculate the rollups for
+    :return list: The rollup documents
+    """
+
+    ranges = group_hours(hours)
+    hours = {hour if hour.tzinfo else hour.replace(tzinfo=pytz.utc) for hour in hours}
+    service = get_resource_service("archive_statistics")
+    use_composite = BaseReportService.composite_enabled()
+    rollups = {}
+
+    def get_rollup(epoch, keys):
+        hour = datetime.fromtimestamp(epoch / 1000, pytz.utc)
+
+        if hour not in hours:
+            return None
+
+        rollup_id = "{}_{}".format(hour.strftime("%Y%m%d%H"), "_".join(key or "" for key in keys))
+
+        if rollup_id not in rollups:
+            rollups[rollup_id] = dict(zip(ROLLUP_KEYS, keys), _id=rollup_id, hour=hour, count=0)
+
+        return rollups[rollup_id]
+
+    stat_types = [
+        (STAT_TYPE.TIMELINE, "operation_created", ["task.desk", "task.stage", "task.user", "operation"], None),
+        (
+            STAT_TYPE.DESK_TRANSITIONS,
+            "entered",
+            ["desk", "stage", "user", "entered_operation"],
+            {"duration": {"stats": {"field": "stats.desk_transitions.duration"}}},
+        ),
+    ]
+
+    def search(path, date_field, aggs):
+        # Only the items with entries in the hours are aggregated
+        query = {
+            "query": {
+                "filtered": {
+                    "filter": {
+                        "bool": {
+                            "must": [
+                                {"term": {"stats_type": "archive"}},
+                                {"nested": {"path": path, "query": _gen_hours_query(path, date_field, ranges)}},
+                            ]
+                        }
+                    }
+                }
+            },
+            "size": 0,
+            "aggs": {"nested": aggs},
+        }
+
+        docs = service.search(query)
+        return getattr(docs, "hits", {}).get("aggregations") or {}
+
+    for stat_type, date_field, fields, leaf_aggs in stat_types:
+        path = "stats.{}".format(stat_type)
+
+        if use_composite:
+            buckets = _iter_composite_buckets(search, path, date_field, fields, leaf_aggs)
+        else:
+            buckets = _iter_terms_buckets(search, path, date_field, ranges, fields, leaf_aggs)
+
+        for epoch, keys, bucket in buckets:
+            rollup = get_rollup(epoch, keys)
+
+            if rollup is None:
+                continue
+            elif stat_type == STAT_TYPE.TIMELINE:
+                rollup["count"] = bucket.get("doc_count") or 0
+            else:
+                duration = bucket.get("duration") or {}
+                rollup["duration"] = {field: duration.get(field) for field in ["count", "sum", "min", "max"]}
+
+    return list(rollups.values())
+
+
+def update_rollups(hours):
+    """Re-calculates and stores the rollups of the hours
+
+    :param set hours: The hours to re-calculate the rollups for
+    """
+
+    service = get_resource_service(ArchiveStatisticsRollupsResource.endpoint_name)
+    hours = sorted(hours)
+
+    for start in range(0, len(hours), HOURS_PER_REQUEST):
+        end = start + HOURS_PER_REQUEST
+        batch = hours[start:end]
+        service.replace_hours(batch, gen_rollups(batch))
+
+
+def use_stats_rollups(args):
+    """Returns True if the report can be answered from the rollups
+
+    The rollups are only used if enabled (config ANALYTICS_STATS_ROLLUPS), and if the report
+    is only filtered by date, as the rollups don't contain the attributes of the items.
+
+    :param dict args: The arguments of the report request
+    :return bool: True if the rollups should be used
+    """
+
+    params = args.get("params")
+
+    if not app.config.get("ANALYTICS_STATS_ROLLUPS", False) or not params or args.get("aggs"):
+        return False
+    elif (params.get("rewrites") or "include") != "include":
+        return False
+
+    for must in ["must", "must_not"]:
+        for filters in (params.get(must) or {}).values():
+            if isinstance(filters, dict) and any(filters.values()):
+                return False
+            elif not isinstance(filters, dict) and filters:
+                return False
+
+    return True
+
+
+def search_rollups(service, params, terms=None, aggs=None):
+    """Runs an aggregation query against the rollups, filtered by the dates of the report
+
+    :param BaseReportService service: The report service (used to calculate the date filters)
+    :param dict params: The params of the report request
+    :param dict terms: Additional values to filter the rollups by
+    :param dict aggs: The aggregations to run
+    :return ElasticCursor: The search results
+    """
+
+    lt, gte, time_zone = service._es_get_date_filters(params)
+    must = [{"term": {field: value}} for field, value in (terms or {}).items()]
+
+    if lt is not None and gte is not None:
+        must.append({"range": {"hour": {"gte": gte, "lt": lt, "time_zone": time_zone}}})
+
+    query = {"query": {"filtered": {"filter": {"bool": {"must": must}}}}, "size": 0}
+    if aggs:
+        query["aggs"] = aggs
+
+    return get_resource_service(ArchiveStatisticsRollupsResource.endpoint_name).search(query)
+
+
+class ArchiveStatisticsRollups:
+    """Keeps the rollups up to date, as the statistics are generated
+
+    The hours where the timeline or desk transitions of an item changed are collected during a chunk,
+    and their rollups are re-calculated from the statistics once the chunk has been written.
+    """
+
+    def __init__(self):
+        self.hours = set()
+
+    def on_start(self, sender=None):
+        self.hours = set()
+
+    def processed(self, sender, orig, updates):
+        if app.config.get("ANALYTICS_STATS_ROLLUPS", False):
+            self.hours.update(get_touched_hours(orig.get("item") or {}, updates))
+
+    def finish(self, sender):
+        if not self.hours:
+            return
+        elif not getattr(sender, "refresh", True):
+            # The statistics index is not refreshed (i.e. during a backfill)
+            # so the rollups are re-calculated using analytics:rollup_archive_statistics afterwards
+            logger.info("Skipping rollups of {} hours, as the statistics are not refreshed".format(len(self.hours)))
+            return
+
+        try:
+            update_rollups(self.hours)
+        except Exception:
+            logger.exception("Failed to update rollups")
+
+
+archive_statistics_rollups = ArchiveStatisticsRollups()
+
+connect_stats_signals(
+    on_start=archive_statistics_rollups.on_start,
+    on_processed=archive_statistics_rollups.processed,
+    on_finish=archive_statistics_rollups.finish,
+)
+
+
+class RollupArchiveStatistics(Command):
+    """Re-calculate the hourly rollups from the archive statistics
+
+    Use this after a backfill, or when enabling the rollups (config ANALYTICS_STATS_ROLLUPS) for the first time.
+
+    Options
+    ::
+
+        -s, --start-date (defaults to 365 days ago):
+        The date to start re-calculating the rollups from (YYYY-MM-DD)
+        -e, --end-date (defaults to now):
+        The date to stop re-calculating the rollups at (YYYY-MM-DD)
+
+    Example:
+    ::
+
+        $ python manage.py analytics:rollup_archive_statistics
+        $ python manage.py analytics:rollup_archive_statistics -s 2018-01-01 -e 2019-01-01
+
+    """
+
+    option_list = [
+        Option("--start-date", "-s", dest="start_date", default=None),
+        Option("--end-date", "-e", dest="end_date", default=None),
+    ]
+
+    def run(self, start_date=None, end_date=None):
+        end = self.parse_date(end_date) if end_date else utcnow()
+        start = self.parse_date(start_date) if start_date else end - timedelta(days=365)
+        hour = get_hour(start)
+        num_hours = 0
+
+        while hour < end:
+            hours = [hour + timedelta(hours=index) for index in range(HOURS_PER_REQUEST)]
+            hour = hours[-1] + timedelta(hours=1)
+
+            hours = [next_hour for next_hour in hours if next_hour < end]
+            update_rollups(hours)
+            num_hours += len(hours)
+
+        logger.info("Re-calculated rollups for {} hours".format(num_hours))
+
+    def parse_date(self, date):
+        return datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=pytz.utc)
+
+
+command("analytics:rollup_archive_statistics", RollupArchiveStatistics())
@@ -0,0 +1,148 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service, get_backend
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.stats.archive_statistics_rollups import get_touched_hours, group_hours, update_rollups, gen_rollups
+from analytics.stats.gen_archive_statistics import GenArchiveStatistics
+from analytics.stats.gen_archive_statistics_test import gen_history
+from analytics.production_time_report.production_time_report import ProductionTimeReportService
+
+from bson import ObjectId
+from eve_elastic.elastic import ElasticCursor
+from unittest import mock
+from datetime import datetime, timedelta
+import pytz
+
+
+def gen_entry(operation, created, desk="desk1"):
+    return {
+        "operation": operation,
+        "operation_created": created,
+        "task": {"desk": desk, "stage": "stage1", "user": "user1"},
+    }
+
+
+class ArchiveStatisticsRollupsTestCase(TestCase):
+    def test_get_touched_hours(self):
+        hour = datetime(2019, 3, 1, 10, tzinfo=pytz.utc)
+        original = {"stats": {"timeline": [gen_entry("create", hour + timedelta(minutes=5))]}}
+        updates = {
+            "stats": {
+                "timeline": [
+                    gen_entry("create", hour + timedelta(minutes=5)),
+                    gen_entry("update", hour + timedelta(hours=2, minutes=30)),
+                ],
+                "desk_transitions": [
+                    {
+                        "desk": "desk1",
+                        "entered": hour + timedelta(minutes=5),
+                        "entered_operation": "create",
+                        "duration": 600,
+                    }
+                ],
+            }
+        }
+
+        self.assertEqual(get_touched_hours(original, updates), {hour, hour + timedelta(hours=2)})
+
+        # Re-generating the same timeline doesn't touch any hours
+        self.assertEqual(get_touched_hours(updates, updates), set())
+
+        self.assertEqual(
+            group_hours([hour + timedelta(hours=2), hour, hour + timedelta(hours=1)]),
+            [[hour, hour + timedelta(hours=3)]],
+        )
+
+    def test_update_rollups(self):
+        with self.app.app_context():
+            init_app(self.app)
+            self.app.config["ANALYTICS_STATS_ROLLUPS"] = True
+
+            history_items = [gen_history("item1", ObjectId(), "create", 0)] + [
+                gen_history("item1", ObjectId(), minutes=index) for index in range(1, 4)
+            ]
+            self.app.data.insert("archive_history", history_items)
+
+            GenArchiveStatistics().generate_stats(None, None, 100)
+
+            service = get_resource_service("archive_statistics_rollups")
+            rollups = list(service.get_from_mongo(req=None, lookup={}))
+            self.assertEqual(sum(rollup["count"] for rollup in rollups), 4)
+            self.assertEqual({rollup["desk"] for rollup in rollups}, {"desk1"})
+            self.assertEqual({rollup["operation"] for rollup in rollups}, {"create", "update"})
+
+            # Re-calculating an hour replaces its rollups
+            hours = {rollup["hour"] for rollup in rollups}
+            update_rollups(hours)
+            self.assertEqual(len(list(service.get_from_mongo(req=None, lookup={}))), len(rollups))
+
+    def test_gen_rollups_pages_using_composite_aggregations(self):
+        hour = datetime(2019, 3, 1, 10, tzinfo=pytz.utc)
+        epoch = int(hour.timestamp() * 1000)
+
+        def gen_page(buckets, after_key=None):
+            keys = {"buckets": buckets}
+            if after_key:
+                keys["after_key"] = after_key
+
+            return ElasticCursor({"hits": {"hits": []}, "aggregations": {"nested": {"keys": keys}}})
+
+        def gen_bucket(hour_epoch, operation, **kwargs):
+            key = {"hour": hour_epoch, "desk": "desk1", "stage": None, "user": "user1", "operation": operation}
+            return dict(kwargs, key=key, doc_count=1)
+
+        pages = [
+            # Timeline entries, including an hour of the items that was not requested
+            gen_page([gen_bucket(epoch, "create"), gen_bucket(epoch + 3600000, "update")], {"hour": 1}),
+            gen_page([gen_bucket(epoch, "update")], {"hour": 2}),
+            gen_page([]),
+            # Desk transitions
+            gen_page([gen_bucket(epoch, "create", duration={"count": 1, "sum": 60, "min": 60, "max": 60})]),
+            gen_page([]),
+        ]
+
+        with self.app.app_context():
+            service = get_resource_service("archive_statistics")
+
+            with mock.patch(
+                "analytics.base_report.BaseReportService.composite_enabled", return_value=True
+            ), mock.patch.object(service, "search", side_effect=pages) as search:
+                rollups = sorted(gen_rollups([hour]), key=lambda rollup: rollup["_id"])
+
+            self.assertEqual(search.call_count, 5)
+            composite = search.call_args_list[1][0][0]["aggs"]["nested"]["aggs"]["keys"]["composite"]
+            self.assertEqual(composite["after"], {"hour": 1})
+
+            # The items are filtered by the hours
+            query = search.call_args_list[0][0][0]["query"]["filtered"]["filter"]["bool"]["must"]
+            self.assertEqual(query[1]["nested"]["path"], "stats.timeline")
+
+            self.assertEqual(
+                [rollup["_id"] for rollup in rollups],
+                ["2019030110_desk1__user1_create", "2019030110_desk1__user1_update"],
+            )
+            self.assertEqual(rollups[0]["duration"], {"count": 1, "sum": 60, "min": 60, "max": 60})
+            self.assertEqual(rollups[1]["count"], 1)
+
+    def test_production_time_only_uses_rollups_when_the_range_ends_now(self):
+        with self.app.app_context(), mock.patch.dict(self.app.config, {"ANALYTICS_STATS_ROLLUPS": True}):
+            service = ProductionTimeReportService("production_time_report", backend=get_backend())
+
+            def gen_args(dates):
+                return {"params": {"dates": dates, "must": {}, "must_not": {}}}
+
+            self.assertTrue(service.use_rollups(gen_args({"filter": "today"})))
+            self.assertFalse(service.use_rollups(gen_args({"filter": "yesterday"})))
+            self.assertFalse(
+                service.use_rollups(gen_args({"filter": "range", "start": "2019-03-01", "end": "2019-03-02"}))
+            )
@@ -0,0 +1,416 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, get_resource_service, Option
+from superdesk.logging import logger
+from superdesk.utc import utcnow
+from superdesk.celery_app import celery
+from superdesk.celery_task_utils import get_lock_id
+from superdesk.lock import lock, unlock
+
+from analytics.stats.common import BACKFILL_STATUS
+from analytics.stats.gen_archive_statistics import (
+    GenArchiveStatistics,
+    gen_stats_signals,
+    get_range_lock_id,
+    wait_for_lock,
+    LOCK_RETRY_COUNTDOWN,
+)
+from analytics.stats.bulk_writer import StatsBulkWriter
+
+from flask import current_app as app
+from eve.utils import config
+from bson import ObjectId
+
+
+# Number of archive_history items sampled per shard, to calculate the ranges of the shards
+SAMPLES_PER_SHARD = 100
+
+
+def get_shard_lookup(state):
+    """Returns the Mongo query for the archive_history items that belong to a shard"""
+
+    lookup = {}
+
+    if state.get("gte"):
+        lookup["$gte"] = state["gte"]
+
+    if state.get("lt"):
+        lookup["$lt"] = state["lt"]
+
+    return {"item_id": lookup} if lookup else {}
+
+
+class BackfillArchiveStatistics(Command):
+    """Re-generate statistics for the entire archive_history collection, using parallel celery tasks
+
+    The archive_history collection is split into ranges of ``item_id``, so that all history for an item
+    is processed by the same shard (in order). Each range is processed by its own celery task,
+    which stores its progress in a checkpoint document (stats_type='backfill') after every chunk.
+    When a task reaches its time budget (config ANALYTICS_STATS_BACKFILL_TIME_BUDGET, defaults to 480 seconds),
+    it dispatches a new task to continue from the checkpoint.
+
+    Elasticsearch refresh is disabled on the statistics index while the backfill is running,
+    and is restored once all shards have finished.
+
+    The record of the last processed history item for the hourly statistics (stats_type='last_run') is not used
+    or modified, so the hourly task can keep running during the backfill. Each chunk is processed while holding
+    the lock of the shard's item_id range only, so the shards run in parallel. The hourly and streaming tasks
+    lock the ranges of the items they process (see ``lock_backfill_ranges``), so they don't write to the same
+    statistics as a shard at the same time. If the range is locked, the shard continues in a new task.
+
+    By default, the history is processed on top of the stored statistics, continuing from their timeline state,
+    so history that has already been processed is skipped. Use ``--full`` to rebuild the statistics
+    (i.e. after changing how they're generated), where the stored statistics of each item are ignored
+    and replaced by statistics generated from all of its history.
+
+    Options
+    ::
+
+        -s, --shards (defaults to 8):
+        Number of shards (celery tasks) to split the archive_history items into
+        -c, --chunk-size (defaults to 1000):
+        Number of archive history items to process per iteration
+        --status:
+        Log the progress of the current backfill
+        --reset:
+        Remove the checkpoints of a previous backfill and start a new one
+        --full:
+        Rebuild the statistics of every item from its history, ignoring the stored statistics
+
+    Running this command while there are unfinished shards will dispatch new tasks for those shards,
+    continuing from their checkpoints.
+
+    Example:
+    ::
+
+        $ python manage.py analytics:backfill_archive_statistics
+        $ python manage.py analytics:backfill_archive_statistics -s 16 -c 500
+        $ python manage.py analytics:backfill_archive_statistics --status
+        $ python manage.py analytics:backfill_archive_statistics --reset
+        $ python manage.py analytics:backfill_archive_statistics --reset --full
+
+    """
+
+    option_list = [
+        Option("--shards", "-s", dest="shards", default=8),
+        Option("--chunk-size", "-c", dest="chunk_size", default=1000),
+        Option("--status", dest="status", action="store_true", default=False),
+        Option("--reset", dest="reset", action="store_true", default=False),
+        Option("--full", dest="full", action="store_true", default=False),
+    ]
+
+    busy = False
+
+    def run(self, shards=8, chunk_size=1000, status=False, reset=False, full=False):
+        statistics_service = get_resource_service("archive_statistics")
+
+        if status:
+            self.log_status()
+            return
+
+        if reset:
+            statistics_service.delete_action({"stats_type": "backfill"})
+
+        checkpoints = statistics_service.get_backfill_shards()
+
+        if not checkpoints:
+            checkpoints = self.create_shards(int(shards), int(chunk_size), full)
+        else:
+            if full:
+                logger.warning("Continuing the existing backfill, use --reset to start a full rebuild")
+
+            checkpoints = [
+                checkpoint for checkpoint in checkpoints if checkpoint["backfill"]["status"] != BACKFILL_STATUS.FINISHED
+            ]
+
+            if not checkpoints:
+                logger.info("Backfill has already finished, use --reset to start a new one")
+                return
+
+            logger.info("Continuing backfill of {} unfinished shards".format(len(checkpoints)))
+
+        self.disable_refresh()
+
+        for checkpoint in checkpoints:
+            backfill_archive_stats.apply_async(args=[checkpoint[config.ID_FIELD]])
+
+        logger.info("Dispatched {} backfill tasks".format(len(checkpoints)))
+
+    def get_shard_ranges(self, num_shards):
+        """Calculates the item_id ranges of the shards from a random sample of archive_history
+
+        :param int num_shards: The number of shards to split the history into
+        :return list: List of (gte, lt) tuples, where None means unbounded
+        """
+
+        collection = app.data.mongo.pymongo("archive_history").db["archive_history"]
+        samples = collection.aggregate(
+            [
+                {"$sample": {"size": num_shards * SAMPLES_PER_SHARD}},
+                {"$project": {"item_id": 1}},
+            ]
+        )
+        item_ids = sorted({str(sample["item_id"]) for sample in samples if sample.get("item_id")})
+
+        boundaries = []
+        for index in range(1, num_shards):
+            if not item_ids:
+                break
+
+            boundary = item_ids[(index * len(item_ids)) // num_shards]
+            if boundary not in boundaries:
+                boundaries.append(boundary)
+
+        lower_bounds = [None] + boundaries
+        upper_bounds = boundaries + [None]
+
+        return list(zip(lower_bounds, upper_bounds))
+
+    def create_shards(self, num_shards, chunk_size, full=False):
+        statistics_service = get_resource_service("archive_statistics")
+        refresh_interval = self.get_refresh_interval()
+        now = utcnow()
+
+        if refresh_interval == "-1":
+            # Refresh is still disabled from a previous backfill, restore the default once finished
+            refresh_interval = None
+
+        checkpoints = [
+            {
+                config.ID_FIELD: "backfill_{}".format(index),
+                "stats_type": "backfill",
+                "backfill": {
+                    "status": BACKFILL_STATUS.PENDING,
+                    "gte": gte,
+                    "lt": lt,
+                    "chunk_size": chunk_size,
+                    "last_id": None,
+                    "history_processed": 0,
+                    "items_processed": 0,
+                    "failed_ids": [],
+                    "refresh_interval": refresh_interval,
+                    # All shards of a full rebuild share its id, stored with the timeline state of the rebuilt items
+                    "full_replay": now.isoformat() if full else None,
+                    "created": now,
+                    "started": None,
+                    "finished": None,
+                },
+            }
+            for index, (gte, lt) in enumerate(self.get_shard_ranges(max(num_shards, 1)))
+        ]
+
+        statistics_service.post(checkpoints)
+        logger.info("Created {} backfill shards".format(len(checkpoints)))
+
+        return checkpoints
+
+    def run_shard(self, shard_id):
+        """Process the history items of a single shard, until finished or the time budget is reached
+
+        :param str shard_id: The id of the shard checkpoint document
+        """
+
+        lock_name = get_lock_id("analytics", "backfill_archive_statistics", shard_id)
+        if not lock(lock_name, expire=610):
+            logger.info("Backfill shard {} is already running".format(shard_id))
+            return
+
+        try:
+            finished = self.process_shard(shard_id)
+        except Exception as e:
+            logger.exception("Failed to backfill shard {}".format(shard_id))
+            self.update_checkpoint(shard_id, {"status": BACKFILL_STATUS.FAILED, "error": str(e)})
+            return
+        finally:
+            unlock(lock_name)
+
+        if finished is None:
+            return
+        elif not finished and self.busy:
+            # The statistics are being generated by another task, continue from the checkpoint later
+            backfill_archive_stats.apply_async(args=[shard_id], countdown=LOCK_RETRY_COUNTDOWN)
+        elif not finished:
+            # Continue from the checkpoint in a new task
+            backfill_archive_stats.apply_async(args=[shard_id])
+        else:
+            self.complete_backfill()
+
+    def process_shard(self, shard_id):
+        """Process the history items of a shard, saving the checkpoint after each chunk
+
+        :param str shard_id: The id of the shard checkpoint document
+        :return bool: True if the shard finished, False if the time budget was reached
+            (or the statistics lock is not available), None if not found
+        """
+
+        statistics_service = get_resource_service("archive_statistics")
+        checkpoint = statistics_service.find_one(req=None, _id=shard_id)
+
+        if not checkpoint:
+            logger.warning("Backfill shard {} not found".format(shard_id))
+            return None
+
+        state = checkpoint["backfill"]
+        if state["status"] == BACKFILL_STATUS.FINISHED:
+            return None
+
+        time_budget = app.config.get("ANALYTICS_STATS_BACKFILL_TIME_BUDGET", 480)
+        started = utcnow()
+
+        state["status"] = BACKFILL_STATUS.RUNNING
+        state["started"] = state.get("started") or started
+        state.pop("error", None)
+        self.update_checkpoint(shard_id, state)
+
+        generator = GenArchiveStatistics()
+        generator.refresh = False
+        generator.full_replay = state.get("full_replay")
+        lock_name = get_range_lock_id(shard_id)
+
+        for history_items in statistics_service.get_history_items(
+            state["last_id"], None, None, state["chunk_size"], get_shard_lookup(state)
+        ):
+            if not wait_for_lock(lock_name):
+                logger.info("Items of shard {} are locked by another task, it will continue later".format(shard_id))
+                self.busy = True
+                return False
+
+            failed_ids = []
+
+            try:
+                gen_stats_signals["start"].send(generator)
+
+                items = generator.gen_history_timelines(history_items)
+                generator.process_timelines(items, failed_ids)
+
+                gen_stats_signals["finish"].send(generator)
+            finally:
+                unlock(lock_name)
+
+            state["last_id"] = str(history_items[-1][config.ID_FIELD])
+            state["history_processed"] += len(history_items)
+            state["items_processed"] += len(items)
+            state["failed_ids"] = sorted(set(state.get("failed_ids") or []) | set(failed_ids))
+            self.update_checkpoint(shard_id, state)
+
+            if (utcnow() - started).total_seconds() >= time_budget:
+                logger.info(
+                    "Backfill shard {} reached its time budget, processed {} history items".format(
+                        shard_id, state["history_processed"]
+                    )
+                )
+                return False
+
+        state["status"] = BACKFILL_STATUS.FINISHED
+        state["finished"] = utcnow()
+        self.update_checkpoint(shard_id, state)
+        logger.info(
+            "Backfill shard {} finished, processed {} history items".format(shard_id, state["history_processed"])
+        )
+
+        return True
+
+    def update_checkpoint(self, shard_id, updates):
+        service = get_resource_service("archive_statistics")
+        checkpoint = service.find_one(req=None, _id=shard_id) or {}
+        service.system_update(shard_id, {"backfill": {**(checkpoint.get("backfill") or {}), **updates}}, checkpoint)
+
+    def complete_backfill(self):
+        """Restores Elasticsearch refresh once all shards have finished"""
+
+        checkpoints = get_resource_service("archive_statistics").get_backfill_shards()
+
+        if any(checkpoint["backfill"]["status"] != BACKFILL_STATUS.FINISHED for checkpoint in checkpoints):
+            return
+
+        self.restore_refresh(checkpoints[0]["backfill"].get("refresh_interval") if checkpoints else None)
+        logger.info("Backfill of archive statistics finished")
+
+    def get_refresh_interval(self):
+        writer = StatsBulkWriter()
+        settings = writer.get_elastic().indices.get_settings(
+            index=writer.get_elastic_index(), name="index.refresh_interval"
+        )
+
+        for index_settings in settings.values():
+            return ((index_settings.get("settings") or {}).get("index") or {}).get("refresh_interval")
+
+        return None
+
+    def set_refresh_interval(self, refresh_interval):
+        writer = StatsBulkWriter()
+        writer.get_elastic().indices.put_settings(
+            index=writer.get_elastic_index(), body={"index": {"refresh_interval": refresh_interval}}
+        )
+
+    def disable_refresh(self):
+        logger.info("Disabling refresh of the statistics index")
+        self.set_refresh_interval("-1")
+
+    def restore_refresh(self, refresh_interval):
+        logger.info("Restoring refresh of the statistics index to {}".format(refresh_interval or "default"))
+        self.set_refresh_interval(refresh_interval)
+
+        writer = StatsBulkWriter()
+        writer.get_elastic().indices.refresh(index=writer.get_elastic_index())
+
+    def log_status(self):
+        checkpoints = get_resource_service("archive_statistics").get_backfill_shards()
+
+        if not checkpoints:
+            logger.info("No backfill found")
+            return
+
+        collection = app.data.mongo.pymongo("archive_history").db["archive_history"]
+        total_processed = 0
+        total_remaining = 0
+
+        for checkpoint in checkpoints:
+            state = checkpoint["backfill"]
+            remaining = 0
+
+            if state["status"] != BACKFILL_STATUS.FINISHED:
+                query = get_shard_lookup(state)
+                if state.get("last_id"):
+                    last_id = state["last_id"]
+                    query[config.ID_FIELD] = {"$gt": ObjectId(last_id) if ObjectId.is_valid(last_id) else last_id}
+
+                remaining = collection.count_documents(query)
+
+            total_processed += state["history_processed"]
+            total_remaining += remaining
+
+            logger.info(
+                "{}: {} - processed {} history ({} items), {} remaining, {} failed{}".format(
+                    checkpoint[config.ID_FIELD],
+                    state["status"],
+                    state["history_processed"],
+                    state["items_processed"],
+                    remaining,
+                    len(state.get("failed_ids") or []),
+                    " ({})".format(state["error"]) if state.get("error") else "",
+                )
+            )
+
+        total = total_processed + total_remaining
+        logger.info(
+            "Total: processed {} of {} history items ({}%)".format(
+                total_processed, total, int(total_processed * 100 / total) if total else 100
+            )
+        )
+
+
+@celery.task(soft_time_limit=600)
+def backfill_archive_stats(shard_id):
+    BackfillArchiveStatistics().run_shard(shard_id)
+
+
+command("analytics:backfill_archive_statistics", BackfillArchiveStatistics())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+from superdesk.celery_task_utils import get_lock_id
+from superdesk.lock import lock, unlock
+
+from analytics import init_app
+from analytics.stats.backfill_archive_statistics import BackfillArchiveStatistics, BACKFILL_STATUS
+from analytics.stats.gen_archive_statistics import get_range_lock_id, lock_backfill_ranges, unlock_all
+from analytics.stats.gen_archive_statistics_test import gen_history
+
+from bson import ObjectId
+
+
+class BackfillArchiveStatisticsTestCase(TestCase):
+    def setUp(self):
+        with self.app.app_context():
+            init_app(self.app)
+            self.service = get_resource_service("archive_statistics")
+
+            self.app.data.insert(
+                "archive_history",
+                [gen_history("item{}".format(index % 4), ObjectId(), "create", index) for index in range(4)]
+                + [gen_history("item{}".format(index % 4), ObjectId(), minutes=index) for index in range(4, 12)],
+            )
+
+            self.app.data.insert(
+                "archive_statistics",
+                [
+                    {
+                        "_id": "backfill_0",
+                        "stats_type": "backfill",
+                        "backfill": {
+                            "status": BACKFILL_STATUS.PENDING,
+                            "gte": "item1",
+                            "lt": "item3",
+                            "chunk_size": 2,
+                            "last_id": None,
+                            "history_processed": 0,
+                            "items_processed": 0,
+                            "failed_ids": [],
+                        },
+                    },
+                    {"_id": "last_run", "stats_type": "last_run", "guid": "history1"},
+                ],
+            )
+
+    def test_process_shard(self):
+        with self.app.app_context():
+            self.app.config["ANALYTICS_STATS_BACKFILL_TIME_BUDGET"] = 0
+            command = BackfillArchiveStatistics()
+
+            # The time budget is reached after the first chunk
+            self.assertFalse(command.process_shard("backfill_0"))
+            state = self.service.find_one(req=None, _id="backfill_0")["backfill"]
+            self.assertEqual(state["status"], BACKFILL_STATUS.RUNNING)
+            self.assertEqual(state["history_processed"], 2)
+            self.assertIsNotNone(state["last_id"])
+
+            self.app.config["ANALYTICS_STATS_BACKFILL_TIME_BUDGET"] = 480
+            self.assertTrue(command.process_shard("backfill_0"))
+            state = self.service.find_one(req=None, _id="backfill_0")["backfill"]
+            self.assertEqual(state["status"], BACKFILL_STATUS.FINISHED)
+            self.assertEqual(state["history_processed"], 6)
+
+            # Only items within the range of the shard are processed
+            stats_ids = sorted(doc["_id"] for doc in self.service.find({"stats_type": "archive"}))
+            self.assertEqual(stats_ids, ["item1", "item2"])
+            self.assertEqual(len(self.service.find_one(req=None, _id="item1")["stats"]["timeline"]), 3)
+
+            # The hourly last_run record is not modified
+            self.assertEqual(self.service.get_last_run()["guid"], "history1")
+
+    def test_shards_only_lock_their_range(self):
+        with self.app.app_context():
+            # The shards don't wait for the lock of the hourly and streaming tasks
+            lock_name = get_lock_id("analytics", "gen_archive_statistics")
+            self.assertTrue(lock(lock_name, expire=610))
+
+            try:
+                self.assertTrue(BackfillArchiveStatistics().process_shard("backfill_0"))
+            finally:
+                unlock(lock_name)
+
+    def test_lock_backfill_ranges(self):
+        with self.app.app_context():
+            range_lock = get_range_lock_id("backfill_0")
+            self.assertTrue(lock(range_lock, expire=610))
+
+            try:
+                # Items in the range of the shard wait for the shard, other items don't
+                self.assertIsNone(lock_backfill_ranges([gen_history("item2", "history20")], wait=0))
+                self.assertEqual(lock_backfill_ranges([gen_history("item3", "history21")], wait=0), [])
+            finally:
+                unlock(range_lock)
+
+            locked = lock_backfill_ranges([gen_history("item1", "history22")], wait=0)
+            self.assertEqual(locked, [range_lock])
+            unlock_all(locked)
+
+    def test_process_shard_full_replay(self):
+        with self.app.app_context():
+            command = BackfillArchiveStatistics()
+            self.assertTrue(command.process_shard("backfill_0"))
+
+            item = self.service.find_one(req=None, _id="item1")
+            self.service.system_update("item1", {"par_count": 10, "stale": True}, item)
+
+            self.service.post(
+                [
+                    {
+                        "_id": "backfill_full",
+                        "stats_type": "backfill",
+                        "backfill": {
+                            "status": BACKFILL_STATUS.PENDING,
+                            "gte": "item1",
+                            "lt": "item2",
+                            "chunk_size": 2,
+                            "last_id": None,
+                            "history_processed": 0,
+                            "items_processed": 0,
+                            "failed_ids": [],
+                            "full_replay": "2019-01-01T00:00:00+00:00",
+                        },
+                    }
+                ]
+            )
+            self.assertTrue(command.process_shard("backfill_full"))
+
+            # The stored stats are replaced by stats generated from the entire history
+            item = self.service.find_one(req=None, _id="item1")
+            self.assertNotIn("stale", item)
+            self.assertEqual(item["par_count"], 0)
+            self.assertEqual(len(item["stats"]["timeline"]), 3)
+            self.assertEqual(item["timeline_state"]["full_replay"], "2019-01-01T00:00:00+00:00")
+
+    def test_get_shard_ranges(self):
+        with self.app.app_context():
+            ranges = BackfillArchiveStatistics().get_shard_ranges(2)
+
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        for (_, lt), (gte, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(lt, gte)
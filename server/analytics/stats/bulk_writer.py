@@ -0,0 +1,380 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk.logging import logger
+from superdesk.utc import utcnow
+
+from analytics.stats.common import STAT_TYPE
+from analytics.stats.archive_statistics_partitions import StatsPartitions, partitions_enabled, get_partition
+
+from flask import current_app as app
+from eve.utils import config, document_etag
+from pymongo import InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from elasticsearch.helpers import streaming_bulk
+
+
+# Painless script used to append new timeline entries to an existing document
+# along with setting the derived fields that have changed
+APPEND_TIMELINE_SCRIPT = """
+for (entry in params.fields.entrySet()) {
+    ctx._source[entry.getKey()] = entry.getValue();
+}
+if (ctx._source.stats == null) {
+    ctx._source.stats = new HashMap();
+}
+for (entry in params.stats.entrySet()) {
+    ctx._source.stats[entry.getKey()] = entry.getValue();
+}
+if (ctx._source.stats.timeline == null) {
+    ctx._source.stats.timeline = new ArrayList();
+}
+ctx._source.stats.timeline.addAll(params.timeline);
+"""
+
+
+def gen_delta_updates(original, updates):
+    """Calculates the changes between the stored document and the newly generated updates
+
+    New timeline entries are returned separately, so they can be appended to the stored timeline,
+    instead of re-sending the entire timeline. If the stored timeline is not a prefix of the new timeline
+    (i.e. a previous entry was changed), then the entire timeline is returned in the stats changes.
+
+    :param dict original: The stored statistics document
+    :param dict updates: The newly generated statistics document
+    :return tuple: (changed fields, changed stats, new timeline entries)
+    """
+
+    fields = {}
+    stats = {}
+    timeline = []
+
+    for key, value in updates.items():
+        if key == "stats":
+            continue
+        elif key not in original or original[key] != value:
+            fields[key] = value
+
+    original_stats = original.get("stats") or {}
+
+    for key, value in (updates.get("stats") or {}).items():
+        if key == STAT_TYPE.TIMELINE:
+            original_timeline = original_stats.get(key) or []
+            new_timeline = value or []
+            num_entries = len(original_timeline)
+
+            if new_timeline[:num_entries] == original_timeline:
+                timeline = new_timeline[num_entries:]
+                continue
+        elif key in original_stats and original_stats[key] == value:
+            continue
+
+        stats[key] = value
+
+    return fields, stats, timeline
+
+
+class StatsBulkWriter:
+    """Collects the statistics documents for a chunk and writes them in bulk
+
+    Creates and updates are sent to Mongo using a single ``bulk_write`` call,
+    and then to Elasticsearch using a single bulk request. Failures are reported
+    per item, so one bad document doesn't fail the whole chunk.
+
+    If the config option ANALYTICS_STATS_DELTA_UPDATES is true (the default), updates only contain
+    the fields that changed from the original document, and new timeline entries are appended
+    to the stored timeline. This way the amount of data written grows with the new history,
+    not with the total history of an item.
+
+    Example:
+    ::
+
+        writer = StatsBulkWriter()
+        writer.create({"_id": "item1", "stats_type": "archive"})
+        writer.update("item2", {"headline": "Updated"}, original)
+        failed_ids = writer.flush()
+
+    """
+
+    def __init__(self, resource="archive_statistics", refresh=True, delta=None):
+        """Initialise the writer
+
+        :param str resource: The resource to write the documents to
+        :param bool refresh: If True, refresh the Elasticsearch index after writing
+        :param bool delta: If True, only write changes (defaults to ANALYTICS_STATS_DELTA_UPDATES config)
+        """
+
+        self.resource = resource
+        self.refresh = refresh
+        self.delta = app.config.get("ANALYTICS_STATS_DELTA_UPDATES", True) if delta is None else delta
+        self.creates = []
+        self.updates = []
+        self.replaces = []
+        self.partitions = StatsPartitions(resource) if partitions_enabled(resource) else None
+
+    def __len__(self):
+        return len(self.creates) + len(self.updates) + len(self.replaces)
+
+    def create(self, doc):
+        """Add a new document to be created
+
+        :param dict doc: The document to create (must include the _id)
+        """
+
+        self.creates.append(doc)
+
+    def update(self, item_id, updates, original=None):
+        """Add updates for an existing document
+
+        :param str item_id: The id of the document to update
+        :param dict updates: The attributes to set on the document
+        :param dict original: The original document (used to calculate the etag)
+        """
+
+        self.updates.append((item_id, updates, original or {}))
+
+    def replace(self, doc, original):
+        """Add a document that replaces the stored document entirely (used to rebuild the statistics)
+
+        :param dict doc: The new document (must include the _id)
+        :param dict original: The stored document
+        """
+
+        self.replaces.append((doc, original))
+
+    def flush(self):
+        """Writes all collected creates and updates, then clears the writer
+
+        :return list: The ids of the items that failed to be written
+        """
+
+        if not len(self):
+            return []
+
+        now = utcnow()
+        requests = []
+        item_ids = []
+        es_actions = []
+
+        for doc in self.creates:
+            doc.setdefault(config.DATE_CREATED, now)
+            doc[config.LAST_UPDATED] = now
+            self._set_partition(doc, {})
+            doc[config.ETAG] = document_etag(doc)
+
+            requests.append(InsertOne(doc))
+            item_ids.append(doc[config.ID_FIELD])
+            es_actions.append(self._route(self._gen_index_action(doc), doc.get("partition")))
+
+        for doc, original in self.replaces:
+            doc[config.DATE_CREATED] = original.get(config.DATE_CREATED) or now
+            doc[config.LAST_UPDATED] = now
+            self._set_partition(doc, {})
+            doc[config.ETAG] = document_etag(doc)
+
+            requests.append(ReplaceOne({config.ID_FIELD: doc[config.ID_FIELD]}, doc, upsert=True))
+            item_ids.append(doc[config.ID_FIELD])
+            es_actions.append(self._route(self._gen_index_action(doc), doc.get("partition")))
+
+            if self.partitions is not None and original.get("partition") != doc.get("partition"):
+                # Remove the stored document from its previous partition
+                delete_action = {"_op_type": "delete", "_id": doc[config.ID_FIELD]}
+                es_actions.append(self._route(delete_action, original.get("partition")))
+
+        for item_id, updates, original in self.updates:
+            updates.pop(config.ID_FIELD, None)
+            self._set_partition(updates, original)
+
+            if not self.delta:
+                updates[config.LAST_UPDATED] = now
+                updates[config.ETAG] = document_etag({**original, **updates})
+
+                requests.append(UpdateOne({config.ID_FIELD: item_id}, {"$set": updates}))
+                item_ids.append(item_id)
+                es_actions.extend(
+                    self._gen_partition_actions(item_id, updates, original, self._gen_update_action(item_id, updates))
+                )
+                continue
+
+            fields, stats, timeline = gen_delta_updates(original, updates)
+
+            if not fields and not stats and not timeline:
+                # Nothing has changed for this item, no need to write it
+                continue
+
+            fields[config.LAST_UPDATED] = now
+            fields[config.ETAG] = document_etag({**original, **updates})
+
+            requests.append(self._gen_mongo_delta_request(item_id, fields, stats, timeline))
+            item_ids.append(item_id)
+            es_actions.extend(
+                self._gen_partition_actions(
+                    item_id,
+                    dict(updates, **fields),
+                    original,
+                    self._gen_delta_action(item_id, fields, stats, timeline),
+                )
+            )
+
+        self.creates = []
+        self.updates = []
+        self.replaces = []
+
+        if not requests:
+            return []
+
+        failed_ids = self._write_to_mongo(requests, item_ids)
+
+        # Only send documents to Elasticsearch that were successfully stored in Mongo
+        es_actions = [action for action in es_actions if action["_id"] not in failed_ids]
+        failed_ids.update(self._write_to_elastic(es_actions))
+
+        return [item_id for item_id in item_ids if item_id in failed_ids]
+
+    def _set_partition(self, updates, original):
+        """Sets the monthly partition of the document, if the statistics index is partitioned"""
+
+        if self.partitions is None:
+            return
+
+        partition = get_partition({**original, **updates})
+
+        if partition != original.get("partition"):
+            updates["partition"] = partition
+
+    def _route(self, action, partition):
+        if self.partitions is not None and partition:
+            action["_index"] = self.partitions.ensure_partition(partition)
+
+        return action
+
+    def _gen_partition_actions(self, item_id, updates, original, action):
+        """Returns the Elasticsearch actions for an update, moving the document if its partition changed"""
+
+        if self.partitions is None:
+            return [action]
+
+        partition = updates.get("partition", original.get("partition"))
+
+        if partition == original.get("partition"):
+            return [self._route(action, partition)]
+
+        # Index the entire document in the new partition, and remove it from the previous one
+        index_action = self._route(self._gen_index_action({**original, **updates, config.ID_FIELD: item_id}), partition)
+        delete_action = self._route({"_op_type": "delete", "_id": item_id}, original.get("partition"))
+
+        return [index_action, delete_action]
+
+    def index(self, docs):
+        """Indexes the documents in Elasticsearch only, using a single bulk request
+
+        Used for secondary indices that are derived from the statistics, and not stored in Mongo
+
+        :param list docs: The documents to index (must include the _id)
+        :return list: The ids of the documents that failed to be indexed
+        """
+
+        failed_ids = self._write_to_elastic([self._gen_index_action(doc) for doc in docs])
+        return [doc[config.ID_FIELD] for doc in docs if doc[config.ID_FIELD] in failed_ids]
+
+    def _gen_index_action(self, doc):
+        source = {key: value for key, value in doc.items() if key != config.ID_FIELD}
+        return {"_op_type": "index", "_id": doc[config.ID_FIELD], "_source": source}
+
+    def _gen_update_action(self, item_id, updates):
+        return {"_op_type": "update", "_id": item_id, "doc": updates}
+
+    def _gen_mongo_delta_request(self, item_id, fields, stats, timeline):
+        updates = {"$set": dict(fields)}
+
+        for key, value in stats.items():
+            updates["$set"]["stats.{}".format(key)] = value
+
+        if timeline:
+            updates["$push"] = {"stats.{}".format(STAT_TYPE.TIMELINE): {"$each": timeline}}
+
+        return UpdateOne({config.ID_FIELD: item_id}, updates)
+
+    def _gen_delta_action(self, item_id, fields, stats, timeline):
+        if not timeline:
+            # Partial updates are merged with the stored document, so changes
+            # to the stats won't overwrite the stored timeline
+            updates = dict(fields)
+            if stats:
+                updates["stats"] = stats
+
+            return self._gen_update_action(item_id, updates)
+
+        return {
+            "_op_type": "update",
+            "_id": item_id,
+            "script": {
+                "lang": "painless",
+                "source": APPEND_TIMELINE_SCRIPT,
+                "params": {"fields": fields, "stats": stats, "timeline": timeline},
+            },
+        }
+
+    def get_mongo_collection(self):
+        return app.data.mongo.pymongo(self.resource).db[self.resource]
+
+    def get_elastic(self):
+        return app.data.elastic.elastic(self.resource)
+
+    def get_elastic_index(self):
+        return app.data.elastic._resource_index(self.resource)
+
+    def _write_to_mongo(self, requests, item_ids):
+        failed_ids = set()
+
+        try:
+            self.get_mongo_collection().bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors") or []:
+                item_id = item_ids[error["index"]]
+                logger.error("Failed to write stats for item {}: {}".format(item_id, error.get("errmsg")))
+                failed_ids.add(item_id)
+        except Exception:
+            logger.exception("Failed to write stats for items {}".format(", ".join(item_ids)))
+            failed_ids.update(item_ids)
+
+        return failed_ids
+
+    def _write_to_elastic(self, actions):
+        failed_ids = set()
+
+        if not actions:
+            return failed_ids
+
+        es = self.get_elastic()
+        index = self.get_elastic_index()
+
+        try:
+            for success, info in streaming_bulk(
+                es, actions, index=index, raise_on_error=False, raise_on_exception=False
+            ):
+                if not success:
+                    op_type, result = next(iter(info.items()))
+
+                    if op_type == "delete" and result.get("status") == 404:
+                        # The document was already removed from its previous partition
+                        continue
+
+                    logger.error("Failed to index stats for item {}: {}".format(result.get("_id"), result.get("error")))
+                    failed_ids.add(result.get("_id"))
+
+            if self.refresh and app.config.get("ELASTICSEARCH_FORCE_REFRESH", True):
+                es.indices.refresh(index=index)
+        except Exception:
+            item_ids = [action["_id"] for action in actions]
+            logger.exception("Failed to index stats for items {}".format(", ".join(item_ids)))
+            failed_ids.update(item_ids)
+
+        return failed_ids
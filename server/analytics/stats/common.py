@@ -20,6 +20,13 @@ class StatTypes(NamedTuple):
 STAT_TYPE: StatTypes = StatTypes("timeline", "desk_transitions", "featuremedia_updates")
 
 
+class BACKFILL_STATUS:
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+
 class Operations(NamedTuple):
     CREATE: str
     FETCH: str
@@ -0,0 +1,211 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, Option
+from superdesk.logging import logger
+from superdesk.metadata.item import ASSOCIATIONS
+
+from analytics.stats.common import STAT_TYPE, OPERATION
+from analytics.stats.bulk_writer import StatsBulkWriter
+
+from eve.utils import config
+from time import perf_counter
+
+
+# Attributes of the featuremedia used by the featuremedia stats and reports (including the renditions preview)
+FEATUREMEDIA_FIELDS = [
+    config.ID_FIELD,
+    "guid",
+    "type",
+    "headline",
+    "alt_text",
+    "description_text",
+    "byline",
+    "copyrightholder",
+    "copyrightnotice",
+    "usageterms",
+    "credit",
+    "source",
+    "renditions",
+    "poi",
+]
+
+# Attributes of the lock history stored with item_lock/item_unlock timeline entries
+LOCK_FIELDS = ["lock_user", "lock_action"]
+
+
+def compact_featuremedia(media):
+    if not media:
+        return media
+
+    return {key: value for key, value in media.items() if key in FEATUREMEDIA_FIELDS}
+
+
+def compact_update(entry):
+    """Returns the update of a timeline entry, with only the attributes used by the stats and reports
+
+    :param dict entry: The timeline entry
+    :return dict: The compacted update
+    """
+
+    update = entry.get("update")
+
+    if not update:
+        return update
+    elif entry.get("operation") in [OPERATION.ITEM_LOCK, OPERATION.ITEM_UNLOCK]:
+        return {key: value for key, value in update.items() if key in LOCK_FIELDS}
+    elif ASSOCIATIONS in update:
+        # Only keep the featuremedia, other associations are not used
+        associations = update.get(ASSOCIATIONS)
+        featuremedia = (associations or {}).get("featuremedia")
+
+        return {ASSOCIATIONS: None if associations is None else {"featuremedia": compact_featuremedia(featuremedia)}}
+
+    return update
+
+
+def compact_stats(stats):
+    """Compacts the update of the timeline and featuremedia entries of the stats (in place)
+
+    The compaction is idempotent, so compacting already compacted stats results in the same stats
+
+    :param dict stats: The stats of an archive_statistics document
+    :return bool: True if the stats were modified
+    """
+
+    modified = False
+
+    for stat_type in [STAT_TYPE.TIMELINE, STAT_TYPE.FEATUREMEDIA_UPDATES]:
+        entries = stats.get(stat_type) or []
+
+        for index, entry in enumerate(entries):
+            if not entry.get("update"):
+                continue
+
+            update = compact_update(entry)
+
+            if update != entry["update"]:
+                entries[index] = dict(entry, update=update)
+                modified = True
+
+    return modified
+
+
+class CompactArchiveStatistics(Command):
+    """Remove the attributes from the timeline updates that are not used by the stats or reports
+
+    Rewrites the existing archive_statistics documents, the same way new stats are stored when
+    the config option ANALYTICS_STATS_COMPACT_TIMELINE is true. Only the featuremedia of associations
+    and the lock user/action of lock entries are kept.
+
+    Options
+    ::
+
+        -c, --chunk-size (defaults to 500):
+        Number of documents to rewrite per iteration
+        -m, --measure:
+        Log the store and document stats of the statistics index, and the latency of a search,
+        before and after the compaction. Compacted documents are re-indexed, so the store size
+        includes the deleted documents until Elasticsearch merges the segments
+
+    Example:
+    ::
+
+        $ python manage.py analytics:compact_archive_statistics
+        $ python manage.py analytics:compact_archive_statistics -c 100 --measure
+
+    """
+
+    option_list = [
+        Option("--chunk-size", "-c", dest="chunk_size", default=500),
+        Option("--measure", "-m", dest="measure", action="store_true", default=False),
+    ]
+
+    def run(self, chunk_size=500, measure=False):
+        if measure:
+            before = self.measure()
+
+        num_compacted = self.compact(int(chunk_size))
+
+        if measure:
+            after = self.measure()
+
+            logger.info("Compacted {} documents".format(num_compacted))
+
+            for key in ["size_in_bytes", "docs_count", "docs_deleted", "segments_count", "latency"]:
+                logger.info("{}: {} -> {}".format(key, before[key], after[key]))
+
+    def compact(self, chunk_size):
+        writer = StatsBulkWriter()
+        collection = writer.get_mongo_collection()
+        lookup = {"stats_type": {"$in": ["archive", "archive_family"]}}
+        last_id = None
+        num_compacted = 0
+
+        while True:
+            query = dict(lookup, **{config.ID_FIELD: {"$gt": last_id}}) if last_id else lookup
+            docs = list(collection.find(query).sort(config.ID_FIELD, 1).limit(chunk_size))
+
+            if not docs:
+                break
+
+            for doc in docs:
+                stats = dict(doc.get("stats") or {})
+
+                if compact_stats(stats):
+                    writer.update(doc[config.ID_FIELD], {"stats": stats}, doc)
+
+            num_compacted += len(writer)
+            failed_ids = writer.flush()
+
+            if failed_ids:
+                logger.warning("Failed to compact stats for items {}".format(", ".join(failed_ids)))
+
+            last_id = docs[-1][config.ID_FIELD]
+
+        logger.info("Compacted {} archive statistics documents".format(num_compacted))
+        return num_compacted
+
+    def measure(self, num_searches=20, size=100):
+        """Returns the store and document stats of the statistics index, and the average latency of a search
+
+        The stats are reported as they are, without merging the segments of the index. So the store size
+        after a compaction still includes the replaced documents, until Elasticsearch merges them away.
+
+        :param int num_searches: The number of searches to average the latency over
+        :param int size: The number of hits to return per search
+        :return dict: The primaries store size in bytes, document and segment counts, and latency in milliseconds
+        """
+
+        writer = StatsBulkWriter()
+        es = writer.get_elastic()
+        index = writer.get_elastic_index()
+
+        es.indices.refresh(index=index)
+        primaries = es.indices.stats(index=index, metric="store,docs,segments")["_all"]["primaries"]
+
+        query = {"query": {"term": {"stats_type": "archive"}}, "size": size}
+        started = perf_counter()
+
+        for _ in range(num_searches):
+            es.search(index=index, body=query, request_cache=False)
+
+        latency = (perf_counter() - started) * 1000 / num_searches
+
+        return {
+            "size_in_bytes": primaries["store"]["size_in_bytes"],
+            "docs_count": primaries["docs"]["count"],
+            "docs_deleted": primaries["docs"]["deleted"],
+            "segments_count": primaries["segments"]["count"],
+            "latency": round(latency, 1),
+        }
+
+
+command("analytics:compact_archive_statistics", CompactArchiveStatistics())
@@ -0,0 +1,111 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.stats.compact_archive_statistics import CompactArchiveStatistics, compact_stats
+
+from copy import deepcopy
+from bson import json_util
+
+
+def gen_featuremedia(media_id):
+    return {
+        "_id": media_id,
+        "guid": media_id,
+        "type": "picture",
+        "headline": "Image",
+        "renditions": {"original": {"href": "/{}.jpg".format(media_id), "width": 800, "height": 600}},
+        "poi": {"x": 0.5, "y": 0.5},
+        "body_html": "<p>{}</p>".format("Image description " * 200),
+        "subject": [{"qcode": "01000000", "name": "arts, culture and entertainment"}] * 20,
+    }
+
+
+def gen_stats():
+    featuremedia_update = {
+        "operation": "add_featuremedia",
+        "update": {
+            "associations": {
+                "featuremedia": gen_featuremedia("image1"),
+                "editor_0": gen_featuremedia("image2"),
+            }
+        },
+    }
+
+    return {
+        "timeline": [
+            {"operation": "create", "task": {"user": "user1"}},
+            {
+                "operation": "item_lock",
+                "update": {"lock_user": "user1", "lock_action": "edit", "lock_session": "session1", "_etag": "etag"},
+            },
+            featuremedia_update,
+        ],
+        "featuremedia_updates": [featuremedia_update],
+    }
+
+
+class CompactArchiveStatisticsTestCase(TestCase):
+    def test_compact_stats(self):
+        stats = gen_stats()
+        original = deepcopy(stats)
+
+        self.assertTrue(compact_stats(stats))
+
+        self.assertEqual(stats["timeline"][0], original["timeline"][0])
+        self.assertEqual(stats["timeline"][1]["update"], {"lock_user": "user1", "lock_action": "edit"})
+
+        for entry in [stats["timeline"][2], stats["featuremedia_updates"][0]]:
+            self.assertEqual(list(entry["update"]["associations"].keys()), ["featuremedia"])
+
+            featuremedia = entry["update"]["associations"]["featuremedia"]
+            self.assertEqual(featuremedia["renditions"], gen_featuremedia("image1")["renditions"])
+            self.assertNotIn("body_html", featuremedia)
+            self.assertNotIn("subject", featuremedia)
+
+        # Compacting is idempotent
+        compacted = deepcopy(stats)
+        self.assertFalse(compact_stats(stats))
+        self.assertEqual(stats, compacted)
+
+        # Measure the size of the fixture stats, as stored in the _source of the document
+        size_before = len(json_util.dumps(original))
+        size_after = len(json_util.dumps(stats))
+        self.assertLess(size_after, size_before / 4)
+
+    def test_compact_command(self):
+        with self.app.app_context():
+            init_app(self.app)
+            service = get_resource_service("archive_statistics")
+
+            service.post(
+                [
+                    {"_id": "item1", "stats_type": "archive", "stats": gen_stats()},
+                    {"_id": "item2", "stats_type": "archive", "stats": {"timeline": []}},
+                ]
+            )
+
+            # Size of the stats as stored in the document, before and after the compaction
+            size_before = len(json_util.dumps(service.find_one(req=None, _id="item1")["stats"]))
+
+            self.assertEqual(CompactArchiveStatistics().compact(1), 1)
+
+            stats = service.find_one(req=None, _id="item1")["stats"]
+            size_after = len(json_util.dumps(stats))
+            self.assertLess(size_after, size_before / 4)
+
+            self.assertEqual(list(stats["timeline"][2]["update"]["associations"].keys()), ["featuremedia"])
+            self.assertEqual(list(stats["featuremedia_updates"][0]["update"]["associations"].keys()), ["featuremedia"])
+
+            # The document without updates to compact is stored as it was
+            self.assertEqual(service.find_one(req=None, _id="item2")["stats"], {"timeline": []})
@@ -15,14 +15,17 @@ from analytics.stats.common import (
     EXIT_DESK_OPERATIONS,
 )
 
-from copy import deepcopy
-
 
 def init(stats):
     # Clear the desk stats as we'll recalculate them here
     stats[STAT_TYPE.DESK_TRANSITIONS] = []
 
 
+def resume(stats):
+    # Copy the stored desk stats, as we'll append new transitions to them
+    stats[STAT_TYPE.DESK_TRANSITIONS] = list(stats.get(STAT_TYPE.DESK_TRANSITIONS) or [])
+
+
 def store_update_fields(entry, new_update):
     pass
 
@@ -35,7 +38,7 @@ def process(entry, new_timeline, updates, update, stats):
     operation_created = entry.get("operation_created")
 
     if operation in ENTER_DESK_OPERATIONS:
-        updates["_current_task"] = deepcopy(task)
+        updates["_current_task"] = dict(task)
 
         if operation == OPERATION.CREATE and updates.get("rewrite_of"):
             updates["_current_task"]["entered_operation"] = OPERATION.REWRITE
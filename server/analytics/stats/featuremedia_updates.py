@@ -10,18 +10,18 @@
 
 from superdesk import get_resource_service
 from superdesk.metadata.item import ASSOCIATIONS, CONTENT_TYPE
-from superdesk.logging import logger
 
 from analytics.stats.common import STAT_TYPE, OPERATION, FEATUREMEDIA_OPERATIONS
-from analytics.stats.gen_archive_statistics import connect_stats_signals
+from analytics.stats.gen_archive_statistics import register_stats_plugin, copy_timeline_entry
+from analytics.stats.rewrite_families import RewriteFamilyResolver
 
 from copy import deepcopy
 from flask import current_app as app
-from eve.utils import config
 
 
 class FeaturemediaUpdates:
     def __init__(self, sender=None):
+        self.resolver = RewriteFamilyResolver()
         self.on_start()
 
     def on_start(self, sender=None):
@@ -38,6 +38,10 @@ class FeaturemediaUpdates:
         # Clear the featuremedia stats as we'll recalculate them here
         stats[STAT_TYPE.FEATUREMEDIA_UPDATES] = []
 
+    def resume(self, sender, stats):
+        # Copy the stored featuremedia stats, as we'll append new updates to them
+        stats[STAT_TYPE.FEATUREMEDIA_UPDATES] = list(stats.get(STAT_TYPE.FEATUREMEDIA_UPDATES) or [])
+
     def process(self, sender, entry, new_timeline, updates, update, stats):
         # Generating stats with PUBLISH_ASSOCIATED_ITEMS=True is currently not supported
         if app.config.get("PUBLISH_ASSOCIATED_ITEMS", False):
@@ -153,7 +157,7 @@ class FeaturemediaUpdates:
                 )
 
     def _add_media_operation(self, entry, operation, new_timeline, updates, stats, name, media=None):
-        media_operation = deepcopy(entry)
+        media_operation = copy_timeline_entry(entry)
         media_operation["_auto_generated"] = True
         media_operation["operation"] = name
 
@@ -211,6 +215,8 @@ class FeaturemediaUpdates:
         else:
             updates["num_featuremedia_updates"] = num_featuremedia_updates
 
+    def processed(self, sender, orig, updates):
+        # Collect the rewrites in the main process, as ``complete`` can be called from a worker process
         if updates.get("rewrite_of"):
             self.rewrite_ids.add(updates.get("rewrite_of"))
             self.rewrite_ids.add(orig["_id"])
@@ -221,30 +227,14 @@ class FeaturemediaUpdates:
     def finish(self, sender):
         service = get_resource_service("archive_statistics")
 
-        query = {"query": {"bool": {"must": {"terms": {"_id": list(self.rewrite_ids)}}}}}
-        docs = {doc["_id"]: doc for doc in service.search(query)}
-
-        def get_parent_id(doc):
-            if not doc.get("rewrite_of"):
-                return doc[config.ID_FIELD]
-            elif doc["rewrite_of"] not in docs:
-                # If the parent item was not part of this stats iteration
-                # then load it now
-                parent = service.find_one(req=None, _id=doc["rewrite_of"])
-
-                if not parent:
-                    # Stats entry for the parent item was not found
-                    logger.warn("Failed to get parent item {}".format(doc["rewrite_of"]))
-                    return None
-                else:
-                    docs[doc["rewrite_of"]] = parent
-
-            return get_parent_id(docs[doc["rewrite_of"]])
+        # Load the docs (and their ancestors) from Mongo in batches,
+        # as the Elasticsearch index may not be refreshed yet (i.e. during a backfill)
+        docs = self.resolver.load(self.rewrite_ids)
 
         parent_docs = {}
         for doc_id in list(docs.keys()):
             doc = docs[doc_id]
-            parent_id = get_parent_id(doc)
+            parent_id = self.resolver.get_root_id(doc_id)
 
             if parent_id is None:
                 # If we failed to find the parent id
@@ -276,17 +266,13 @@ class FeaturemediaUpdates:
                 else:
                     parent_docs[parent_id] += updates
 
+        # get the archive_family stats items (if they exist)
+        # otherwise the stats for the archive item itself
+        families = self.resolver.get_family_docs(parent_docs.keys())
+
         for doc_id, stats in parent_docs.items():
-            # get the archive_family stats item (if it exists)
             merged_id = "{}_family".format(doc_id)
-            original = service.find_one(req=None, _id=merged_id)
-            is_new = False
-
-            if not original:
-                # If the archive_family stats item doesn't exist
-                # then get the stats for the archive item itself
-                is_new = True
-                original = service.find_one(req=None, _id=doc_id) or {}
+            original, is_new = families[doc_id]
 
             sorted_entries = sorted(stats, key=lambda k: (k["operation_created"], k["history_id"]))
 
@@ -348,11 +334,17 @@ class FeaturemediaUpdates:
 
 featuremedia_updates = FeaturemediaUpdates()
 
-connect_stats_signals(
+# Featuremedia updates are only generated for text and picture items
+register_stats_plugin(
+    content_types=[CONTENT_TYPE.TEXT, CONTENT_TYPE.PICTURE],
     on_start=featuremedia_updates.on_start,
-    on_generate=featuremedia_updates.store_update_fields,
     on_init_timeline=featuremedia_updates.init,
+    on_resume_timeline=featuremedia_updates.resume,
     on_process=featuremedia_updates.process,
     on_complete=featuremedia_updates.complete,
+    on_processed=featuremedia_updates.processed,
     on_finish=featuremedia_updates.finish,
 )
+
+# The update fields only need to be stored for the featuremedia operations
+register_stats_plugin(operations=FEATUREMEDIA_OPERATIONS, on_generate=featuremedia_updates.store_update_fields)
@@ -12,6 +12,7 @@ from superdesk import Command, command, get_resource_service, Option
 from superdesk.logging import logger
 from superdesk.utc import utcnow
 from superdesk.metadata.item import (
+    CONTENT_TYPE,
     ITEM_STATE,
     ITEM_TYPE,
     FORMAT,
@@ -23,25 +24,211 @@ from superdesk.metadata.item import (
 )
 from superdesk.text_utils import get_par_count
 from superdesk.celery_task_utils import get_lock_id
-from superdesk.lock import lock, unlock
+from superdesk.lock import lock, unlock, touch
 from superdesk.signals import signals
 
-from analytics.stats.common import STAT_TYPE, OPERATION
+from analytics.stats.common import STAT_TYPE, OPERATION, BACKFILL_STATUS
 from analytics.stats import desk_transitions
+from analytics.stats.bulk_writer import StatsBulkWriter
+from analytics.stats.compact_archive_statistics import compact_stats
 
+from flask import current_app as app
 from eve.utils import config
-from copy import deepcopy
 from datetime import timedelta
+from hashlib import blake2b
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep
+import multiprocessing
 
 gen_stats_signals = {
     "start": signals.signal("gen_archive_statistics:start"),
     "generate": signals.signal("gen_archive_statistics:generate"),
     "init_timeline": signals.signal("gen_archive_statistics:init_timeline"),
+    "resume_timeline": signals.signal("gen_archive_statistics:resume_timeline"),
     "process": signals.signal("gen_archive_statistics:process"),
     "complete": signals.signal("gen_archive_statistics:complete"),
+    "processed": signals.signal("gen_archive_statistics:processed"),
     "finish": signals.signal("gen_archive_statistics:finish"),
 }
 
+# Seconds to wait for a statistics lock, and before retrying the task once the lock was not available
+LOCK_WAIT = 10
+LOCK_RETRY_COUNTDOWN = 60
+
+
+def wait_for_lock(lock_name, wait=LOCK_WAIT):
+    """Waits up to ``wait`` seconds for the lock
+
+    :param str lock_name: The name of the lock
+    :param int wait: Seconds to wait for the lock
+    :return bool: True if the lock was acquired
+    """
+
+    for attempt in range(wait + 1):
+        if lock(lock_name, expire=610):
+            return True
+        elif attempt < wait:
+            sleep(1)
+
+    return False
+
+
+def get_range_lock_id(shard_id):
+    """Returns the lock of the item_id range of a backfill shard, held while the shard processes a chunk"""
+
+    return get_lock_id("analytics", "gen_archive_statistics", "range", shard_id)
+
+
+def in_shard_range(item_id, state):
+    """Returns True if the item belongs to the item_id range of a backfill shard"""
+
+    gte = state.get("gte")
+    lt = state.get("lt")
+
+    return (not gte or item_id >= str(gte)) and (not lt or item_id < str(lt))
+
+
+def lock_backfill_ranges(history_items, wait=LOCK_WAIT):
+    """Locks the ranges of the unfinished backfill shards that contain the items of the history
+
+    The backfill shards only lock their own range, so the hourly and streaming tasks lock the ranges
+    of the items they're about to process, instead of a shard locking all the statistics.
+
+    :param list history_items: The archive_history items about to be processed
+    :param int wait: Seconds to wait for each range lock
+    :return list: The names of the locks acquired, or None if a range is still locked by its shard
+    """
+
+    item_ids = {str(history.get("item_id")) for history in history_items}
+    lock_names = []
+
+    for shard in get_resource_service("archive_statistics").get_backfill_shards():
+        state = shard.get("backfill") or {}
+
+        if state.get("status") == BACKFILL_STATUS.FINISHED:
+            continue
+
+        if any(in_shard_range(item_id, state) for item_id in item_ids):
+            lock_names.append(get_range_lock_id(shard[config.ID_FIELD]))
+
+    locked = []
+
+    for lock_name in lock_names:
+        if not wait_for_lock(lock_name, wait):
+            unlock_all(locked)
+            return None
+
+        locked.append(lock_name)
+
+    return locked
+
+
+def unlock_all(lock_names):
+    for lock_name in lock_names:
+        unlock(lock_name)
+
+
+def copy_timeline_entry(entry):
+    """Returns a copy of a timeline entry, without cloning its update payload
+
+    The top level attributes and the task are copied, so they can be modified without
+    affecting the original entry. The ``update`` dictionary (which can contain large values
+    such as ``body_html``) is shared with the original entry, and must be treated as read only.
+
+    :param dict entry: The timeline entry to copy
+    :return dict: The copied timeline entry
+    """
+
+    copied = dict(entry)
+
+    if isinstance(entry.get("task"), dict):
+        copied["task"] = dict(entry["task"])
+
+    return copied
+
+
+# Per entry handlers registered using ``register_stats_plugin``
+stats_plugin_handlers = {
+    "generate": [],
+    "process": [],
+}
+
+
+def register_stats_plugin(operations=None, content_types=None, on_generate=None, on_process=None, **kwargs):
+    """Register a plugin that only handles timeline entries for specific operations and content types
+
+    Unlike ``connect_stats_signals``, the ``on_generate`` and ``on_process`` handlers are not connected
+    to the signals. Instead they're called directly, and only for timeline entries with one of
+    the provided operations, for items of one of the provided content types.
+    The remaining callbacks are connected to the signals using ``connect_stats_signals``.
+
+    Example:
+    ::
+
+        from analytics.stats.gen_archive_statistics import register_stats_plugin
+
+        register_stats_plugin(
+            operations=[OPERATION.PUBLISH, OPERATION.CORRECT],
+            content_types=[CONTENT_TYPE.TEXT],
+            on_init_timeline=on_init_timeline,
+            on_process=on_process_stats,
+        )
+
+    :param list operations: The operations handled by the plugin (defaults to all operations)
+    :param list content_types: The item content types handled by the plugin (defaults to all types)
+    :param on_generate: Callback for the generate stage
+    :param on_process: Callback for the process stage
+    :param kwargs: Callbacks for the remaining signals, passed to ``connect_stats_signals``
+    """
+
+    handler_filter = {
+        "operations": set(operations) if operations else None,
+        "content_types": set(content_types) if content_types else None,
+    }
+
+    if on_generate:
+        stats_plugin_handlers["generate"].append(dict(handler_filter, handler=on_generate))
+
+    if on_process:
+        stats_plugin_handlers["process"].append(dict(handler_filter, handler=on_process))
+
+    connect_stats_signals(**kwargs)
+
+
+def build_dispatch_table():
+    """Returns the registered handlers for each stage, keyed by the operation
+
+    Handlers for operations that are not in the table are stored under the ``None`` key
+    """
+
+    table = {}
+
+    for stage, handlers in stats_plugin_handlers.items():
+        operations = set()
+        for handler in handlers:
+            operations.update(handler["operations"] or [])
+
+        table[stage] = {
+            operation: [
+                handler for handler in handlers if handler["operations"] is None or operation in handler["operations"]
+            ]
+            for operation in operations
+        }
+        table[stage][None] = [handler for handler in handlers if handler["operations"] is None]
+
+    return table
+
+
+def get_receiver_plugin(receiver):
+    """Returns the name of the plugin a signal receiver belongs to (the class of its instance, or its module)"""
+
+    owner = getattr(receiver, "__self__", None)
+
+    if owner is not None:
+        return "{}.{}".format(type(owner).__module__, type(owner).__qualname__)
+
+    return getattr(receiver, "__module__", None) or repr(receiver)
+
 
 def connect_stats_signals(
     on_start=None,
@@ -50,6 +237,8 @@ def connect_stats_signals(
     on_process=None,
     on_complete=None,
     on_finish=None,
+    on_resume_timeline=None,
+    on_processed=None,
 ):
     """Connect functions to the gen_stats_signals
 
@@ -59,6 +248,8 @@ def connect_stats_signals(
     :param on_process: Callback for process signal
     :param on_complete: Callback for complete signal
     :param on_finish: Callback for finish signal
+    :param on_resume_timeline: Callback for resume_timeline signal
+    :param on_processed: Callback for processed signal
     """
     if on_start:
         gen_stats_signals["start"].connect(on_start)
@@ -69,12 +260,18 @@ def connect_stats_signals(
     if on_init_timeline:
         gen_stats_signals["init_timeline"].connect(on_init_timeline)
 
+    if on_resume_timeline:
+        gen_stats_signals["resume_timeline"].connect(on_resume_timeline)
+
     if on_process:
         gen_stats_signals["process"].connect(on_process)
 
     if on_complete:
         gen_stats_signals["complete"].connect(on_complete)
 
+    if on_processed:
+        gen_stats_signals["processed"].connect(on_processed)
+
     if on_finish:
         gen_stats_signals["finish"].connect(on_finish)
 
@@ -94,10 +291,18 @@ class GenArchiveStatistics(Command):
         Generate statistics for a single archive item only
         -c, --chunk-size (defaults to 1000):
         Number of archive history items to process per iteration
+        -w, --workers (defaults to 1):
+        Number of processes used to generate the statistics of each chunk
+        -t, --time-budget (defaults to ANALYTICS_STATS_TIME_BUDGET config):
+        Number of seconds after which no more chunks are processed (0 = no limit)
 
     If the config option ANALYTICS_ENABLE_ARCHIVE_STATS is true, this command will run in
     celery on a schedule every hour (minute=0).
 
+    The id of the last processed history item is stored after every chunk, so the next run
+    continues from there if this run is stopped. Once the time budget has been used, the
+    current chunk is completed and the run stops, before the celery task reaches its time limit.
+
     Example:
     ::
 
@@ -108,6 +313,8 @@ class GenArchiveStatistics(Command):
         $ python manage.py analytics:gen_archive_statistics -item-id 'id-of-item-to-gen-stats-for'
         $ python manage.py analytics:gen_archive_statistics -c 500
         $ python manage.py analytics:gen_archive_statistics -chunk-size 500
+        $ python manage.py analytics:gen_archive_statistics -w 4
+        $ python manage.py analytics:gen_archive_statistics --workers 4
 
     There are 4 signals that are sent when generating statistics.
     This allows custom statistics to be generated and stored in the item.
@@ -122,17 +329,52 @@ class GenArchiveStatistics(Command):
         # or by key values
         connect_stats_signals(on_process=on_process_stats)
 
+    Plugins that only handle specific operations or content types should be registered using
+    ``register_stats_plugin`` instead, so their generate/process handlers are only called
+    for the timeline entries they handle.
+
+    The temporary attributes of the updates (attributes starting with an underscore) are stored
+    with the item under 'timeline_state'. On the next run, only the new history entries are processed,
+    continuing from this stored state. Instead of the 'init_timeline' signal, the 'resume_timeline' signal
+    is sent in this case. If any plugin connects to 'init_timeline' but not 'resume_timeline',
+    or the new history occurred before the last processed entry, the full timeline is replayed.
+    This can be disabled with the config option ANALYTICS_STATS_INCREMENTAL=False.
+
+    When using more than 1 worker, the items of each chunk are split across a pool of processes.
+    The 'generate', 'init_timeline', 'resume_timeline', 'process' and 'complete' signals are then sent
+    from within the worker processes, so any state kept by their receivers is not available to the main process.
+    The 'start', 'processed' and 'finish' signals are always sent from the main process, where 'processed'
+    is sent with the generated stats of each item (and can be used to collect state across items).
+
     """
 
     option_list = [
         Option("--max-days", "-d", dest="max_days", default=3),
         Option("--item-id", "-i", dest="item_id", default=None),
         Option("--chunk-size", "-c", dest="chunk_size", default=1000),
+        Option("--workers", "-w", dest="workers", default=1),
+        Option("--time-budget", "-t", dest="time_budget", default=None),
     ]
 
-    def run(self, max_days=3, item_id=None, chunk_size=1000):
+    workers = 1
+    pool = None
+    refresh = True
+    time_budget = 0
+    dispatch_table = None
+
+    # Set when the run stopped because the statistics were locked by another task, so it can be retried
+    busy = False
+
+    # The id of a full rebuild (see analytics:backfill_archive_statistics --full). Stored statistics that were not
+    # generated by this rebuild are ignored, and generated again from the history
+    full_replay = None
+
+    def run(self, max_days=3, item_id=None, chunk_size=1000, workers=1, time_budget=None):
         now_utc = utcnow()
 
+        # Build the dispatch table of the registered plugins for this run
+        self.dispatch_table = build_dispatch_table()
+
         # If we're generating stats for a single item, then
         # don't set max_days, as we want to process all history records
         # for the provided item
@@ -151,15 +393,31 @@ class GenArchiveStatistics(Command):
             chunk_size = 1000
         chunk_size = None if chunk_size <= 0 else chunk_size
 
+        try:
+            self.workers = max(int(workers), 1)
+        except (ValueError, TypeError):
+            self.workers = 1
+
+        if time_budget is None:
+            time_budget = app.config.get("ANALYTICS_STATS_TIME_BUDGET", 480)
+
+        try:
+            self.time_budget = max(float(time_budget), 0)
+        except (ValueError, TypeError):
+            self.time_budget = 0
+
         logger.info(
-            "Starting to generate archive statistics: {}. gte={}. item_id={}. chunk_size={}".format(
-                now_utc, gte, item_id, chunk_size
+            "Starting to generate archive statistics: {}. gte={}. item_id={}. chunk_size={}. workers={}".format(
+                now_utc, gte, item_id, chunk_size, self.workers
             )
         )
 
+        # The streaming task holds the lock while it processes a batch, so wait for it before giving up.
+        # The celery task is then retried (see ``busy``), so the history is not left until the next hour
         lock_name = get_lock_id("analytics", "gen_archive_statistics")
-        if not lock(lock_name, expire=610):
-            logger.info("Generate archive statistics task is already running.")
+        if not wait_for_lock(lock_name, LOCK_WAIT):
+            logger.info("Generate archive statistics task is already running, it will be retried later.")
+            self.busy = True
             return
 
         items_processed = 0
@@ -167,10 +425,12 @@ class GenArchiveStatistics(Command):
         num_history_items = 0
 
         try:
+            self.pool = self.get_worker_pool()
             items_processed, failed_ids, num_history_items = self.generate_stats(item_id, gte, chunk_size)
         except Exception:
             logger.exception("Failed to generate archive stats")
         finally:
+            self.close_worker_pool()
             unlock(lock_name)
 
         if len(failed_ids) > 0:
@@ -183,6 +443,27 @@ class GenArchiveStatistics(Command):
             )
         )
 
+    def get_worker_pool(self):
+        """Returns a process pool used to generate the stats, or None if using a single worker
+
+        The processes are forked from this process, so the app and connected signals are available in them.
+        """
+
+        if self.workers < 2:
+            return None
+
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_stats_worker,
+            initargs=(app._get_current_object(),),
+        )
+
+    def close_worker_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
     def generate_stats(self, item_id, gte, chunk_size):
         items_processed = 0
         failed_ids = []
@@ -198,20 +479,33 @@ class GenArchiveStatistics(Command):
         if last_history.get("guid"):
             logger.info("Found previous run, continuing from history item {}".format(last_history["guid"]))
 
-        iterated_started = utcnow()
+        started = iterated_started = utcnow()
         for history_items in statistics_service.get_history_items(last_entry_id, gte, item_id, chunk_size):
             if len(history_items) < 1:
                 logger.info("No more history records to process")
                 break
 
-            gen_stats_signals["start"].send(self)
+            range_locks = lock_backfill_ranges(history_items)
+            if range_locks is None:
+                logger.info(
+                    "Items are locked by the backfill, continuing from history item {} later".format(last_entry_id)
+                )
+                self.busy = True
+                break
+
+            try:
+                gen_stats_signals["start"].send(self)
+
+                items = self.gen_history_timelines(history_items)
+                self.process_timelines(items, failed_ids)
+
+                gen_stats_signals["finish"].send(self)
+            finally:
+                unlock_all(range_locks)
 
             num_history_items += len(history_items)
             last_entry_id = history_items[-1].get(config.ID_FIELD)
-
-            items = self.gen_history_timelines(history_items)
             items_processed += len(items)
-            self.process_timelines(items, failed_ids)
 
             time_diff = (utcnow() - iterated_started).total_seconds()
             logger.info(
@@ -224,14 +518,24 @@ class GenArchiveStatistics(Command):
                 )
             )
 
-            gen_stats_signals["finish"].send(self)
             iterated_started = utcnow()
 
-        # Don't store the last processed id if we're generating stats for a single item
-        if not item_id:
-            # Create/Update the system record from this run
-            # Storing the id of the last processed archive_history item
-            statistics_service.set_last_run_id(last_entry_id, last_history)
+            # Don't store the last processed id if we're generating stats for a single item
+            if not item_id:
+                # Create/Update the system record after every chunk
+                # Storing the id of the last processed archive_history item
+                last_history = statistics_service.set_last_run_id(last_entry_id, last_history)
+
+            # Extend the lock, as we're still processing
+            touch(get_lock_id("analytics", "gen_archive_statistics"), expire=610)
+
+            if self.time_budget and (iterated_started - started).total_seconds() >= self.time_budget:
+                logger.info(
+                    "Time budget of {} seconds reached, continuing from history item {} on the next run".format(
+                        int(self.time_budget), last_entry_id
+                    )
+                )
+                break
 
         return items_processed, failed_ids, num_history_items
 
@@ -240,30 +544,42 @@ class GenArchiveStatistics(Command):
 
         statistics_service = get_resource_service("archive_statistics")
 
+        # Load the existing statistics for all items in this chunk in a single query
+        # instead of querying for each item individually
+        existing_items = statistics_service.get_items_by_ids([history.get("item_id") for history in history_items])
+
         def add_item(entry_id):
             if items.get(entry_id):
                 return
 
-            item = statistics_service.find_one(req=None, _id=str(entry_id)) or {}
+            item = existing_items.get(str(entry_id)) or {}
+            stored = None
+
+            if self.full_replay and item and (item.get("timeline_state") or {}).get("full_replay") != self.full_replay:
+                # Rebuild the stats from an empty document, ignoring the stored stats and timeline state
+                stored, item = item, {}
 
             if not item.get("stats"):
                 item["stats"] = {}
 
-            items[entry_id] = {"item": item, "_id": entry_id, "updates": {"stats": {}}}
+            # Copy the stored stats, so the original document is left intact
+            # and can be compared against when writing the updates
+            items[entry_id] = {"item": item, "_id": entry_id, "updates": dict(item), "stored": stored}
+            items[entry_id]["updates"]["stats"] = dict(item["stats"])
 
-            items[entry_id]["updates"].update(item)
+            if self.full_replay:
+                items[entry_id]["updates"]["_full_replay"] = self.full_replay
 
-            def _set_timeline_processed(entry):
-                entry["_processed"] = True
-                return entry
+            def _copy_processed_entry(entry):
+                processed = dict(entry)
+                if "task" in entry:
+                    processed["task"] = dict(entry["task"])
+                processed["_processed"] = True
+                return processed
 
-            items[entry_id]["updates"]["stats"].update(
-                {
-                    STAT_TYPE.TIMELINE: [
-                        _set_timeline_processed(entry) for entry in item["stats"].get(STAT_TYPE.TIMELINE) or []
-                    ]
-                }
-            )
+            items[entry_id]["updates"]["stats"][STAT_TYPE.TIMELINE] = [
+                _copy_processed_entry(entry) for entry in item["stats"].get(STAT_TYPE.TIMELINE) or []
+            ]
 
         for history_item in history_items:
             item_id = history_item.get("item_id")
@@ -320,7 +636,7 @@ class GenArchiveStatistics(Command):
 
             # Copy the original history entry for the MOVE_TO entry
             # Assign the new task details to this entry
-            entry = deepcopy(entry)
+            entry = dict(entry)
             entry["operation"] = OPERATION.MOVE_TO
             entry["task"] = task
             entry["_auto_generated"] = True
@@ -406,40 +722,43 @@ class GenArchiveStatistics(Command):
 
     def process_timelines(self, items, failed_ids):
         statistics_service = get_resource_service("archive_statistics")
-        items_to_create = []
+        writer = StatsBulkWriter(refresh=self.refresh)
         rewrites = []
 
+        gen_failures = self.gen_stats_from_timelines(items)
+
         for item_id, item in items.items():
-            try:
-                self.gen_stats_from_timeline(item)
-            except Exception:
-                logger.exception("Failed to generate stats for item {}".format(item_id))
+            if item_id in gen_failures:
                 failed_ids.append(item_id)
                 continue
 
+            gen_stats_signals["processed"].send(self, orig=item, updates=item["updates"])
+
             if item["updates"].get("rewrite_of") and (item["updates"].get("time_to_first_publish") or 0) > 0:
                 rewrites.append(item_id)
 
-            if not item["item"].get(config.ID_FIELD):
+            if item.get("stored") is not None:
+                # Replace the stored document, so no attributes from the previous stats are kept
+                item["updates"][config.ID_FIELD] = item_id
+                item["updates"]["stats_type"] = "archive"
+                writer.replace(item["updates"], item["stored"])
+            elif not item["item"].get(config.ID_FIELD):
                 item["updates"][config.ID_FIELD] = item_id
                 item["updates"]["stats_type"] = "archive"
-                items_to_create.append(item["updates"])
+                writer.create(item["updates"])
             else:
-                try:
-                    statistics_service.patch(item_id, item["updates"])
-                except Exception:
-                    logger.exception(
-                        "Failed to update stats for item {}. updates={}".format(item_id, item.get("updates"))
-                    )
-                    failed_ids.append(item_id)
+                writer.update(item_id, item["updates"], item["item"])
 
-        if len(items_to_create) > 0:
-            try:
-                statistics_service.post(items_to_create)
-            except Exception:
-                item_ids = [item.get(config.ID_FIELD) for item in items_to_create]
-                logger.exception("Failed to create stat entries for items {}".format(", ".join(item_ids)))
-                failed_ids.extend(failed_ids)
+        # Write all creates and updates for this chunk using a single bulk request
+        write_failures = writer.flush()
+        failed_ids.extend(write_failures)
+
+        rewrites = [item_id for item_id in rewrites if item_id not in write_failures]
+
+        # Load the originals of all rewrites in this chunk using a single query
+        originals = statistics_service.get_items_by_ids(
+            [items[item_id]["updates"].get("rewrite_of") for item_id in rewrites]
+        )
 
         for item_id in rewrites:
             item = items[item_id]
@@ -454,7 +773,7 @@ class GenArchiveStatistics(Command):
                 logger.warning("Failed {}, original_id not defined".format(item_id))
                 continue
 
-            original = statistics_service.find_one(req=None, _id=original_id)
+            original = originals.get(original_id)
             if not original:
                 logger.warning("Failed {}, original not found".format(item_id))
                 continue
@@ -464,12 +783,60 @@ class GenArchiveStatistics(Command):
                 logger.warning("Failed {}, published_at not defined".format(original_id))
                 continue
 
-            statistics_service.patch(
+            writer.update(
                 original_id,
                 {"time_to_next_update_publish": (updated_at - published_at).total_seconds()},
+                original,
             )
 
-    def _store_update_fields(self, entry):
+        writer.flush()
+
+    def gen_stats_from_timelines(self, items):
+        """Generates the stats for all items of a chunk
+
+        If there is a worker pool, the items are split evenly across the workers,
+        and the generated updates are merged back into the items.
+
+        :param dict items: The items to generate stats for, keyed by their id
+        :return set: The ids of the items that failed to generate stats
+        """
+
+        if self.pool is None or len(items) < 2:
+            return {item_id for item_id, updates in _gen_stats_for_items(self, items.values()) if updates is None}
+
+        item_list = list(items.values())
+        workers = self.workers
+        partitions = [item_list[index::workers] for index in range(workers)]
+        failed_ids = set()
+
+        for results in self.pool.map(_gen_stats_in_worker, [partition for partition in partitions if partition]):
+            for item_id, updates in results:
+                if updates is None:
+                    failed_ids.add(item_id)
+                else:
+                    items[item_id]["updates"] = updates
+
+        return failed_ids
+
+    def dispatch(self, stage, operation, content_type, **kwargs):
+        """Call the registered plugin handlers of the stage, for the operation and content type
+
+        :param str stage: The stage to call the handlers for (generate or process)
+        :param str operation: The operation of the timeline entry
+        :param str content_type: The content type of the item
+        :param kwargs: The arguments passed to the handlers
+        """
+
+        if self.dispatch_table is None:
+            self.dispatch_table = build_dispatch_table()
+
+        handlers = self.dispatch_table[stage]
+
+        for handler in handlers.get(operation, handlers[None]):
+            if handler["content_types"] is None or content_type in handler["content_types"]:
+                handler["handler"](self, **kwargs)
+
+    def _store_update_fields(self, entry, updates=None):
         update = {}
 
         if entry.get("operation") in [OPERATION.ITEM_LOCK, OPERATION.ITEM_UNLOCK]:
@@ -478,6 +845,13 @@ class GenArchiveStatistics(Command):
 
         desk_transitions.store_update_fields(entry, update)
         gen_stats_signals["generate"].send(self, entry=entry, update=update)
+        self.dispatch(
+            "generate",
+            entry.get("operation"),
+            (updates or {}).get(ITEM_TYPE) or CONTENT_TYPE.TEXT,
+            entry=entry,
+            update=update,
+        )
 
         if update:
             entry["update"] = update
@@ -494,10 +868,6 @@ class GenArchiveStatistics(Command):
         if len(stats.get(STAT_TYPE.TIMELINE) or []) < 1:
             return
 
-        new_timeline = []
-        desk_transitions.init(stats)
-        gen_stats_signals["init_timeline"].send(self, stats=stats)
-
         try:
             entries = sorted(
                 stats[STAT_TYPE.TIMELINE],
@@ -507,13 +877,36 @@ class GenArchiveStatistics(Command):
             logger.exception("Failed to sort timeline {}".format(stats[STAT_TYPE.TIMELINE]))
             raise e
 
-        # If the first history item has original_item_id attribute,
-        # then this item is a duplicate of another item
-        updates["_duplicate"] = entries[0].get("original_item_id")
+        resume_entries = self.get_resume_entries(item, stats[STAT_TYPE.TIMELINE])
+
+        if resume_entries is not None:
+            # Continue processing from the stored state of the item
+            # Only the new entries are processed, the stored timeline is kept as is
+            new_timeline = [entry for entry in stats[STAT_TYPE.TIMELINE] if entry.get("_processed")]
+            entries = resume_entries
+            self.restore_timeline_state(item)
+
+            desk_transitions.resume(stats)
+            gen_stats_signals["resume_timeline"].send(self, stats=stats)
+        else:
+            new_timeline = []
+            desk_transitions.init(stats)
+            gen_stats_signals["init_timeline"].send(self, stats=stats)
+
+            # The plugins whose state is stored with the timeline state, so it can only be resumed by the same plugins
+            updates["_plugins"] = sorted(self.get_signal_plugins("init_timeline"))
 
-        # Default the paragraph count to 0
-        # We'll update this count while processing the timeline
-        updates["par_count"] = 0
+            # If the first history item has original_item_id attribute,
+            # then this item is a duplicate of another item
+            updates["_duplicate"] = entries[0].get("original_item_id")
+
+            # Default the paragraph count to 0
+            # We'll update this count while processing the timeline
+            updates["par_count"] = 0
+
+            # Keep the cached paragraph counts, so unchanged bodies are not parsed again
+            stored_state = (item.get("item") or {}).get("timeline_state") or {}
+            updates["_par_counts"] = trim_par_counts(dict(stored_state.get("par_counts") or {}))
 
         for entry in entries:
             entry.setdefault("update", {})
@@ -525,16 +918,17 @@ class GenArchiveStatistics(Command):
 
             # Remove the update attribute before adding to the timeline
             update = entry.get("update") or {}
-            self._store_update_fields(entry)
+            self._store_update_fields(entry, updates)
 
             # Update the paragraph count from this history entry
             self.update_par_count_from_timeline_entry(entry, updates, update)
 
             new_timeline.append(entry)
+            self.set_last_history(entry, updates)
 
             # Use a copy of entry after adding to the timeline
             # So that any changes from here do not modify the existing timeline entry
-            entry = deepcopy(entry)
+            entry = copy_timeline_entry(entry)
 
             operation = entry.get("operation")
             operation_created = entry.get("operation_created")
@@ -555,6 +949,18 @@ class GenArchiveStatistics(Command):
                 update=update,
                 stats=stats,
             )
+            self.dispatch(
+                "process",
+                operation,
+                updates.get(ITEM_TYPE) or CONTENT_TYPE.TEXT,
+                entry=entry,
+                new_timeline=new_timeline,
+                updates=updates,
+                update=update,
+                stats=stats,
+            )
+
+        self.complete_par_count(updates)
 
         desk_transitions.complete(stats, updates)
         gen_stats_signals["complete"].send(self, stats=stats, orig=item, updates=updates)
@@ -568,10 +974,122 @@ class GenArchiveStatistics(Command):
 
         stats[STAT_TYPE.TIMELINE] = [_remove_tmp_fields(entry) for entry in new_timeline]
 
+        if app.config.get("ANALYTICS_STATS_COMPACT_TIMELINE", False):
+            # Only store the attributes of the updates that are used by the stats and reports
+            compact_stats(stats)
+
+        self.store_timeline_state(item)
+
         for key in list(updates.keys()):
             if key.startswith("_"):
                 updates.pop(key)
 
+    def get_resume_entries(self, item, timeline):
+        """Returns the new timeline entries to process, if processing can continue from the stored state
+
+        Processing can only be resumed if the item has a stored timeline state, all plugins
+        connected to the ``init_timeline`` signal also support the ``resume_timeline`` signal
+        and were connected when the state was stored, and all new entries occurred after the last processed entry.
+
+        :param dict item: The item to generate stats for
+        :param list timeline: The stored and new timeline entries of the item
+        :return list: The sorted new entries to process, or None if the full timeline must be replayed
+        """
+
+        if not app.config.get("ANALYTICS_STATS_INCREMENTAL", True):
+            return None
+
+        state = (item.get("item") or {}).get("timeline_state")
+        if not state:
+            return None
+
+        # Every plugin must support resuming, and its state must have been stored with the timeline state
+        # (plugins connected since the state was stored have to see the full timeline)
+        plugins = self.get_signal_plugins("init_timeline")
+        if not plugins <= self.get_signal_plugins("resume_timeline") or not plugins <= set(state.get("plugins") or []):
+            return None
+
+        processed = [entry for entry in timeline if entry.get("_processed")]
+        if not processed:
+            return None
+
+        def get_key(entry):
+            return entry["operation_created"], entry["history_id"]
+
+        # The high-water mark of the processed history (stats generated before it was stored use the timeline)
+        last_entry = state.get("last_history") or max(processed, key=get_key)
+        last_key = get_key(last_entry)
+
+        # Don't process history entries again that have already been processed
+        processed_ids = {entry.get("history_id") for entry in processed if get_key(entry) <= last_key}
+        entries = sorted(
+            [
+                entry
+                for entry in timeline
+                if not entry.get("_processed")
+                and not (get_key(entry) <= last_key and (entry.get("history_id") or None) in processed_ids)
+            ],
+            key=get_key,
+        )
+
+        if entries and get_key(entries[0]) < last_key:
+            logger.info("Out of order history found for item {}, replaying the full timeline".format(item.get("_id")))
+            return None
+
+        return entries
+
+    def get_signal_plugins(self, name):
+        """Returns the names of the plugins connected to the signal"""
+
+        return {get_receiver_plugin(receiver) for receiver in gen_stats_signals[name].receivers_for(self)}
+
+    def restore_timeline_state(self, item):
+        """Restores the temporary attributes stored from the previous run into the updates"""
+
+        state = (item.get("item") or {}).get("timeline_state") or {}
+
+        for key, value in state.items():
+            if key == "processed_ids":
+                # No longer stored, replaced by the last_history high-water mark
+                continue
+
+            # Copy the values, so the original document is not modified
+            if isinstance(value, dict):
+                value = dict(value)
+            elif isinstance(value, list):
+                value = list(value)
+
+            item["updates"]["_{}".format(key)] = value
+
+    def store_timeline_state(self, item):
+        """Stores the temporary attributes of the updates, so the next run can continue from this state
+
+        This includes the last known task, the current desk transition, the last processed history entry,
+        and any temporary attributes created by plugins (i.e. the current featuremedia).
+        The ids of the processed history are only used during this run, so the state doesn't grow with the history.
+        """
+
+        original = item.get("item") or {}
+        updates = item["updates"]
+
+        updates["timeline_state"] = {
+            key[1:]: value
+            for key, value in updates.items()
+            if key.startswith("_") and key not in original and key != "_processed_ids"
+        }
+
+    def set_last_history(self, entry, updates):
+        """Keeps the high-water mark of the processed history, used to resume on the next run"""
+
+        if entry.get("history_id") is None or entry.get("_auto_generated"):
+            return
+
+        last_history = updates.get("_last_history")
+        key = (entry["operation_created"], entry["history_id"])
+
+        if not last_history or key > (last_history["operation_created"], last_history["history_id"]):
+            updates["_last_history"] = {"operation_created": key[0], "history_id": key[1]}
+
     def set_timeline_entry_task_details(self, entry, updates):
         """Calculate the desk, stage and user for this entry"""
 
@@ -594,7 +1112,7 @@ class GenArchiveStatistics(Command):
 
         # Store temporary attribute for storing ids of history records
         # that have already been processed (no duplicate history records in stats)
-        updates.setdefault("_processed_ids", [])
+        updates.setdefault("_processed_ids", set())
 
         # Skip history records that belong to the parent item
         # (history records are copied for duplicate items)
@@ -609,21 +1127,94 @@ class GenArchiveStatistics(Command):
             if entry["history_id"] in updates["_processed_ids"]:
                 return True
 
-            updates["_processed_ids"].append(entry["history_id"])
+            updates["_processed_ids"].add(entry["history_id"])
 
         return False
 
     def update_par_count_from_timeline_entry(self, entry, updates, update):
-        """Generate and store the paragraph count from body_html"""
+        """Generate and store the paragraph count from body_html
 
-        if len(update.get("body_html") or "") > 0:
-            entry["par_count"] = get_par_count(update["body_html"])
-            updates["par_count"] = entry["par_count"]
-        else:
-            entry["par_count"] = updates["par_count"]
+        If the config option ANALYTICS_STATS_PAR_COUNT_PUBLISH_ONLY is true, once the original count
+        is known the latest body is only counted for publish entries, and once the timeline has been
+        processed (see ``complete_par_count``). The par_count and original_par_count of the item are
+        the same either way, only the other timeline entries keep the last count that was generated.
+        """
+
+        if update.get("body_html"):
+            updates["_latest_body_html"] = update["body_html"]
+
+        if updates.get("_latest_body_html") and (
+            not app.config.get("ANALYTICS_STATS_PAR_COUNT_PUBLISH_ONLY", False)
+            or entry.get("operation") == OPERATION.PUBLISH
+            or "original_par_count" not in updates
+        ):
+            updates["par_count"] = self.get_par_count(updates.pop("_latest_body_html"), updates)
+
+        entry["par_count"] = updates["par_count"]
 
         if "original_par_count" not in updates and entry["par_count"] > 0:
             updates["original_par_count"] = entry["par_count"]
 
+    def complete_par_count(self, updates):
+        """Generate the paragraph count of the latest body, if it was not counted while processing the timeline"""
+
+        body_html = updates.pop("_latest_body_html", None)
+
+        if body_html:
+            updates["par_count"] = self.get_par_count(body_html, updates)
+
+            if "original_par_count" not in updates and updates["par_count"] > 0:
+                updates["original_par_count"] = updates["par_count"]
+
+    def get_par_count(self, body_html, updates):
+        """Returns the paragraph count of the body_html, using the counts cached by the hash of the body
+
+        The cache is stored with the timeline state of the item, and holds up to
+        ANALYTICS_STATS_PAR_COUNT_CACHE_SIZE (defaults to 50) counts per item.
+        """
+
+        par_counts = updates.setdefault("_par_counts", {})
+        key = blake2b(body_html.encode("utf-8"), digest_size=16).hexdigest()
+
+        if key not in par_counts:
+            par_counts[key] = get_par_count(body_html)
+            trim_par_counts(par_counts)
+
+        return par_counts[key]
+
+
+def trim_par_counts(par_counts):
+    """Removes the oldest counts from the cache, keeping up to ANALYTICS_STATS_PAR_COUNT_CACHE_SIZE (at least 1)"""
+
+    cache_size = max(int(app.config.get("ANALYTICS_STATS_PAR_COUNT_CACHE_SIZE", 50)), 1)
+
+    for old_key in list(par_counts.keys())[:-cache_size]:
+        par_counts.pop(old_key)
+
+    return par_counts
+
+
+def _gen_stats_for_items(generator, items):
+    results = []
+
+    for item in items:
+        try:
+            generator.gen_stats_from_timeline(item)
+            results.append((item["_id"], item["updates"]))
+        except Exception:
+            logger.exception("Failed to generate stats for item {}".format(item["_id"]))
+            results.append((item["_id"], None))
+
+    return results
+
+
+def _init_stats_worker(flask_app):
+    # Push an app context for the lifetime of the worker process
+    flask_app.app_context().push()
+
+
+def _gen_stats_in_worker(items):
+    return _gen_stats_for_items(GenArchiveStatistics(), items)
+
 
 command("analytics:gen_archive_statistics", GenArchiveStatistics())
@@ -0,0 +1,424 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+from superdesk.utc import utcnow
+from superdesk.text_utils import get_par_count
+from superdesk.celery_task_utils import get_lock_id
+from superdesk.lock import lock, unlock
+
+from analytics import init_app
+from analytics.stats.gen_archive_statistics import (
+    GenArchiveStatistics,
+    register_stats_plugin,
+    stats_plugin_handlers,
+    gen_stats_signals,
+    get_receiver_plugin,
+)
+from analytics.stats.bulk_writer import StatsBulkWriter, gen_delta_updates
+
+from bson import ObjectId
+from datetime import timedelta
+from pymongo.errors import BulkWriteError
+from unittest import mock
+
+
+def gen_history(item_id, history_id, operation="update", minutes=0):
+    return {
+        "_id": history_id,
+        "item_id": item_id,
+        "operation": operation,
+        "user_id": "user1",
+        "update": {"task": {"desk": "desk1", "stage": "stage1"}},
+        "version": 1,
+        "_created": utcnow() - timedelta(minutes=60 - minutes),
+    }
+
+
+class GenArchiveStatisticsTestCase(TestCase):
+    def setUp(self):
+        self.maxDiff = None
+
+        with self.app.app_context():
+            init_app(self.app)
+            self.service = get_resource_service("archive_statistics")
+
+            self.app.data.insert(
+                "archive_statistics",
+                [
+                    {"_id": "item{}".format(index), "stats_type": "archive", "stats": {"timeline": []}}
+                    for index in range(5)
+                ],
+            )
+
+    def test_gen_history_timelines_loads_existing_stats_in_one_query(self):
+        history_items = [
+            gen_history("item{}".format(index % 10), "history{}".format(index), minutes=index) for index in range(100)
+        ]
+
+        with self.app.app_context():
+            with mock.patch.object(self.service, "find", wraps=self.service.find) as find, mock.patch.object(
+                self.service, "find_one", wraps=self.service.find_one
+            ) as find_one:
+                items = GenArchiveStatistics().gen_history_timelines(history_items)
+
+        # One round trip per chunk, regardless of the number of distinct items
+        self.assertEqual(find.call_count, 1)
+        self.assertEqual(find_one.call_count, 0)
+
+        self.assertEqual(len(items), 10)
+        for index in range(10):
+            item = items["item{}".format(index)]
+            self.assertEqual(bool(item["item"].get("_id")), index < 5)
+            self.assertEqual(len(item["updates"]["stats"]["timeline"]), 10)
+
+    def test_process_timelines_writes_chunk_in_bulk(self):
+        history_items = [gen_history("item{}".format(index), "history{}".format(index), "create") for index in range(4)]
+        history_items[0]["item_id"] = "item_new"
+
+        with self.app.app_context():
+            command = GenArchiveStatistics()
+            items = command.gen_history_timelines(history_items)
+
+            failed_ids = []
+            collection = mock.MagicMock()
+            collection.bulk_write.side_effect = BulkWriteError(
+                {"writeErrors": [{"index": 1, "errmsg": "write failed"}]}
+            )
+
+            with mock.patch.object(StatsBulkWriter, "get_mongo_collection", return_value=collection), mock.patch(
+                "analytics.stats.bulk_writer.streaming_bulk", return_value=[]
+            ) as es_bulk:
+                command.process_timelines(items, failed_ids)
+
+        # Creates and updates are sent in a single request to Mongo and Elasticsearch
+        self.assertEqual(collection.bulk_write.call_count, 1)
+        self.assertEqual(es_bulk.call_count, 1)
+
+        requests = collection.bulk_write.call_args[0][0]
+        self.assertEqual(len(requests), 4)
+
+        # The item that failed in Mongo is reported, and not sent to Elasticsearch
+        self.assertEqual(failed_ids, ["item1"])
+        es_ids = [action["_id"] for action in es_bulk.call_args[0][1]]
+        self.assertEqual(sorted(es_ids), ["item2", "item3", "item_new"])
+
+    def test_gen_delta_updates(self):
+        entry1 = {"history_id": "h1", "operation": "create", "task": {"user": "user1"}}
+        entry2 = {"history_id": "h2", "operation": "update", "task": {"user": "user1"}}
+        original = {
+            "headline": "Test",
+            "par_count": 1,
+            "stats": {"timeline": [entry1], "desk_transitions": None},
+        }
+
+        # Only new timeline entries and changed fields are returned
+        fields, stats, timeline = gen_delta_updates(
+            original,
+            {
+                "headline": "Test",
+                "par_count": 2,
+                "stats": {"timeline": [dict(entry1), dict(entry2)], "desk_transitions": None},
+            },
+        )
+        self.assertEqual(fields, {"par_count": 2})
+        self.assertEqual(stats, {})
+        self.assertEqual(timeline, [entry2])
+
+        # If a previous timeline entry changed, then the entire timeline is returned
+        fields, stats, timeline = gen_delta_updates(
+            original,
+            {
+                "headline": "Test",
+                "par_count": 1,
+                "stats": {"timeline": [dict(entry1, par_count=1), entry2], "desk_transitions": [{"desk": "d1"}]},
+            },
+        )
+        self.assertEqual(fields, {})
+        self.assertEqual(stats, {"timeline": [dict(entry1, par_count=1), entry2], "desk_transitions": [{"desk": "d1"}]})
+        self.assertEqual(timeline, [])
+
+    def _gen_stats(self, history_items, original=None):
+        command = GenArchiveStatistics()
+        item = {"item": original or {"stats": {}}, "_id": "item1"}
+        item["updates"] = dict(item["item"])
+        item["updates"]["stats"] = dict(item["item"]["stats"])
+        item["updates"]["stats"]["timeline"] = [
+            dict(entry, task=dict(entry["task"]), _processed=True)
+            for entry in item["item"]["stats"].get("timeline") or []
+        ]
+
+        for history in history_items:
+            command.gen_archive_stats_from_history(item, dict(history, update=dict(history["update"])))
+
+        command.gen_stats_from_timeline(item)
+        return item["updates"]
+
+    def test_gen_stats_resumes_from_timeline_state(self):
+        history_items = [
+            gen_history("item1", "history0", "create", 0),
+            gen_history("item1", "history1", "update", 1),
+            gen_history("item1", "history2", "move", 2),
+            gen_history("item1", "history3", "update", 3),
+            gen_history("item1", "history4", "publish", 4),
+        ]
+        history_items[1]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p>"
+        history_items[2]["update"]["task"] = {"desk": "desk2", "stage": "stage2"}
+
+        with self.app.app_context():
+            full = self._gen_stats(history_items)
+
+            original = self._gen_stats(history_items[:3])
+            self.assertNotIn("processed_ids", original["timeline_state"])
+            self.assertEqual(original["timeline_state"]["last_history"]["history_id"], "history2")
+
+            with mock.patch.object(
+                GenArchiveStatistics,
+                "set_metadata_updates",
+                autospec=True,
+                side_effect=GenArchiveStatistics.set_metadata_updates,
+            ) as set_metadata:
+                resumed = self._gen_stats(history_items[2:], original)
+
+            # Only the new entries are processed (history2 has already been processed)
+            self.assertEqual(set_metadata.call_count, 2)
+
+        self.assertEqual(resumed["stats"], full["stats"])
+        self.assertEqual(resumed["timeline_state"], full["timeline_state"])
+        self.assertEqual(resumed["par_count"], full["par_count"])
+        self.assertEqual(resumed["num_desk_transitions"], 2)
+
+    def test_gen_stats_replays_timeline_for_new_plugins(self):
+        class TimelinePlugin:
+            def init(self, sender, stats):
+                pass
+
+            def resume(self, sender, stats):
+                pass
+
+        def resume_other_plugin(sender, stats):
+            pass
+
+        history_items = [
+            gen_history("item1", "history0", "create", 0),
+            gen_history("item1", "history1", "update", 1),
+            gen_history("item1", "history2", "publish", 2),
+        ]
+        plugin = TimelinePlugin()
+        init_timeline = gen_stats_signals["init_timeline"]
+        resume_timeline = gen_stats_signals["resume_timeline"]
+
+        with self.app.app_context():
+            original = self._gen_stats(history_items[:2])
+            self.assertNotIn(get_receiver_plugin(plugin.init), original["timeline_state"]["plugins"])
+
+            try:
+                # The plugin didn't see the stored timeline, so its state is not in the stored state
+                init_timeline.connect(plugin.init)
+                resume_timeline.connect(plugin.resume)
+
+                updates = self._gen_stats(history_items[2:], original)
+
+                self.assertIn(get_receiver_plugin(plugin.init), updates["timeline_state"]["plugins"])
+                self.assertIsNone(GenArchiveStatistics().get_resume_entries({"item": original}, []))
+
+                # A plugin that can't resume always replays the timeline, even if another plugin resumes twice
+                resume_timeline.disconnect(plugin.resume)
+                resume_timeline.connect(resume_other_plugin)
+                self.assertIsNone(
+                    GenArchiveStatistics().get_resume_entries(
+                        {"item": updates}, [dict(entry, _processed=True) for entry in updates["stats"]["timeline"]]
+                    )
+                )
+            finally:
+                init_timeline.disconnect(plugin.init)
+                resume_timeline.disconnect(plugin.resume)
+                resume_timeline.disconnect(resume_other_plugin)
+
+    def test_stream_history_items_in_chunks(self):
+        with self.app.app_context():
+            self.app.data.insert(
+                "archive_history",
+                [gen_history("item{}".format(index % 3), ObjectId(), minutes=index) for index in range(7)],
+            )
+
+            def get_ids(chunks):
+                return [[history["_id"] for history in chunk] for chunk in chunks]
+
+            with mock.patch.object(
+                self.service, "get_history_items_by_page", wraps=self.service.get_history_items_by_page
+            ) as get_by_page:
+                chunks = list(self.service.get_history_items(None, None, None, 3))
+
+            # All chunks are read from a single cursor
+            self.assertEqual(get_by_page.call_count, 0)
+            self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 1])
+            self.assertEqual(get_ids(chunks), get_ids(self.service.get_history_items_by_page(None, None, None, 3)))
+
+            # Continues from the last processed item
+            chunks = list(self.service.get_history_items(str(chunks[0][-1]["_id"]), None, "item1", 3))
+            self.assertEqual([len(chunk) for chunk in chunks], [1])
+            self.assertEqual(chunks[0][0]["item_id"], "item1")
+
+    def test_gen_stats_with_worker_pool_matches_serial(self):
+        history_items = [
+            gen_history(
+                "item{}".format(index % 6), "history{}".format(index), "create" if index < 6 else "update", index
+            )
+            for index in range(30)
+        ]
+        history_items[10]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p>"
+
+        with self.app.app_context():
+            serial = GenArchiveStatistics()
+            serial_items = serial.gen_history_timelines(history_items)
+            self.assertEqual(serial.gen_stats_from_timelines(serial_items), set())
+
+            parallel = GenArchiveStatistics()
+            parallel.workers = 2
+            parallel_items = parallel.gen_history_timelines(history_items)
+
+            parallel.pool = parallel.get_worker_pool()
+            try:
+                self.assertEqual(parallel.gen_stats_from_timelines(parallel_items), set())
+            finally:
+                parallel.close_worker_pool()
+
+        self.assertEqual(list(parallel_items.keys()), list(serial_items.keys()))
+        for item_id, item in serial_items.items():
+            self.assertEqual(parallel_items[item_id]["updates"], item["updates"])
+
+    def test_run_stores_last_run_after_each_chunk(self):
+        history_ids = [ObjectId() for index in range(5)]
+
+        with self.app.app_context():
+            self.app.data.insert(
+                "archive_history",
+                [gen_history("item_run", history_id, minutes=index) for index, history_id in enumerate(history_ids)],
+            )
+
+            with mock.patch.object(
+                self.service, "set_last_run_id", wraps=self.service.set_last_run_id
+            ) as set_last_run_id:
+                # Stops after the first chunk once the time budget has been used
+                GenArchiveStatistics().run(max_days=0, chunk_size=2, time_budget=0.000001)
+                self.assertEqual(set_last_run_id.call_count, 1)
+                self.assertEqual(self.service.get_last_run()["guid"], history_ids[1])
+
+                # The next run continues from the stored checkpoint
+                GenArchiveStatistics().run(max_days=0, chunk_size=2, time_budget=0)
+                self.assertEqual(set_last_run_id.call_count, 3)
+                self.assertEqual(self.service.get_last_run()["guid"], history_ids[4])
+
+            stats = self.service.find_one(req=None, _id="item_run")
+            self.assertEqual(len(stats["stats"]["timeline"]), 5)
+
+    def test_run_is_retried_when_locked(self):
+        with self.app.app_context():
+            self.app.data.insert("archive_history", [gen_history("item_locked", ObjectId(), "create")])
+
+            # i.e. the streaming task is processing a batch
+            lock_name = get_lock_id("analytics", "gen_archive_statistics")
+            self.assertTrue(lock(lock_name, expire=610))
+
+            try:
+                with mock.patch("analytics.stats.gen_archive_statistics.LOCK_WAIT", 0):
+                    command = GenArchiveStatistics()
+                    command.run(max_days=0)
+            finally:
+                unlock(lock_name)
+
+            self.assertTrue(command.busy)
+            self.assertIsNone(self.service.find_one(req=None, _id="item_locked"))
+
+            command = GenArchiveStatistics()
+            command.run(max_days=0)
+            self.assertFalse(command.busy)
+            self.assertIsNotNone(self.service.find_one(req=None, _id="item_locked"))
+
+    def test_par_count_is_cached_by_body(self):
+        history_items = [
+            gen_history("item1", "history{}".format(index), "create" if not index else "update", index)
+            for index in range(4)
+        ]
+        history_items[1]["update"]["body_html"] = "<p>Para 1</p>"
+        history_items[2]["update"]["body_html"] = "<p>Para 1</p>"
+        history_items[3]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p>"
+        history_items.append(gen_history("item1", "history4", "publish", 4))
+        history_items[4]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p>"
+
+        with self.app.app_context():
+            with mock.patch("analytics.stats.gen_archive_statistics.get_par_count", wraps=get_par_count) as par_count:
+                updates = self._gen_stats(history_items)
+
+            # Each distinct body is only parsed once
+            self.assertEqual(par_count.call_count, 2)
+            self.assertEqual([entry["par_count"] for entry in updates["stats"]["timeline"]], [0, 1, 1, 2, 2])
+            self.assertEqual(updates["par_count"], 2)
+            self.assertEqual(updates["original_par_count"], 1)
+            self.assertEqual(len(updates["timeline_state"]["par_counts"]), 2)
+
+            # Once the original count is known, only the publish entries and latest body are counted
+            history_items[3]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p><p>Para 3</p>"
+            history_items[4]["update"].pop("body_html")
+            history_items.append(gen_history("item1", "history5", "update", 5))
+            history_items[5]["update"]["body_html"] = "<p>Para 1</p><p>Para 2</p>"
+
+            with mock.patch.dict(self.app.config, {"ANALYTICS_STATS_PAR_COUNT_PUBLISH_ONLY": True}), mock.patch(
+                "analytics.stats.gen_archive_statistics.get_par_count", wraps=get_par_count
+            ) as par_count:
+                updates = self._gen_stats(history_items)
+
+            self.assertEqual(par_count.call_count, 3)
+            self.assertEqual([entry["par_count"] for entry in updates["stats"]["timeline"]], [0, 1, 1, 1, 3, 3])
+            self.assertEqual(updates["original_par_count"], 1)
+            self.assertNotIn("latest_body_html", updates["timeline_state"])
+
+            # The item's counts are the same as when every body is counted
+            expected = self._gen_stats(history_items)
+            self.assertEqual(updates["par_count"], expected["par_count"])
+            self.assertEqual(updates["original_par_count"], expected["original_par_count"])
+
+    def test_par_count_cache_is_capped(self):
+        history_items = [gen_history("item1", "history0", "create", 0)]
+
+        for index in range(1, 5):
+            history_items.append(gen_history("item1", "history{}".format(index), "update", index))
+            history_items[index]["update"]["body_html"] = "<p>Para</p>" * index
+
+        with self.app.app_context(), mock.patch.dict(self.app.config, {"ANALYTICS_STATS_PAR_COUNT_CACHE_SIZE": 2}):
+            updates = self._gen_stats(history_items)
+
+            self.assertEqual(updates["par_count"], 4)
+            self.assertEqual(len(updates["timeline_state"]["par_counts"]), 2)
+
+    def test_plugin_handlers_only_called_for_registered_operations(self):
+        history_items = [
+            gen_history("item1", "history0", "create", 0),
+            gen_history("item1", "history1", "update", 1),
+            gen_history("item1", "history2", "publish", 2),
+        ]
+
+        on_publish = mock.Mock()
+        on_picture = mock.Mock()
+        on_generate = mock.Mock()
+
+        with self.app.app_context(), mock.patch.dict(stats_plugin_handlers, {"generate": [], "process": []}):
+            register_stats_plugin(operations=["publish"], on_process=on_publish)
+            register_stats_plugin(content_types=["picture"], on_process=on_picture)
+            register_stats_plugin(on_generate=on_generate)
+
+            self._gen_stats(history_items)
+
+        self.assertEqual(on_publish.call_count, 1)
+        self.assertEqual(on_publish.call_args[1]["entry"]["operation"], "publish")
+        self.assertEqual(on_picture.call_count, 0)
+        self.assertEqual(on_generate.call_count, 3)
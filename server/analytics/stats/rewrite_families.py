@@ -0,0 +1,160 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.logging import logger
+
+from flask import current_app as app
+from collections import OrderedDict
+
+
+class RewriteFamilyResolver:
+    """Resolves the root item of rewrite families, using batched queries
+
+    The statistics of all ancestors of the provided items are loaded one generation at a time,
+    using a single ``$in`` query per generation (instead of one query per parent).
+    The ``rewrite_of`` links of resolved items are kept in an LRU cache across chunks
+    (ANALYTICS_STATS_REWRITE_CACHE_SIZE, defaults to 10000 links), so ancestors that were
+    resolved previously are not loaded again.
+
+    Example:
+    ::
+
+        resolver = RewriteFamilyResolver()
+        docs = resolver.load(["item3", "item4"])
+        root_id = resolver.get_root_id("item3")
+        families = resolver.get_family_docs([root_id])
+
+    """
+
+    def __init__(self, cache_size=None):
+        self.cache_size = cache_size
+        self.links = OrderedDict()
+        self.docs = {}
+
+    def get_cache_size(self):
+        if self.cache_size is None:
+            return app.config.get("ANALYTICS_STATS_REWRITE_CACHE_SIZE", 10000)
+
+        return self.cache_size
+
+    def _set_link(self, item_id, rewrite_of):
+        self.links[item_id] = rewrite_of or None
+        self.links.move_to_end(item_id)
+
+        while len(self.links) > self.get_cache_size():
+            self.links.popitem(last=False)
+
+    def load(self, item_ids):
+        """Loads the statistics of the items, along with any ancestors not already in the cache
+
+        :param list item_ids: The ids of the items to load
+        :return dict: The statistics of the requested items, keyed by their id
+        """
+
+        service = get_resource_service("archive_statistics")
+        self.docs = service.get_items_by_ids(item_ids)
+
+        for doc_id, doc in self.docs.items():
+            self._set_link(doc_id, doc.get("rewrite_of"))
+
+        requested = dict(self.docs)
+        missing = self._get_missing_ancestors(requested.keys())
+
+        while missing:
+            parents = service.get_items_by_ids(missing)
+
+            for doc_id, doc in parents.items():
+                self.docs[doc_id] = doc
+                self._set_link(doc_id, doc.get("rewrite_of"))
+
+            missing = self._get_missing_ancestors(parents.keys())
+
+        return requested
+
+    def _get_missing_ancestors(self, item_ids):
+        """Returns the ids of the closest ancestors that are neither loaded nor cached"""
+
+        missing = set()
+
+        for item_id in item_ids:
+            parent_id = self.links.get(item_id)
+            visited = {item_id}
+
+            while parent_id and parent_id not in visited:
+                visited.add(parent_id)
+
+                if parent_id not in self.links:
+                    if parent_id not in self.docs:
+                        missing.add(parent_id)
+                    break
+
+                parent_id = self.links[parent_id]
+
+        return list(missing)
+
+    def get_root_id(self, item_id):
+        """Returns the id of the first item in the rewrite family
+
+        :param str item_id: The id of the item
+        :return str: The id of the root item, or None if an ancestor was not found
+        """
+
+        visited = set()
+
+        while item_id not in visited:
+            visited.add(item_id)
+
+            if item_id not in self.links:
+                # Stats entry for the parent item was not found
+                logger.warn("Failed to get parent item {}".format(item_id))
+                return None
+
+            self.links.move_to_end(item_id)
+            parent_id = self.links[item_id]
+
+            if not parent_id:
+                return item_id
+
+            item_id = parent_id
+
+        logger.warn("Circular rewrite_of found for item {}".format(item_id))
+        return None
+
+    def get_family_docs(self, root_ids):
+        """Returns the archive_family statistics of the families, using a maximum of 2 queries
+
+        If the archive_family statistics do not exist, then the statistics of the root item are returned instead.
+
+        :param list root_ids: The ids of the root items
+        :return dict: Tuple of (statistics, is_new) keyed by the root id
+        """
+
+        service = get_resource_service("archive_statistics")
+        root_ids = list(root_ids)
+
+        family_docs = service.get_items_by_ids(["{}_family".format(root_id) for root_id in root_ids])
+        missing = [
+            root_id
+            for root_id in root_ids
+            if "{}_family".format(root_id) not in family_docs and root_id not in self.docs
+        ]
+        root_docs = service.get_items_by_ids(missing)
+
+        families = {}
+        for root_id in root_ids:
+            family_doc = family_docs.get("{}_family".format(root_id))
+
+            if family_doc:
+                families[root_id] = (family_doc, False)
+            else:
+                families[root_id] = (self.docs.get(root_id) or root_docs.get(root_id) or {}, True)
+
+        return families
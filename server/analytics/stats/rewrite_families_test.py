@@ -0,0 +1,66 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.stats.rewrite_families import RewriteFamilyResolver
+
+from unittest import mock
+
+
+class RewriteFamilyResolverTestCase(TestCase):
+    def setUp(self):
+        with self.app.app_context():
+            init_app(self.app)
+            self.service = get_resource_service("archive_statistics")
+
+            self.app.data.insert(
+                "archive_statistics",
+                [
+                    {"_id": "item1", "stats_type": "archive"},
+                    {"_id": "item2", "stats_type": "archive", "rewrite_of": "item1"},
+                    {"_id": "item3", "stats_type": "archive", "rewrite_of": "item2"},
+                    {"_id": "item4", "stats_type": "archive", "rewrite_of": "item3"},
+                    {"_id": "item5", "stats_type": "archive", "rewrite_of": "item_missing"},
+                    {"_id": "item6", "stats_type": "archive"},
+                    {"_id": "item6_family", "stats_type": "archive_family"},
+                ],
+            )
+
+    def test_resolve_families(self):
+        with self.app.app_context():
+            resolver = RewriteFamilyResolver()
+
+            with mock.patch.object(self.service, "find", wraps=self.service.find) as find:
+                docs = resolver.load(["item4", "item3", "item5", "item6"])
+
+            # One query for the items, then one per generation of ancestors
+            self.assertEqual(sorted(docs.keys()), ["item3", "item4", "item5", "item6"])
+            self.assertEqual(find.call_count, 3)
+
+            self.assertEqual(resolver.get_root_id("item4"), "item1")
+            self.assertEqual(resolver.get_root_id("item3"), "item1")
+            self.assertEqual(resolver.get_root_id("item6"), "item6")
+            self.assertIsNone(resolver.get_root_id("item5"))
+
+            # Ancestors resolved previously are not loaded again
+            with mock.patch.object(self.service, "find", wraps=self.service.find) as find:
+                resolver.load(["item4"])
+
+            self.assertEqual(find.call_count, 1)
+            self.assertEqual(resolver.get_root_id("item4"), "item1")
+
+            families = resolver.get_family_docs(["item1", "item6"])
+            self.assertEqual(families["item1"][0]["_id"], "item1")
+            self.assertTrue(families["item1"][1])
+            self.assertEqual(families["item6"][0]["_id"], "item6_family")
+            self.assertFalse(families["item6"][1])
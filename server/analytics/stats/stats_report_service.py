@@ -8,16 +8,136 @@
 # AUTHORS and LICENSE files distributed with this source code, or
 # at https://www.sourcefabric.org/superdesk/license
 
+from superdesk.logging import logger
+
 from flask import current_app as app
+from eve_elastic.elastic import fix_query
+
 from analytics.base_report import BaseReportService
+from analytics.base_report.report_cache import cache_enabled, invalidate
+from analytics.stats.gen_archive_statistics import connect_stats_signals
+from analytics.stats.archive_statistics_partitions import StatsPartitions, partitions_enabled, get_search_partitions
+
+
+def invalidate_stats_reports(sender=None):
+    """Invalidates the cached statistics reports, once new statistics have been written"""
+
+    if cache_enabled():
+        invalidate("stats")
+
+
+connect_stats_signals(on_finish=invalidate_stats_reports)
 
 
 class StatsReportService(BaseReportService):
     repos = ["archive_statistics"]
+    cache_group = "stats"
+
+    # Reports that build their tables from the hits stream them using search_after (see use_stream_hits)
+    stream_hits = False
+
+    def get_cache_extra(self, args):
+        # The statistics are not filtered by the stages of the items
+        return {"repos": self.repos}
 
     def get_elastic_index(self, types):
         return app.config.get("STATISTICS_ELASTIC_INDEX") or app.config.get("STATISTICS_MONGO_DBNAME") or "statistics"
 
+    def get_partition_indices(self, types, args):
+        """Returns the monthly partitions that can contain documents in the date range of the report
+
+        Returns None if the statistics are not partitioned, or all partitions need to be searched
+        """
+        if not partitions_enabled() or types != ["archive_statistics"]:
+            return None
+
+        lt, gte, time_zone = self._es_get_date_filters(args.get("params") or {})
+        partitions = get_search_partitions(self.date_filter_field, gte, lt)
+
+        if partitions is None:
+            return None
+
+        return StatsPartitions(types[0]).get_search_indices(partitions)
+
+    def get_search_indices(self, types, args):
+        return self.get_partition_indices(types, args) or super().get_search_indices(types, args)
+
+    def search_elastic(self, query, types, args):
+        indices = self.get_partition_indices(types, args)
+
+        if indices is None:
+            return super().search_elastic(query, types, args)
+
+        elastic = app.data.elastic
+        hits = elastic.elastic(types[0]).search(body=fix_query(query), index=indices, ignore_unavailable=True)
+
+        return elastic._parse_hits(hits, types[0])
+
+    def use_stream_hits(self, query, args):
+        """Returns True if the hits of the query are streamed using search_after (see iter_hits)
+
+        Paged requests (i.e. the Update Time table) use from/size instead, so the response includes
+        the total number of hits. The hits are only streamed for the exported outputs (highcharts_config,
+        CSV or HTML), or when a page size is not requested.
+        """
+        if not self.stream_hits or self.is_aggregation_query(query, args) or int(args.get("include_items") or 0):
+            return False
+
+        return args.get("return_type") not in [None, "aggregations"] or not query.get("size")
+
+    def execute_query(self, query, types, args):
+        if self.use_stream_hits(query, args):
+            return self.iter_hits(query, types, args)
+
+        return super().execute_query(query, types, args)
+
+    def get_stream_sort(self, query):
+        """Returns the sort of the query, with the _id added so no hits are skipped or repeated between pages
+
+        The guid is not unique, as the archive_family statistics use the guid of the item.
+        """
+        sort = list(query.get("sort") or [{self.date_filter_field: "desc"}])
+
+        if "_id" not in [next(iter(field)) if isinstance(field, dict) else field for field in sort]:
+            sort.append({"_id": "asc"})
+
+        return sort
+
+    def iter_hits(self, query, types, args):
+        """Yields the hits of the query, requesting the next page using search_after
+
+        Only a page of hits is loaded at a time (config ANALYTICS_STATS_STREAM_SIZE), and the hits are
+        yielded in the sort order of the query. The hits are not limited, unless ANALYTICS_STATS_STREAM_MAX_HITS
+        is configured (a warning is logged when the report is limited).
+        As with the aggregation queries, the fetch hooks of the resources are not called.
+
+        :param dict query: The Elasticsearch query
+        :param list types: The repos to search
+        :param dict args: The arguments of the report request
+        """
+        page_size = int(app.config.get("ANALYTICS_STATS_STREAM_SIZE", 500))
+        max_hits = int(app.config.get("ANALYTICS_STATS_STREAM_MAX_HITS") or 0)
+        query = dict(query, size=page_size, sort=self.get_stream_sort(query))
+        query.pop("from", None)
+        num_hits = 0
+
+        while True:
+            docs = self.search_elastic(query, types, args)
+            hits = (docs.hits.get("hits") or {}).get("hits") or []
+
+            for doc in docs:
+                if max_hits and num_hits >= max_hits:
+                    logger.warning("Report {} is limited to the first {} hits".format(self.datasource, max_hits))
+                    return
+
+                num_hits += 1
+                yield doc
+
+            if len(hits) < page_size:
+                return
+
+            query["search_after"] = hits[-1]["sort"]
+
     def get_es_stats_type(self, query, params):
         query["must"].append({"term": {"stats_type": "archive"}})
 
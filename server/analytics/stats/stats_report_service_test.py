@@ -0,0 +1,105 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2019 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_backend
+from superdesk.tests import TestCase
+
+from analytics.stats.stats_report_service import StatsReportService
+from analytics.update_time_report.update_time_report import UpdateTimeReportService
+
+from eve_elastic.elastic import ElasticCursor
+from unittest import mock
+
+
+def gen_page(ids, total=None):
+    return ElasticCursor(
+        {
+            "hits": {
+                "total": len(ids) if total is None else total,
+                "hits": [
+                    {"_id": item_id, "_type": "archive_statistics", "_source": {}, "sort": [item_id]} for item_id in ids
+                ],
+            }
+        }
+    )
+
+
+class StatsReportServiceTestCase(TestCase):
+    def test_iter_hits_pages_using_search_after(self):
+        with self.app.app_context(), mock.patch.dict(self.app.config, {"ANALYTICS_STATS_STREAM_SIZE": 2}):
+            service = StatsReportService("archive_statistics", backend=get_backend())
+            service.stream_hits = True
+
+            query = {"query": {"match_all": {}}, "sort": [{"versioncreated": "desc"}], "size": 10, "from": 0}
+            pages = [gen_page(["item1", "item2"]), gen_page(["item3", "item4"]), gen_page(["item5"])]
+            args = {"return_type": "highcharts_config"}
+
+            with mock.patch.object(service, "search_elastic", side_effect=pages) as search_elastic:
+                docs = service.execute_query(query, ["archive_statistics"], args)
+
+                # The hits are only requested as they are consumed
+                self.assertEqual(search_elastic.call_count, 0)
+                self.assertEqual([doc["_id"] for doc in docs], ["item1", "item2", "item3", "item4", "item5"])
+
+            self.assertEqual(search_elastic.call_count, 3)
+
+            last_query = search_elastic.call_args[0][0]
+            self.assertEqual(last_query["size"], 2)
+            self.assertEqual(last_query["search_after"], ["item4"])
+            self.assertEqual(last_query["sort"], [{"versioncreated": "desc"}, {"_id": "asc"}])
+            self.assertNotIn("from", last_query)
+
+            # The hits are not streamed when they're returned with the report
+            with mock.patch.object(service, "search_elastic", return_value=gen_page([])):
+                docs = service.execute_query(query, ["archive_statistics"], dict(args, include_items=1))
+                self.assertIsInstance(docs, ElasticCursor)
+
+    def test_iter_hits_is_limited(self):
+        config = {"ANALYTICS_STATS_STREAM_SIZE": 2, "ANALYTICS_STATS_STREAM_MAX_HITS": 3}
+
+        with self.app.app_context(), mock.patch.dict(self.app.config, config):
+            service = StatsReportService("archive_statistics", backend=get_backend())
+            service.stream_hits = True
+
+            query = {"query": {"match_all": {}}, "sort": [{"versioncreated": "desc"}]}
+            pages = [gen_page(["item1", "item2"]), gen_page(["item3", "item4"]), gen_page(["item5"])]
+
+            with mock.patch.object(service, "search_elastic", side_effect=pages) as search_elastic:
+                docs = service.execute_query(query, ["archive_statistics"], {"return_type": "text/csv"})
+                self.assertEqual([doc["_id"] for doc in docs], ["item1", "item2", "item3"])
+
+            self.assertEqual(search_elastic.call_count, 2)
+
+            # The hits are not limited by default
+            pages = [gen_page(["item1", "item2"]), gen_page(["item3", "item4"]), gen_page(["item5"])]
+
+            with mock.patch.dict(self.app.config, {"ANALYTICS_STATS_STREAM_MAX_HITS": None}):
+                with mock.patch.object(service, "search_elastic", side_effect=pages):
+                    docs = service.execute_query(query, ["archive_statistics"], {"return_type": "text/csv"})
+                    self.assertEqual(len(list(docs)), 5)
+
+    def test_paged_requests_return_the_total(self):
+        with self.app.app_context():
+            service = UpdateTimeReportService("update_time_report", backend=get_backend())
+
+            query = {"query": {"match_all": {}}, "sort": [{"firstpublished": "desc"}], "size": 2, "from": 2}
+            args = {"return_type": "aggregations"}
+
+            with mock.patch.object(service, "search_elastic", return_value=gen_page(["item3", "item4"], 5)) as search:
+                docs = service.execute_query(query, ["archive_statistics"], args)
+                report = service.generate_output(docs, args)
+
+            # The page requested by the client is searched, instead of streaming all the hits
+            self.assertEqual(search.call_args[0][0]["from"], 2)
+            self.assertEqual(search.call_args[0][0]["size"], 2)
+
+            self.assertIsInstance(report, ElasticCursor)
+            self.assertEqual(report.count(), 5)
+            self.assertEqual([doc["_id"] for doc in report], ["item3", "item4"])
@@ -0,0 +1,247 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import Command, command, get_resource_service, Option
+from superdesk.logging import logger
+from superdesk.celery_task_utils import get_lock_id
+from superdesk.lock import lock, unlock
+
+from analytics.stats.archive_statistics import HISTORY_FIELDS
+from analytics.stats.gen_archive_statistics import (
+    GenArchiveStatistics,
+    gen_stats_signals,
+    lock_backfill_ranges,
+    unlock_all,
+)
+
+from flask import current_app as app
+from eve.utils import config
+from time import monotonic
+
+
+# Number of attempts to process a batch of history that failed, before it's left for the hourly task
+MAX_ATTEMPTS = 5
+
+
+class HistoryDebouncer:
+    """Buffers archive_history items, until no new history has been received for an item
+
+    This way a burst of updates to an item (i.e. while it is being edited) is processed as one batch.
+
+    Example:
+    ::
+
+        debouncer = HistoryDebouncer(debounce=5, max_items=100)
+        debouncer.add(history)
+        history_items = debouncer.pop_ready()
+
+    """
+
+    def __init__(self, debounce=5, max_items=100):
+        """Initialise the debouncer
+
+        :param float debounce: Seconds since the last history of an item, before the item is ready
+        :param int max_items: Maximum number of buffered items, before all items are considered ready
+        """
+
+        self.debounce = debounce
+        self.max_items = max_items
+        self.history = {}
+        self.last_received = {}
+
+    def __len__(self):
+        return len(self.history)
+
+    def add(self, history, now=None):
+        item_id = history.get("item_id")
+        self.history.setdefault(item_id, []).append(history)
+        self.last_received[item_id] = monotonic() if now is None else now
+
+    def pop_ready(self, now=None, force=False):
+        """Removes and returns the history of the items that are ready to be processed
+
+        :param float now: The current monotonic time
+        :param bool force: If True, return the history of all buffered items
+        :return list: The history items, sorted by their id
+        """
+
+        now = monotonic() if now is None else now
+        force = force or len(self.history) >= self.max_items
+
+        ready = [
+            item_id
+            for item_id, last_received in self.last_received.items()
+            if force or now - last_received >= self.debounce
+        ]
+
+        history_items = []
+        for item_id in ready:
+            history_items.extend(self.history.pop(item_id))
+            self.last_received.pop(item_id)
+
+        return sorted(history_items, key=lambda history: (history[config.ID_FIELD], history.get("version")))
+
+
+class StreamArchiveStatistics(Command):
+    """Generate statistics as soon as new archive_history documents are inserted
+
+    Follows the inserts into archive_history using a Mongo change stream (requires a replica set),
+    and feeds the new history through the same path as ``analytics:gen_archive_statistics``.
+    The history is debounced per item, and processed in small batches.
+
+    The hourly ``analytics:gen_archive_statistics`` task still runs, as a reconciliation sweep.
+    History that has already been processed by this command is skipped by the sweep.
+    While the sweep is running, new history is kept in the buffer until it has finished.
+
+    The resume token of the change stream is stored (stats_type='stream') whenever the buffer is empty,
+    so after a restart the stream continues from where it left off. If generating the stats of a batch fails,
+    the batch is kept in the buffer (so the resume token doesn't move past it) and retried with an increasing delay.
+    After MAX_ATTEMPTS failures, the batch is skipped and left for the hourly task.
+
+    Options
+    ::
+
+        -d, --debounce (defaults to ANALYTICS_STATS_STREAM_DEBOUNCE config, or 5):
+        Seconds without new history for an item, before its stats are generated
+        -m, --max-items (defaults to 100):
+        Maximum number of items buffered, before all buffered items are processed
+
+    Example:
+    ::
+
+        $ python manage.py analytics:stream_archive_statistics
+        $ python manage.py analytics:stream_archive_statistics -d 10 -m 500
+
+    """
+
+    option_list = [
+        Option("--debounce", "-d", dest="debounce", default=None),
+        Option("--max-items", "-m", dest="max_items", default=100),
+    ]
+
+    resume_id = "stream_resume"
+    failures = 0
+    retry_at = 0
+
+    def run(self, debounce=None, max_items=100):
+        if debounce is None:
+            debounce = app.config.get("ANALYTICS_STATS_STREAM_DEBOUNCE", 5)
+
+        debouncer = HistoryDebouncer(float(debounce), int(max_items))
+        generator = GenArchiveStatistics()
+        collection = app.data.mongo.pymongo("archive_history").db["archive_history"]
+
+        pipeline = [
+            {"$match": {"operationType": "insert"}},
+            {"$project": dict({"fullDocument.{}".format(field): 1 for field in HISTORY_FIELDS}, operationType=1)},
+        ]
+
+        resume_token = self.get_resume_token()
+        logger.info("Starting to stream archive statistics (resume_token={})".format(resume_token))
+
+        with collection.watch(pipeline, resume_after=resume_token, max_await_time_ms=1000) as stream:
+            while stream.alive:
+                change = stream.try_next()
+
+                if change is not None:
+                    debouncer.add(change["fullDocument"])
+
+                history_items = debouncer.pop_ready() if len(debouncer) and monotonic() >= self.retry_at else []
+                if history_items and not self.process_history(generator, history_items):
+                    # Keep the history in the buffer, and try again later
+                    for history in history_items:
+                        debouncer.add(history)
+
+                if not len(debouncer) and stream.resume_token != resume_token:
+                    resume_token = stream.resume_token
+                    self.set_resume_token(resume_token)
+
+    def process_history(self, generator, history_items):
+        """Generate the stats for the provided history items
+
+        :param GenArchiveStatistics generator: The command used to generate the stats
+        :param list history_items: The history items to process
+        :return bool: False if the history should be processed again later, as the hourly task or backfill
+            is running or generating the stats failed
+        """
+
+        lock_name = get_lock_id("analytics", "gen_archive_statistics")
+        if not lock(lock_name, expire=610):
+            logger.info(
+                "Generate archive statistics task is running, delaying {} history items".format(len(history_items))
+            )
+            return False
+
+        range_locks = lock_backfill_ranges(history_items)
+        if range_locks is None:
+            unlock(lock_name)
+            logger.info("Items are locked by the backfill, delaying {} history items".format(len(history_items)))
+            return False
+
+        failed_ids = []
+
+        try:
+            gen_stats_signals["start"].send(generator)
+
+            items = generator.gen_history_timelines(history_items)
+            generator.process_timelines(items, failed_ids)
+
+            gen_stats_signals["finish"].send(generator)
+        except Exception:
+            self.failures += 1
+            item_ids = sorted({str(history.get("item_id")) for history in history_items})
+
+            if self.failures < MAX_ATTEMPTS:
+                delay = 2**self.failures
+                logger.exception(
+                    "Failed to generate archive stats for items {}, retrying in {} seconds".format(
+                        ", ".join(item_ids), delay
+                    )
+                )
+                self.retry_at = monotonic() + delay
+                return False
+
+            logger.exception(
+                "Failed to generate archive stats for items {} after {} attempts, "
+                "skipping {} history items (they will be processed by the hourly task)".format(
+                    ", ".join(item_ids), self.failures, len(history_items)
+                )
+            )
+        finally:
+            unlock_all(range_locks)
+            unlock(lock_name)
+
+        self.failures = 0
+        self.retry_at = 0
+
+        if len(failed_ids) > 0:
+            logger.warning(
+                "Failed to generate stats for items {}, they will be processed by the hourly task".format(
+                    ", ".join(failed_ids)
+                )
+            )
+
+        return True
+
+    def get_resume_token(self):
+        doc = get_resource_service("archive_statistics").find_one(req=None, _id=self.resume_id) or {}
+        return doc.get("resume_token")
+
+    def set_resume_token(self, resume_token):
+        service = get_resource_service("archive_statistics")
+        doc = service.find_one(req=None, _id=self.resume_id)
+
+        if doc:
+            service.system_update(self.resume_id, {"resume_token": resume_token}, doc)
+        else:
+            service.post([{config.ID_FIELD: self.resume_id, "stats_type": "stream", "resume_token": resume_token}])
+
+
+command("analytics:stream_archive_statistics", StreamArchiveStatistics())
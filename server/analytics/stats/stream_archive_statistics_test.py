@@ -0,0 +1,60 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2013-2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk.tests import TestCase
+
+from analytics.stats.stream_archive_statistics import HistoryDebouncer, StreamArchiveStatistics, MAX_ATTEMPTS
+from analytics.stats.gen_archive_statistics import GenArchiveStatistics
+from analytics.stats.gen_archive_statistics_test import gen_history
+
+from unittest import mock
+
+
+class HistoryDebouncerTestCase(TestCase):
+    def test_debounce_history_per_item(self):
+        debouncer = HistoryDebouncer(debounce=5, max_items=3)
+
+        debouncer.add(gen_history("item1", "history1"), now=0)
+        debouncer.add(gen_history("item2", "history2"), now=1)
+        debouncer.add(gen_history("item1", "history3"), now=3)
+
+        # No item has been idle for the debounce period yet
+        self.assertEqual(debouncer.pop_ready(now=5), [])
+
+        # item2 is ready, item1 received new history at 3
+        self.assertEqual([history["_id"] for history in debouncer.pop_ready(now=6)], ["history2"])
+        self.assertEqual([history["_id"] for history in debouncer.pop_ready(now=8)], ["history1", "history3"])
+        self.assertEqual(len(debouncer), 0)
+
+        # All items are ready once the maximum number of items are buffered
+        for index in range(3):
+            debouncer.add(gen_history("item{}".format(index), "history{}".format(index)), now=10)
+
+        self.assertEqual(len(debouncer.pop_ready(now=10)), 3)
+
+
+class StreamArchiveStatisticsTestCase(TestCase):
+    def test_failed_history_is_retried(self):
+        with self.app.app_context():
+            command = StreamArchiveStatistics()
+            generator = GenArchiveStatistics()
+            history_items = [gen_history("item1", "history1")]
+
+            with mock.patch.object(generator, "gen_history_timelines", side_effect=Exception("failed")):
+                # The history is kept in the buffer, so the resume token doesn't move past it
+                for _ in range(MAX_ATTEMPTS - 1):
+                    self.assertFalse(command.process_history(generator, history_items))
+
+                self.assertGreater(command.retry_at, 0)
+
+                # Then it's skipped, and left for the hourly task
+                self.assertTrue(command.process_history(generator, history_items))
+
+            self.assertEqual(command.failures, 0)
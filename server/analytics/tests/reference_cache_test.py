@@ -0,0 +1,71 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.reference_cache import get_desk_names, get_reference_cache
+
+from celery.signals import worker_process_init
+from unittest import mock
+
+
+class ReferenceCacheTestCase(TestCase):
+    def test_desk_names_are_cached_until_desks_change(self):
+        with self.app.app_context():
+            init_app(self.app)
+            get_reference_cache().clear()
+            self.app.config["ANALYTICS_REFERENCE_CACHE"] = True
+
+            self.app.data.insert("desks", [{"_id": "desk1", "name": "Sports"}])
+            self.assertEqual(get_desk_names(), {"desk1": "Sports"})
+
+            # Changes made without the API hooks are not seen until the cache is invalidated
+            desks = [{"_id": "desk2", "name": "Politics"}]
+            self.app.data.insert("desks", desks)
+            self.assertEqual(get_desk_names(), {"desk1": "Sports"})
+
+            self.app.on_inserted_desks(desks)
+            self.assertEqual(get_desk_names(), {"desk1": "Sports", "desk2": "Politics"})
+
+    def test_changes_made_using_the_service_invalidate_the_cache(self):
+        with self.app.app_context(), mock.patch.dict(self.app.config, {"ANALYTICS_REFERENCE_CACHE": True}):
+            init_app(self.app)
+            get_reference_cache().clear()
+
+            self.app.data.insert("desks", [{"_id": "desk1", "name": "Sports"}])
+            self.assertEqual(get_desk_names(), {"desk1": "Sports"})
+
+            service = get_resource_service("desks")
+            service.patch("desk1", {"name": "Sport"})
+            self.assertEqual(get_desk_names(), {"desk1": "Sport"})
+
+    def test_hooks_are_registered_once(self):
+        with self.app.app_context():
+            init_app(self.app)
+            num_hooks = len(self.app.on_inserted_desks)
+            num_receivers = len(worker_process_init.receivers)
+
+            init_app(self.app)
+            self.assertEqual(len(self.app.on_inserted_desks), num_hooks)
+            self.assertEqual(len(worker_process_init.receivers), num_receivers)
+
+    def test_disabled_cache_always_loads(self):
+        with self.app.app_context():
+            init_app(self.app)
+            get_reference_cache().clear()
+            self.app.config["ANALYTICS_REFERENCE_CACHE"] = False
+
+            self.app.data.insert("desks", [{"_id": "desk1", "name": "Sports"}])
+            self.assertEqual(get_desk_names(), {"desk1": "Sports"})
+
+            self.app.data.insert("desks", [{"_id": "desk2", "name": "Politics"}])
+            self.assertEqual(get_desk_names(), {"desk1": "Sports", "desk2": "Politics"})
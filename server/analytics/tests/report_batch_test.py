@@ -0,0 +1,109 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.metadata.item import ITEM_STATE, CONTENT_STATE
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.common import register_report
+
+from elasticsearch import Elasticsearch
+from unittest import mock
+
+
+class ReportBatchTestCase(TestCase):
+    def test_gen_reports_uses_a_single_msearch(self):
+        with self.app.app_context():
+            init_app(self.app)
+            register_report("analytics_test_report", "analytics_test_report")
+
+            self.app.data.insert(
+                "published",
+                [
+                    {"_id": "item1", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AAP"},
+                    {"_id": "item2", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AFP"},
+                ],
+            )
+
+            entries = [
+                {
+                    "report": "analytics_test_report",
+                    "source": {"query": {"filtered": {"filter": {"bool": {"must": [], "must_not": []}}}}, "size": 0},
+                    "repo": repo,
+                    "return_type": "aggregations",
+                }
+                for repo in ["published", "archive"]
+            ]
+
+            service = get_resource_service("analytics_report_batch")
+            with mock.patch.object(service, "msearch", wraps=service.msearch) as msearch:
+                reports = service.gen_reports(entries)
+                self.assertEqual(msearch.call_count, 1)
+
+            self.assertEqual([report["report"] for report in reports], ["analytics_test_report"] * 2)
+            self.assertEqual(
+                sorted(bucket["key"] for bucket in reports[0]["result"]["source"]),
+                ["AAP", "AFP"],
+            )
+            self.assertEqual(reports[1]["result"]["source"], [])
+
+    def test_gen_reports_round_trips(self):
+        """The multi aggregation reports (category and source) take one Elasticsearch round trip,
+        instead of one per report"""
+        with self.app.app_context():
+            init_app(self.app)
+            register_report("analytics_test_report", "analytics_test_report")
+
+            self.app.data.insert(
+                "published",
+                [
+                    {"_id": "item1", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AAP"},
+                    {"_id": "item2", ITEM_STATE: CONTENT_STATE.PUBLISHED, "source": "AFP"},
+                ],
+            )
+
+            def get_entries():
+                return [
+                    {
+                        "report": "analytics_test_report",
+                        "source": {
+                            "query": {"filtered": {"filter": {"bool": {"must": [], "must_not": []}}}},
+                            "size": 0,
+                        },
+                        "repo": "published",
+                        "return_type": "aggregations",
+                    }
+                    for _ in range(3)
+                ]
+
+            with mock.patch.object(
+                Elasticsearch, "search", autospec=True, side_effect=Elasticsearch.search
+            ) as search, mock.patch.object(
+                Elasticsearch, "msearch", autospec=True, side_effect=Elasticsearch.msearch
+            ) as msearch:
+                # Before: each report is requested on its own
+                service = get_resource_service("analytics_test_report")
+                for entry in get_entries():
+                    service.get(req=None, source=entry["source"], repo=entry["repo"])
+
+                self.assertEqual(search.call_count, 3)
+                self.assertEqual(msearch.call_count, 0)
+
+                # After: the reports are sent in one msearch
+                search.reset_mock()
+                reports = get_resource_service("analytics_report_batch").gen_reports(get_entries())
+
+                self.assertEqual(search.call_count, 0)
+                self.assertEqual(msearch.call_count, 1)
+
+            for report in reports:
+                self.assertEqual(sorted(bucket["key"] for bucket in report["result"]["source"]), ["AAP", "AFP"])
+                self.assertIn("category", report["result"])
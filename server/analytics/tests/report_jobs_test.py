@@ -0,0 +1,58 @@
+# -*- coding: utf-8; -*-
+#
+# This file is part of Superdesk.
+#
+# Copyright 2018 Sourcefabric z.u. and contributors.
+#
+# For the full copyright and license information, please see the
+# AUTHORS and LICENSE files distributed with this source code, or
+# at https://www.sourcefabric.org/superdesk/license
+
+from superdesk import get_resource_service
+from superdesk.tests import TestCase
+
+from analytics import init_app
+from analytics.common import register_report
+
+from unittest import mock
+
+
+class ReportJobsTestCase(TestCase):
+    def test_run_job_stores_the_result(self):
+        with self.app.app_context():
+            init_app(self.app)
+            register_report("analytics_test_report", "analytics_test_report")
+
+            service = get_resource_service("report_jobs")
+            self.app.data.insert(
+                "report_jobs",
+                [
+                    {
+                        "_id": "job1",
+                        "report_type": "analytics_test_report",
+                        "params": {},
+                        "return_type": "aggregations",
+                        "status": "pending",
+                    }
+                ],
+            )
+
+            with mock.patch("analytics.report_jobs.push_notification") as push:
+                service.run_job("job1")
+
+            job = service.find_one(req=None, _id="job1")
+            self.assertEqual(job["status"], "completed")
+            self.assertIsNotNone(job.get("result"))
+            self.assertIsNotNone(job.get("finished"))
+            push.assert_called_once_with(
+                "report_jobs:update",
+                job_id="job1",
+                report_type="analytics_test_report",
+                status="completed",
+                user_id=None,
+            )
+
+            # Jobs are only run once
+            with mock.patch("analytics.report_jobs.get_report_service") as get_report_service:
+                service.run_job("job1")
+                get_report_service.assert_not_called()
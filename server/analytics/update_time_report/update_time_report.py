@@ -17,6 +17,7 @@ from analytics.chart_config import ChartConfig
 from analytics.common import REPORT_CONFIG, CHART_TYPES
 
 from flask import current_app as app
+from eve_elastic.elastic import ElasticCursor
 from datetime import timedelta
 from copy import deepcopy
 
@@ -30,6 +31,10 @@ class UpdateTimeReportResource(Resource):
 
     schema = deepcopy(ArchiveStatisticsResource.schema)
     schema.pop("stats", None)
+    schema.pop("timeline_state", None)
+    schema.pop("backfill", None)
+    schema.pop("resume_token", None)
+    schema.pop("partition", None)
     schema.update(
         {
             "highcharts": {
@@ -44,6 +49,7 @@ class UpdateTimeReportResource(Resource):
 class UpdateTimeReportService(StatsReportService):
     aggregations = None
     date_filter_field = "firstpublished"
+    stream_hits = True
 
     defaultConfig = {
         REPORT_CONFIG.CHART_TYPES: {
@@ -72,14 +78,22 @@ class UpdateTimeReportService(StatsReportService):
 
         return query
 
-    def generate_report(self, docs, args):
+    @staticmethod
+    def iter_items(docs):
+        """Yields the items without their stats, as the hits are streamed"""
+
         for doc in docs:
             doc.pop("stats", None)
-        return docs
+            doc.pop("timeline_state", None)
+            yield doc
 
-    def generate_highcharts_config(self, docs, args):
-        items = list(self.generate_report(docs, args))
+    def generate_report(self, docs, args):
+        items = list(self.iter_items(docs))
+
+        # The cursor of a paged request is returned, so the response includes the total number of hits
+        return docs if isinstance(docs, ElasticCursor) else items
 
+    def generate_highcharts_config(self, docs, args):
         params = args.get("params") or {}
         chart_params = params.get("chart") or {}
 
@@ -100,7 +114,8 @@ class UpdateTimeReportService(StatsReportService):
 
             return "{} minutes".format(times[1])
 
-        for item in items:
+        # The rows are generated as the hits are streamed, in the sort order of the query
+        for item in self.iter_items(docs):
             publish_time = item.get("firstpublished")
             update_time = publish_time + timedelta(seconds=item.get("time_to_next_update_publish"))
             updated = "{} ({})".format(
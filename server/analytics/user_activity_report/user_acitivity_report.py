@@ -42,6 +42,9 @@ class UserActivityReportResource(Resource):
 class UserActivityReportService(StatsReportService):
     date_filter_field = "versioncreated"
 
+    # The report is limited to the size of the request, unless it is streamed (see use_stream_hits)
+    stream_hits = True
+
     defaultConfig = {
         REPORT_CONFIG.DATE_FILTERS: {
             # Day filter is the only type of filter available to 'UserActivity' report
@@ -62,6 +65,15 @@ class UserActivityReportService(StatsReportService):
 
     def generate_report(self, docs, args):
         report = {"items": [], "min": 0, "max": 0}
+        report["items"] = list(self.iter_items(docs, args, report))
+
+        if len(report["items"]) < 1:
+            return {}
+
+        return report
+
+    def iter_items(self, docs, args, report):
+        """Yields the items with activity of the user as the hits are streamed, updating the min/max of the report"""
 
         for doc in docs:
             stats = doc.get("stats") or {}
@@ -109,9 +121,4 @@ class UserActivityReportService(StatsReportService):
                     current_lock = None
 
             if len(entry["activity"]) > 0:
-                report["items"].append(entry)
-
-        if len(report["items"]) < 1:
-            return {}
-
-        return report
+                yield entry